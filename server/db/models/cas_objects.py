@@ -0,0 +1,21 @@
+"""content-addressed store objects model."""
+import datetime
+
+import ormar
+
+from server.db.base import BaseMeta
+
+
+class CasObject(ormar.Model):
+    """File of the content-addressed store, linked from the result directories holding the same content"""
+
+    class Meta(BaseMeta):
+        """Meta class"""
+
+        tablename = "cas_objects"
+
+    sha256: str = ormar.String(max_length=64, primary_key=True)
+    size: int = ormar.BigInteger()
+    # Result files linked to the object
+    refcount: int = ormar.Integer(default=0)
+    created: datetime.datetime = ormar.DateTime(default=datetime.datetime.now)
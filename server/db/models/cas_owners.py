@@ -0,0 +1,18 @@
+"""content-addressed store owners model."""
+import ormar
+
+from server.db.base import BaseMeta
+
+
+class CasOwner(ormar.Model):
+    """User who put content in the store, by upload or result, and may link it without sending it again"""
+
+    class Meta(BaseMeta):
+        """Meta class"""
+
+        tablename = "cas_owners"
+        constraints = [ormar.UniqueColumns("sha256", "owner_id")]
+
+    id: int = ormar.Integer(primary_key=True)
+    sha256: str = ormar.String(max_length=64, index=True)
+    owner_id: str = ormar.String(max_length=100)
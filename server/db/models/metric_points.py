@@ -0,0 +1,24 @@
+"""metric points model."""
+import datetime
+
+import ormar
+
+from server.db.base import BaseMeta
+from server.db.models.results import Result
+
+
+class MetricPoint(ormar.Model):
+    """Value of a metric at a step of a run"""
+
+    class Meta(BaseMeta):
+        """Meta class"""
+
+        tablename = "metric_points"
+        constraints = [ormar.IndexColumns("result", "step")]
+
+    id: int = ormar.BigInteger(primary_key=True, autoincrement=True)
+    result = ormar.ForeignKey(Result, related_name="metric_points", ondelete="CASCADE")
+    name: str = ormar.String(max_length=200)
+    step: int = ormar.BigInteger()
+    value: float = ormar.Float()
+    created: datetime.datetime = ormar.DateTime(default=datetime.datetime.now)
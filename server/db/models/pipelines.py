@@ -0,0 +1,31 @@
+"""pipelines model."""
+import datetime
+import uuid
+
+import ormar
+from typing import Any
+from server.db.base import BaseMeta
+from server.db.models.jobs import Job
+
+
+class Pipeline(ormar.Model):
+    """Pipeline model: stages run one after the other on a job"""
+
+    class Meta(BaseMeta):
+        """Meta class"""
+
+        tablename = "pipelines"
+
+    id: uuid.UUID = ormar.UUID(primary_key=True, default=uuid.uuid4)
+    owner_id: str = ormar.String(max_length=100, nullable=False)
+    job = ormar.ForeignKey(Job)
+    # Declared stages: [{"type": "train" | "test" | "export", "name": ..., "parameters": ..., "datasets": ...}]
+    stages: list[dict[str, Any]] = ormar.JSON(default=[])
+    current_stage: int = ormar.Integer(default=0)
+    # Result of the running stage, its submission starts the next stage
+    current_result_id: uuid.UUID = ormar.UUID(nullable=True, index=True)
+    status: str = ormar.String(max_length=20, default="running")
+    # Per stage: {"type": ..., "result_id": ..., "started": ..., "finished": ..., "seconds": ...}
+    timings: list[dict[str, Any]] = ormar.JSON(default=[])
+    created: datetime.datetime = ormar.DateTime(default=datetime.datetime.now)
+    modified: datetime.datetime = ormar.DateTime(default=datetime.datetime.now)
@@ -0,0 +1,26 @@
+"""result files model."""
+import ormar
+
+from server.db.base import BaseMeta
+from server.db.models.results import Result
+
+
+class ResultFile(ormar.Model):
+    """Manifest entry of a file in a result directory"""
+
+    class Meta(BaseMeta):
+        """Meta class"""
+
+        tablename = "result_files"
+        constraints = [ormar.UniqueColumns("result", "name")]
+
+    id: int = ormar.Integer(primary_key=True)
+    result = ormar.ForeignKey(Result, related_name="result_files")
+    # Path relative to the result directory
+    name: str = ormar.String(max_length=1000)
+    size: int = ormar.BigInteger()
+    sha256: str = ormar.String(max_length=64)
+    mtime: float = ormar.Float()
+    # Set when the file is stored compressed, size and sha256 are then those of its content
+    encoding: str = ormar.String(max_length=10, nullable=True)
+    stored_size: int = ormar.BigInteger(nullable=True)
@@ -39,3 +39,12 @@ class Result(ormar.Model):
     parameters: dict[str, Any] = ormar.JSON(default={})
     pretrained_model: str = ormar.String(max_length=300, nullable=True)
     predictions: dict[str, Any] = ormar.JSON(default={})
+    # Parent result of a batch test, one child result per dataset
+    parent_id: uuid.UUID = ormar.UUID(nullable=True, index=True)
+    # Pinned results are never moved to the archive tier
+    pinned: bool = ormar.Boolean(default=False, server_default="false")
+    # Storage tier of the files: [hot or archived]
+    tier: str = ormar.String(max_length=20, default="hot", server_default="hot")
+    archived: datetime.datetime = ormar.DateTime(nullable=True)
+    # Last time the files were restored from the archive tier
+    restored: datetime.datetime = ormar.DateTime(nullable=True)
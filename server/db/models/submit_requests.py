@@ -0,0 +1,28 @@
+"""submit requests model."""
+import datetime
+import uuid
+
+import ormar
+
+from server.db.base import BaseMeta
+
+
+class SubmitRequest(ormar.Model):
+    """Idempotency key of a result submission, with its outcome once it is processed"""
+
+    class Meta(BaseMeta):
+        """Meta class"""
+
+        tablename = "submit_requests"
+        constraints = [ormar.UniqueColumns("owner_id", "key")]
+
+    id: int = ormar.Integer(primary_key=True)
+    owner_id: str = ormar.String(max_length=100)
+    key: str = ormar.String(max_length=200)
+    # Status of the submission: [pending or done]
+    status: str = ormar.String(max_length=20, default="pending")
+    # Result the submission was for, and the status it left it in
+    result_id: uuid.UUID = ormar.UUID(nullable=True)
+    result_status: str = ormar.String(max_length=300, nullable=True)
+    created: datetime.datetime = ormar.DateTime(default=datetime.datetime.now, index=True)
+    completed: datetime.datetime = ormar.DateTime(nullable=True)
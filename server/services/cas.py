@@ -0,0 +1,336 @@
+"""
+Content-addressed store of result artifacts.
+
+Large artifacts, like the pretrained model of a training result, and
+uploaded test data are kept once per content in
+`{results_dir}/.cas/<sha256[:2]>/<sha256>`. The file in each result or
+dataset directory is a hard link to the stored object, so downloads and
+test runs that mount it by path read the store without knowing about it.
+Objects are read-only, since every result linking them shares the bytes.
+The number of links of an object's inode is its reference count: an object
+no directory links any more is removed by the garbage collection.
+"""
+import asyncio
+import os
+import re
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Any
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from server.db.config import database
+from server.db.models.cas_objects import CasObject
+from server.db.models.cas_owners import CasOwner
+from server.db.models.result_files import ResultFile
+from server.db.models.results import Result
+from server.services.compression import SKIPPED_DIRS, is_compressible
+from server.services.manifest import hash_file, result_dir_of
+from server.settings import settings
+
+READ_ONLY = 0o444
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def cas_dir() -> Path:
+    """Directory of the content-addressed store."""
+    return Path(settings.results_dir) / ".cas"
+
+
+def object_path(sha256: str) -> Path:
+    """
+    Path of the stored object with this content hash.
+
+    Raises:
+    - ValueError: If `sha256` is not a lowercase hex SHA-256, which could point outside the store.
+    """
+    if not SHA256_PATTERN.fullmatch(sha256):
+        raise ValueError(f"Invalid SHA-256 {sha256!r}")
+    return cas_dir() / sha256[:2] / sha256
+
+
+def is_deduplicated(name: str, size: int) -> bool:
+    """Whether a result file is kept in the store."""
+    # Text files are compressed at rest instead, which replaces them and would break the link
+    return (
+        size >= settings.cas_min_size
+        and not is_compressible(name, size)
+        and not SKIPPED_DIRS.intersection(PurePosixPath(name).parts[:-1])
+    )
+
+
+def link_file(path: Path, sha256: str, size: int) -> tuple[str, os.stat_result] | None:
+    """
+    Put a file in the store, or replace it with a link to the stored object with the same content.
+
+    The hash of a manifest entry is checked against the file before it is
+    linked either way: a wrong one would put this content under another's
+    name, or replace this file with another's.
+
+    Returns:
+    - tuple[str, os.stat_result] | None: `stored` or `linked` and the stat of the file,
+      None if it already is the object, or cannot be linked (other file system, size or content mismatch).
+
+    Raises:
+    - ValueError: If `sha256` is not a SHA-256.
+    """
+    target = object_path(sha256)
+    current = path.stat()
+    try:
+        stored = target.stat()
+    except FileNotFoundError:
+        stored = None
+    if stored is not None and stored.st_ino == current.st_ino and stored.st_dev == current.st_dev:
+        return None
+    if current.st_size != size or (stored is not None and stored.st_size != size):
+        return None
+    if hash_file(path) != sha256:
+        return None
+    if stored is None:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(path, READ_ONLY)
+        try:
+            os.link(path, target)
+        except FileExistsError:
+            # Stored by another result in the meantime, the file is linked to it instead
+            pass
+        except OSError:
+            return None
+        else:
+            return "stored", path.stat()
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.link")
+    try:
+        os.link(target, tmp_path)
+    except OSError:
+        return None
+    os.replace(tmp_path, path)
+    return "linked", path.stat()
+
+
+def keep_upload(path: Path, sha256: str, destination: Path) -> None:
+    """
+    Move an uploaded file into the store under its content hash and link it at `destination`.
+
+    When the content is already stored, the uploaded copy is dropped.
+    """
+    target = object_path(sha256)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.chmod(path, READ_ONLY)
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        # Stored by an earlier upload
+        pass
+    try:
+        _link_object(sha256, destination)
+    except FileNotFoundError:
+        # Collected in the meantime, the uploaded copy is kept as it is
+        os.replace(path, destination)
+        return
+    if path != destination:
+        path.unlink()
+
+
+def has_object(sha256: str, size: int | None = None) -> bool:
+    """Whether the store holds this content, of this size when given."""
+    try:
+        stat = object_path(sha256).stat()
+    except (FileNotFoundError, ValueError):
+        return False
+    return size is None or stat.st_size == size
+
+
+async def owns_object(sha256: str, size: int, owner_id: str) -> bool:
+    """
+    Whether the store holds this content, of this size, put there by the user.
+
+    Content other users stored is not linked for a hash and size alone,
+    which would hand out their uploads and checkpoints to anyone knowing them.
+    """
+    if not await asyncio.to_thread(has_object, sha256, size):
+        return False
+    return await CasOwner.objects.filter(sha256=sha256, owner_id=owner_id).exists()
+
+
+async def store_upload(path: Path, sha256: str, destination: Path, owner_id: str) -> None:
+    """
+    Keep an uploaded file once per content and link it at `destination`.
+
+    Parameters:
+    - path (Path): The uploaded file, hashed while it was received.
+    - sha256 (str): Its SHA-256.
+    - destination (Path): Where the file is used from, it can be `path` itself.
+    - owner_id (str): The user who uploaded it.
+    """
+    await asyncio.to_thread(keep_upload, path, sha256, destination)
+    await _add_reference(sha256, destination.stat().st_size, owner_id)
+
+
+async def link_upload(sha256: str, destination: Path, owner_id: str) -> None:
+    """
+    Link content the user already stored at `destination`, for an upload that is skipped.
+
+    Raises:
+    - FileNotFoundError: If the content is not stored.
+    """
+    await asyncio.to_thread(_link_object, sha256, destination)
+    await _add_reference(sha256, destination.stat().st_size, owner_id)
+
+
+def _link_object(sha256: str, destination: Path) -> None:
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.link")
+    os.link(object_path(sha256), tmp_path)
+    os.replace(tmp_path, destination)
+
+
+async def _add_reference(sha256: str, size: int, owner_id: str) -> None:
+    table = CasObject.Meta.table
+    insert = postgresql.insert(table).values(sha256=sha256, size=size, refcount=1, created=sa.func.now())
+    await database.execute(insert.on_conflict_do_update(
+        index_elements=[table.c.sha256],
+        set_={"refcount": table.c.refcount + 1},
+    ))
+    owners = CasOwner.Meta.table
+    await database.execute(
+        postgresql.insert(owners).values(sha256=sha256, owner_id=owner_id)
+        .on_conflict_do_nothing(index_elements=[owners.c.sha256, owners.c.owner_id])
+    )
+
+
+async def dedupe_result(result: Result) -> int:
+    """
+    Move the large files of a result to the store, linking the ones whose content is already there.
+
+    Parameters:
+    - result (Result): The result, with its job and an up to date manifest.
+
+    Returns:
+    - int: Bytes saved by linking files to existing objects.
+    """
+    result_dir = result_dir_of(result)
+    saved = 0
+    for entry in await ResultFile.objects.filter(result=result.id, encoding__isnull=True).all():
+        if not is_deduplicated(entry.name, entry.size):
+            continue
+        path = result_dir / entry.name
+        try:
+            stat = path.stat()
+            if stat.st_size != entry.size or stat.st_mtime != entry.mtime:
+                # Changed since it was indexed, its hash cannot be trusted
+                continue
+            linked = await asyncio.to_thread(link_file, path, entry.sha256, entry.size)
+        except (FileNotFoundError, ValueError):
+            continue
+        if linked is None:
+            continue
+        action, stat = linked
+        await _add_reference(entry.sha256, entry.size, result.owner_id)
+        if stat.st_mtime != entry.mtime:
+            await entry.update(mtime=stat.st_mtime)
+        if action == "linked":
+            saved += entry.size
+    return saved
+
+
+def _scan_objects() -> dict[str, tuple[int, int]]:
+    """Size and number of result links of each stored object, from the file system."""
+    objects: dict[str, tuple[int, int]] = {}
+    root = cas_dir()
+    if not root.is_dir():
+        return objects
+    for prefix in root.iterdir():
+        if not prefix.is_dir():
+            continue
+        for path in prefix.iterdir():
+            if not SHA256_PATTERN.fullmatch(path.name):
+                # Temporary links, or files that are not objects
+                continue
+            stat = path.stat()
+            objects[path.name] = (stat.st_size, stat.st_nlink - 1)
+    return objects
+
+
+async def collect_garbage() -> dict[str, int]:
+    """
+    Remove objects no result links any more and bring reference counts in line with the links on disk.
+
+    Returns:
+    - dict[str, int]: Objects removed and bytes freed.
+    """
+    objects = await asyncio.to_thread(_scan_objects)
+    counts = {row.sha256: row for row in await CasObject.objects.all()}
+    removed = freed = 0
+    for sha256, (size, refcount) in objects.items():
+        row = counts.pop(sha256, None)
+        if refcount == 0:
+            # A result could link the object between the scan and now, it then keeps its own copy
+            await asyncio.to_thread(object_path(sha256).unlink, True)
+            if row is not None:
+                await row.delete()
+            await CasOwner.objects.filter(sha256=sha256).delete()
+            removed += 1
+            freed += size
+        elif row is None:
+            await CasObject.objects.create(sha256=sha256, size=size, refcount=refcount)
+        elif row.refcount != refcount:
+            await row.update(refcount=refcount)
+    if counts:
+        # Objects removed from disk outside of the store
+        await CasObject.objects.filter(sha256__in=list(counts)).delete()
+        await CasOwner.objects.filter(sha256__in=list(counts)).delete()
+    return {"removed": removed, "freed_bytes": freed}
+
+
+async def cas_stats(owner_id: str) -> dict[str, Any]:
+    """
+    Objects of the store a user put in, bytes they take, bytes the user's result files would take as copies, and the ratio.
+
+    Only the user's own objects and files are counted, so the store does not
+    tell anyone what content other users hold.
+    """
+    objects = CasObject.Meta.table
+    owners = CasOwner.Meta.table
+    files = ResultFile.Meta.table
+    results = Result.Meta.table
+    owned = (
+        sa.select(objects.c.sha256, objects.c.size)
+        .select_from(objects.join(owners, owners.c.sha256 == objects.c.sha256))
+        .where(owners.c.owner_id == owner_id, objects.c.refcount > 0)
+        .subquery()
+    )
+    links = (
+        sa.select(files.c.sha256, sa.func.count().label("links"))
+        .select_from(files.join(results, results.c.id == files.c.result))
+        .where(results.c.owner_id == owner_id, files.c.sha256.in_(sa.select(owned.c.sha256)))
+        .group_by(files.c.sha256)
+        .subquery()
+    )
+    row = await database.fetch_one(
+        sa.select(
+            sa.func.count(),
+            sa.func.coalesce(sa.func.sum(owned.c.size), 0),
+            sa.func.coalesce(sa.func.sum(owned.c.size * sa.func.coalesce(links.c.links, 0)), 0),
+            sa.func.coalesce(sa.func.sum(links.c.links), 0),
+        ).select_from(owned.outerjoin(links, links.c.sha256 == owned.c.sha256))
+    )
+    count, stored, logical, linked = (int(value) for value in row)  # type: ignore[union-attr]
+    return {
+        "objects": count,
+        "links": linked,
+        "stored_bytes": stored,
+        "logical_bytes": logical,
+        "saved_bytes": max(logical - stored, 0),
+        "dedup_ratio": logical / stored if stored else 1.0,
+    }
+
+
+async def run_forever(interval: float) -> None:
+    """Collect garbage in the store until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await collect_garbage()
+        except Exception as e:
+            print(f"Garbage collection of the content-addressed store failed: {e}")
@@ -1,13 +1,15 @@
 """This module contains the functions to run the cog commands"""
-from concurrent.futures import ProcessPoolExecutor
+import asyncio
 import subprocess
 import os, shutil
 from typing import Any, Callable, Iterable
 import uuid
 from pathlib import Path
 from fastapi import HTTPException
+from git import Repo
 
 from server.services.git import GitService
+from server.services.logs import LogStream, log_broadcaster, pump_process_output
 from server.web.api.utils import job_get_dirs
 from server.settings import settings
 
@@ -33,6 +35,31 @@ def copyfile(
     except Exception as e:
         raise Exception(f"Error copying file: {str(e)}")
 
+def linkfile(
+        src: str,
+        dst: str,
+    ) -> None:
+    """
+    Hard link a file from src into dst, copying it when it cannot be linked.
+
+    Uploaded test data is read-only and shared by every run using it, so a
+    link saves a copy per run.
+
+    Parameters:
+    - src (str): The source file path.
+    - dst (str): The destination directory path.
+
+    Raises:
+    - Exception: If an error occurs during the copying process.
+    """
+    target = Path(dst) / Path(src).name if Path(dst).is_dir() else Path(dst)
+    try:
+        target.unlink(missing_ok=True)
+        os.link(src, target)
+    except OSError:
+        # Other file system, or no links allowed
+        copyfile(src, dst)
+
 async def run(
     name: str,
     at: str,
@@ -43,12 +70,14 @@ async def run(
     user_token: str,
     job_id: uuid.UUID,
     trained_model: str | None = None,
-) -> None:
+) -> "asyncio.Future[None]":
     """
-    Run a script in a cog environment using ProcessPoolExecutor.
+    Run a script in a cog environment as a subprocess of the server.
 
     This function is responsible for executing a command-line interface (CLI) script in a cog environment.
-    It uses Python's concurrent.futures.ProcessPoolExecutor to run the script asynchronously.
+    The output of the script is written to the result's segmented logs and published to the log broadcaster
+    as it comes, so it can be followed live.
+    The returned future completes when the process exits, so callers can supervise the run.
 
     Parameters:
     - name (str): The name of the cog.
@@ -62,13 +91,11 @@ async def run(
     - trained_model (str | None, optional): The path to the trained model. Defaults to None.
 
     Returns:
-    None
+    asyncio.Future[None]: Completes when the script exits, with its exception if it failed.
 
     Raises:
     - Any: Any exceptions raised during the execution of the script.
     """
-    executor = ProcessPoolExecutor()
-
     run_script = build_cli_script(
         name=name,
         dataset_dir=dataset_dir,
@@ -79,13 +106,9 @@ async def run(
         trained_model=trained_model,
         job_id=job_id
     )
-    stdout_file_path = Path(f"{base_dir}/{str(result_id)}/stdout.log").resolve()
-    executor.submit(
-        run_process_with_std,
-        run_script=run_script,
-        stdout_file_path=stdout_file_path,
-        at=at
-    )
+    # Open the logs before returning so that followers find them from the start
+    stream = log_broadcaster.open(Path(f"{base_dir}/{str(result_id)}/logs"))
+    return asyncio.create_task(run_process_with_std(run_script=run_script, stream=stream, at=at))
 def build_cli_script(
     name: str,
     dataset_dir: str,
@@ -117,26 +140,86 @@ def build_cli_script(
     Returns:
     str: The constructed CLI script as a string.
     """
-    dataset_dir = replace_source_with_destination(dataset_dir, base_dir)
-    run_script = f"cog train -n {str(job_id)} -i dataset={dataset_dir} -i result_id={result_id} -i api_url={api_url} -i pkg_name={name} -i user_token={user_token}"
-    if trained_model is not None:
-        trained_model = replace_source_with_destination(trained_model, base_dir)
-        run_script += f" -i trained_model={trained_model}"
+    inputs = build_cog_inputs(
+        name=name,
+        dataset_dir=dataset_dir,
+        base_dir=base_dir,
+        result_id=result_id,
+        api_url=api_url,
+        user_token=user_token,
+        trained_model=trained_model,
+    )
+    run_script = f"cog train -n {str(job_id)}"
+    for key, value in inputs.items():
+        run_script += f" -i {key}={value}"
     # Mount the base directory
     run_script += f" --mount type=bind,source={base_dir},target={settings.cog_base_dir}"
     return run_script
 
-def run_process_with_std(run_script: str, stdout_file_path: Path, at: str) -> None:
+def build_cog_inputs(
+    name: str,
+    dataset_dir: str,
+    base_dir: str,
+    result_id: uuid.UUID,
+    api_url: str,
+    user_token: str,
+    trained_model: str | None = None,
+) -> dict[str, str]:
+    """
+    Build the cog inputs of a run.
+
+    The same inputs are passed with `-i` to `cog train` and posted as JSON
+    to a warm container, with host paths replaced by their mount target.
+
+    Parameters:
+    - name (str): The name of the cog.
+    - dataset_dir (str): The directory path of the dataset.
+    - base_dir (str): The base directory path.
+    - result_id (uuid.UUID): The unique identifier for the result.
+    - api_url (str): The URL of the API.
+    - user_token (str): The user's authentication token.
+    - trained_model (str | None, optional): The path to the trained model. Defaults to None.
+
+    Returns:
+    dict[str, str]: The cog inputs keyed by name.
+    """
+    inputs = {
+        "dataset": replace_source_with_destination(dataset_dir, base_dir),
+        "result_id": str(result_id),
+        "api_url": api_url,
+        "pkg_name": name,
+        "user_token": user_token,
+    }
+    if trained_model is not None:
+        inputs["trained_model"] = replace_source_with_destination(trained_model, base_dir)
+    return inputs
+
+def head_commit(at: str) -> str:
+    """
+    Get the commit checked out in a repository directory.
+
+    Parameters:
+    - at (str): The directory of the cloned repository.
+
+    Returns:
+    str: The commit hash, or an empty string when it cannot be read.
+    """
+    try:
+        return Repo(at).head.commit.hexsha
+    except Exception:
+        return ""
+
+async def run_process_with_std(run_script: str, stream: LogStream, at: str) -> None:
     """
     Run a process with stderr and stdout.
 
-    This function executes a command-line script in a subprocess, redirecting the standard output (stdout)
-    and standard error (stderr) to a specified file. The function also changes the working directory (cwd)
-    to the specified path before executing the script.
+    This function executes a command-line script in a subprocess, publishing the standard output (stdout)
+    and standard error (stderr) to a log stream, which writes them to its segments. The script runs in the
+    specified directory.
 
     Parameters:
     - run_script (str): The command-line script to be executed.
-    - stdout_file_path (Path): The path to the file where the stdout and stderr will be redirected.
+    - stream (LogStream): The log stream the stdout and stderr are published to.
     - at (str): The path to the directory where the script should be executed.
 
     Returns:
@@ -145,16 +228,20 @@ def run_process_with_std(run_script: str, stdout_file_path: Path, at: str) -> No
     Raises:
     - subprocess.CalledProcessError: If the script execution returns a non-zero exit status.
     """
-    with stdout_file_path.open("wb") as stdout_file:
-        subprocess.run(
+    try:
+        process = await asyncio.create_subprocess_shell(
             run_script,
-            stdout=stdout_file,
-            stderr=subprocess.STDOUT,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
             cwd=at,
-            shell=True,
             executable="/bin/bash",
-            check=True
         )
+        await pump_process_output(process, stream)
+        returncode = await process.wait()
+    finally:
+        log_broadcaster.close(stream)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, run_script)
 
 async def setup(
         job_id: uuid.UUID,
@@ -219,7 +306,7 @@ async def prepare(
     - job_id (uuid.UUID): The unique identifier for the job.
     - dataset_name (str): The name of the dataset repository or the path to the dataset
     - model_name (str): The name of the model repository.
-    - dataset_type (str): The type of the dataset. It can be either 'upload' or 'default'.
+    - dataset_type (str): The type of the dataset. It can be 'upload', 'default' or 'none' to only fetch the model.
     - results_dir (str, optional): The directory path where the uploaded dataset is located. Defaults to an empty string.
     - dataset_branch (str | None, optional): The branch of the dataset repository to clone. Defaults to None.
     - model_branch (str | None, optional): The branch of the model repository to clone. Defaults to None.
@@ -237,7 +324,7 @@ async def prepare(
     try:
         # run git
         if dataset_type == 'upload':
-            copyfile(dataset_name,results_dir)
+            linkfile(dataset_name,results_dir)
         elif dataset_type == 'default':
             git.fetch(repo_name_with_namspace=dataset_name, to=dataset_path, branch= dataset_branch)
         git.fetch(repo_name_with_namspace=model_name, to=model_path, branch= model_branch)
@@ -246,6 +333,32 @@ async def prepare(
 
     return True
 
+def prepare_dataset_branch(job_id: uuid.UUID, dataset_name: str, branch: str) -> str:
+    """
+    Check out a branch of the dataset repository in its own directory of the job.
+
+    Parameters:
+    - job_id (uuid.UUID): The unique identifier for the job.
+    - dataset_name (str): The name of the dataset repository.
+    - branch (str): The branch to check out.
+
+    Returns:
+    - str: The directory holding the branch, `{dataset_name}@{branch}` in the job directory.
+
+    Raises:
+    - HTTPException: If the branch cannot be fetched.
+    """
+    _, branch_path, _ = job_get_dirs(job_id, f"{dataset_name}@{branch.replace('/', '--')}", "")
+    git = GitService()
+    try:
+        if os.path.isdir(f"{branch_path}/.git"):
+            git.fetch(repo_name_with_namspace=dataset_name, to=branch_path, branch=branch)
+        else:
+            git.clone_repo(repo_name_with_namspace=dataset_name, to=branch_path, branch=branch)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error Preparing Dataset Branch {branch}: {str(e)}")
+    return branch_path
+
 def stop(job_id: uuid.UUID) -> bool:
     """
     Stop the jobs for container.
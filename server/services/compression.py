@@ -0,0 +1,193 @@
+"""
+Compression at rest of result files.
+
+Text files of a finished result, like CSVs, JSON and logs, are compressed in
+place: the file keeps its name and its manifest entry records the encoding
+and the stored size, while `size` and `sha256` stay those of the content.
+zstd is used when the `zstandard` package is installed, gzip otherwise.
+Readers go through `open_stored`, which recognises compressed files by their
+magic number, so a file is read the same before and after compression.
+
+Runs do not: result directories are mounted in later test and pipeline
+containers, which read files like the `config.json` saved next to a
+checkpoint by path. The feature is therefore opt-in, and the files next to
+the trained model of a result are never compressed.
+"""
+import asyncio
+import gzip
+import os
+import time
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO
+
+import sqlalchemy as sa
+
+from server.db.config import database
+from server.db.models.result_files import ResultFile
+from server.db.models.results import Result
+from server.services.manifest import result_dir_of
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+ENCODING = "zstd" if zstandard is not None else "gzip"
+# Only text compresses well enough to be worth decoding on every read
+COMPRESSIBLE_SUFFIXES = {".log", ".txt", ".csv", ".tsv", ".json", ".jsonl", ".yaml", ".yml", ".xml", ".html", ".md"}
+# Directories with their own layout, read at offsets
+SKIPPED_DIRS = {"logs", "predictions"}
+# Files read at offsets by the legacy log reader
+SKIPPED_NAMES = {"stdout.log"}
+MIN_SIZE = 4096
+# Compressed files must be at most this fraction of the original to be kept
+MAX_RATIO = 0.9
+
+_MAGIC = {b"\x28\xb5\x2f\xfd": "zstd", b"\x1f\x8b": "gzip"}
+
+
+def is_compressible(name: str, size: int) -> bool:
+    """Whether a result file is worth compressing."""
+    path = PurePosixPath(name)
+    return (
+        size >= MIN_SIZE
+        and path.suffix.lower() in COMPRESSIBLE_SUFFIXES
+        and path.name not in SKIPPED_NAMES
+        and not SKIPPED_DIRS.intersection(path.parts[:-1])
+    )
+
+
+def stored_encoding(path: str | Path) -> str | None:
+    """Encoding of a result file on disk, from its magic number if it is a compressible file."""
+    if Path(path).suffix.lower() not in COMPRESSIBLE_SUFFIXES:
+        return None
+    with open(path, "rb") as f:
+        head = f.read(4)
+    for magic, encoding in _MAGIC.items():
+        if head.startswith(magic):
+            return encoding
+    return None
+
+
+def open_stored(path: str | Path) -> BinaryIO:
+    """Open a result file for reading its content, decompressing it if it is stored compressed."""
+    encoding = stored_encoding(path)
+    if encoding == "gzip":
+        return gzip.open(path, "rb")  # type: ignore[return-value]
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"{path} is compressed with zstd, install zstandard to read it")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)  # type: ignore[return-value]
+    return open(path, "rb")
+
+
+def compress_file(path: Path) -> os.stat_result | None:
+    """
+    Compress a file in place with `ENCODING`.
+
+    Returns:
+    - os.stat_result | None: The stat of the compressed file, None if it did not compress enough and was kept.
+    """
+    original = path.stat()
+    tmp_path = path.with_name(f".{path.name}.{ENCODING}.tmp")
+    with path.open("rb") as src, tmp_path.open("wb") as raw:
+        if zstandard is not None:
+            zstandard.ZstdCompressor(level=10).copy_stream(src, raw, size=original.st_size, read_size=CHUNK_SIZE)
+        else:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as dest:
+                while chunk := src.read(CHUNK_SIZE):
+                    dest.write(chunk)
+    if tmp_path.stat().st_size > original.st_size * MAX_RATIO:
+        tmp_path.unlink()
+        return None
+    os.replace(tmp_path, path)
+    return path.stat()
+
+
+async def compress_result(result: Result, min_age: float = 0) -> int:
+    """
+    Compress the eligible files of a result and record it in its manifest.
+
+    Files that do not compress enough keep their stored size in the manifest,
+    so they are not tried again until they change.
+
+    Parameters:
+    - result (Result): The result, with its job.
+    - min_age (float, optional): Seconds since a file was last written before it is compressed.
+
+    Returns:
+    - int: Bytes saved.
+    """
+    result_dir = result_dir_of(result)
+    horizon = time.time() - min_age
+    # Later runs load the trained model with the files around it, by path
+    model_dir = PurePosixPath(result.pretrained_model).parent if result.pretrained_model else None
+    saved = 0
+    for entry in await ResultFile.objects.filter(result=result.id, stored_size__isnull=True).all():
+        if not is_compressible(entry.name, entry.size) or entry.mtime > horizon:
+            continue
+        if model_dir is not None and PurePosixPath(entry.name).parent == model_dir:
+            continue
+        path = result_dir / entry.name
+        try:
+            stat = path.stat()
+            if stat.st_size != entry.size or stat.st_mtime != entry.mtime:
+                # Changed since it was indexed, the next indexing will pick it up
+                continue
+            compressed = await asyncio.to_thread(compress_file, path)
+        except FileNotFoundError:
+            continue
+        if compressed is None:
+            await entry.update(stored_size=entry.size)
+            continue
+        await entry.update(encoding=ENCODING, stored_size=compressed.st_size, mtime=compressed.st_mtime)
+        saved += entry.size - compressed.st_size
+    return saved
+
+
+async def compress_finished_results(min_age: float, batch: int = 50) -> int:
+    """
+    Compress the files of finished results that were not tried yet, a batch of results at a time.
+
+    Parameters:
+    - min_age (float): Seconds since a file was last written before it is compressed.
+    - batch (int, optional): Results handled in one call. Defaults to 50.
+
+    Returns:
+    - int: Bytes saved.
+    """
+    files = ResultFile.Meta.table
+    results = Result.Meta.table
+    name = sa.func.lower(files.c.name)
+    query = (
+        sa.select(files.c.result)
+        .distinct()
+        .select_from(files.join(results, results.c.id == files.c.result))
+        .where(
+            results.c.status.in_(["done", "error", "stopped"]),
+            files.c.stored_size.is_(None),
+            files.c.size >= MIN_SIZE,
+            files.c.mtime <= time.time() - min_age,
+            sa.or_(*(name.like(f"%{suffix}") for suffix in sorted(COMPRESSIBLE_SUFFIXES))),
+            *(~files.c.name.like(f"{directory}/%") for directory in sorted(SKIPPED_DIRS)),
+            *((files.c.name != skipped) & ~files.c.name.like(f"%/{skipped}") for skipped in sorted(SKIPPED_NAMES)),
+        )
+        .limit(batch)
+    )
+    result_ids = [uuid.UUID(str(row[0])) for row in await database.fetch_all(query)]
+    saved = 0
+    for result in await Result.objects.select_related("job").filter(id__in=result_ids).all():
+        saved += await compress_result(result, min_age=min_age)
+    return saved
+
+
+async def run_forever(interval: float, min_age: float) -> None:
+    """Compress finished results in the background until cancelled."""
+    while True:
+        try:
+            await compress_finished_results(min_age)
+        except Exception as e:
+            print(f"Compression of finished results failed: {e}")
+        await asyncio.sleep(interval)
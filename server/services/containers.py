@@ -0,0 +1,120 @@
+"""Long-lived cog containers that are driven through cog's HTTP API."""
+import asyncio
+import json
+import subprocess
+import time
+import urllib.error
+import urllib.request
+import uuid
+from typing import Any
+
+from server.settings import settings
+
+COG_HTTP_PORT = 5000
+
+
+class ContainerError(Exception):
+    """Raised when a cog container cannot be started or does not answer."""
+
+
+def _http_json(method: str, url: str, payload: Any | None = None, timeout: float = 30) -> Any:
+    """Send a blocking JSON request and decode the JSON answer."""
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(
+        url,
+        data=data,
+        method=method,
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:  # noqa: S310
+        return json.loads(response.read() or b"null")
+
+
+def _docker(command: str) -> "subprocess.CompletedProcess[bytes]":
+    """Run a docker command, capturing its output without raising on failure."""
+    return subprocess.run(command, shell=True, capture_output=True, executable="/bin/bash", check=False)
+
+
+class CogContainer:
+    """
+    A cog image started in the background with its HTTP server listening.
+
+    Cog images run `python -m cog.server.http` by default, which loads the
+    model once in `setup()` and then serves `/predictions` and `/trainings`.
+    Keeping such a container around lets later runs skip the start-up and
+    weight loading that `cog train` pays on every invocation.
+    """
+
+    def __init__(self, image: str, base_dir: str) -> None:
+        self.image = image
+        self.base_dir = base_dir
+        self.name = f"mlab-{image}-{uuid.uuid4().hex[:8]}"
+        self.url = ""
+        self.started = 0.0
+        self.last_used = 0.0
+
+    async def start(self, ready_timeout: float = 300) -> None:
+        """
+        Start the container and wait until cog reports it is ready.
+
+        Parameters:
+        - ready_timeout (float, optional): Seconds to wait for `setup()` to finish. Defaults to 300.
+
+        Raises:
+        - ContainerError: If docker fails to start the container or it never becomes ready.
+        """
+        run_script = (
+            f"docker run -d --name {self.name} --publish 127.0.0.1::{COG_HTTP_PORT}"
+            f" --mount type=bind,source={self.base_dir},target={settings.cog_base_dir}"
+            f" {self.image}"
+        )
+        process = await asyncio.to_thread(_docker, run_script)
+        if process.returncode != 0:
+            raise ContainerError(process.stderr.decode("utf-8"))
+        port = await asyncio.to_thread(_docker, f"docker port {self.name} {COG_HTTP_PORT}")
+        address = port.stdout.decode("utf-8").strip().split("\n")[0]
+        if not address:
+            await self.stop()
+            raise ContainerError(f"Container {self.name} did not publish port {COG_HTTP_PORT}")
+        self.url = f"http://{address}"
+        self.started = time.monotonic()
+        self.last_used = self.started
+        await self.wait_ready(ready_timeout)
+
+    async def wait_ready(self, timeout: float) -> None:
+        """Wait for cog's health check to report READY."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                health = await asyncio.to_thread(_http_json, "GET", f"{self.url}/health-check", None, 5)
+                if health.get("status") == "READY":
+                    return
+                if health.get("status") == "SETUP_FAILED":
+                    break
+            except (urllib.error.URLError, ConnectionError, ValueError):
+                pass
+            await asyncio.sleep(1)
+        await self.stop()
+        raise ContainerError(f"Container {self.name} did not become ready")
+
+    async def request(self, path: str, inputs: dict[str, Any], timeout: float) -> dict[str, Any]:
+        """
+        Run a prediction or training on the container and wait for its answer.
+
+        Parameters:
+        - path (str): Either `/predictions` or `/trainings`.
+        - inputs (dict[str, Any]): The cog inputs, the same ones passed with `-i` on the CLI.
+        - timeout (float): Seconds to wait for the run to finish.
+
+        Returns:
+        - dict[str, Any]: cog's response with `status`, `output`, `logs` and `error`.
+        """
+        self.last_used = time.monotonic()
+        try:
+            return await asyncio.to_thread(_http_json, "POST", f"{self.url}{path}", {"input": inputs}, timeout)
+        finally:
+            self.last_used = time.monotonic()
+
+    async def stop(self) -> None:
+        """Stop and remove the container."""
+        await asyncio.to_thread(_docker, f"docker rm -f {self.name}")
@@ -0,0 +1,85 @@
+"""
+Idempotency keys of result submissions.
+
+A run sends an `Idempotency-Key` header with each submission attempt, along
+with the result it is for, and reuses both when it retries after a timeout.
+The first request with a key claims it and records the outcome once the
+result is stored; repeats of a finished submission are answered without
+reading their body, repeats of one still being processed are refused so it
+is not written twice, and a key reused for another result is refused.
+"""
+import datetime
+import uuid
+from typing import Literal
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from server.db.config import database
+from server.db.models.submit_requests import SubmitRequest
+from server.settings import settings
+
+MAX_KEY_LENGTH = 200
+
+
+async def claim_submit(owner_id: str, key: str, result_id: uuid.UUID) -> Literal["claimed", "pending", "done", "conflict"]:
+    """
+    Claim an idempotency key for a submission to a result.
+
+    A key left pending for `submit_pending_timeout` seconds, by a request
+    that died with the server, can be claimed again.
+
+    Returns:
+    - str: `claimed` if the submission is to be processed, `pending` if
+      another request is processing it, `done` if it already was,
+      `conflict` if the key was used for another result.
+    """
+    table = SubmitRequest.Meta.table
+    now = datetime.datetime.now()
+    # Keys are kept long enough to cover the retries of a run
+    await database.execute(table.delete().where(table.c.created < now - datetime.timedelta(seconds=settings.submit_idempotency_ttl)))
+    inserted = await database.fetch_one(
+        postgresql.insert(table)
+        .values(owner_id=owner_id, key=key, status="pending", result_id=result_id, created=now)
+        .on_conflict_do_nothing(index_elements=[table.c.owner_id, table.c.key])
+        .returning(table.c.id)
+    )
+    if inserted is not None:
+        return "claimed"
+    taken_over = await database.fetch_one(
+        table.update()
+        .where(
+            table.c.owner_id == owner_id,
+            table.c.key == key,
+            table.c.result_id == result_id,
+            table.c.status == "pending",
+            table.c.created < now - datetime.timedelta(seconds=settings.submit_pending_timeout),
+        )
+        .values(created=now)
+        .returning(table.c.id)
+    )
+    if taken_over is not None:
+        return "claimed"
+    row = await database.fetch_one(
+        sa.select(table.c.status, table.c.result_id).where(table.c.owner_id == owner_id, table.c.key == key)
+    )
+    if row is None:
+        # Expired between the two queries
+        return await claim_submit(owner_id, key, result_id)
+    if row[1] is None or uuid.UUID(str(row[1])) != result_id:
+        return "conflict"
+    return "done" if row[0] == "done" else "pending"
+
+
+async def complete_submit(owner_id: str, key: str, result_status: str) -> None:
+    """Record the outcome of a claimed submission."""
+    await SubmitRequest.objects.filter(owner_id=owner_id, key=key).update(
+        status="done",
+        result_status=result_status,
+        completed=datetime.datetime.now(),
+    )
+
+
+async def release_submit(owner_id: str, key: str) -> None:
+    """Give up a claimed key after a failed submission, so a retry processes it."""
+    await SubmitRequest.objects.filter(owner_id=owner_id, key=key, status="pending").delete()
@@ -0,0 +1,462 @@
+"""
+Run logs: written once in rotated segments, fanned out to every subscriber.
+
+The logs of a result live in its `logs` directory as numbered segments
+(`000000.log`, `000001.log.gz`, ...) that together hold the output of the run.
+Offsets are byte offsets in that concatenation. A segment is closed once it
+reaches `log_segment_size`, and closed segments are compressed. `index.json`
+records, for each closed segment, its offset, first line, size, line count
+and a checkpoint every `INDEX_INTERVAL` lines, so a line is found by reading
+at most that many lines, and the last lines by reading back from the end.
+Results from before segmented logs have a single `stdout.log`, read as one
+uncompressed segment.
+"""
+import asyncio
+import bisect
+import ctypes
+import gzip
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Any, AsyncIterator, BinaryIO, Generator, Iterator
+
+from server.settings import settings
+
+READ_SIZE = 64 * 1024
+# Lines between two checkpoints of the index
+INDEX_INTERVAL = 1000
+# Chunks a subscriber may fall behind before it catches up from the segments instead
+SUBSCRIBER_QUEUE_SIZE = 256
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_DELETE_SELF = 0x400
+
+_LAGGED = object()
+
+
+def compress_segment(path: Path) -> None:
+    """Replace a closed segment with its gzip, readers holding it open keep reading the original."""
+    tmp_path = path.with_suffix(".log.gz.tmp")
+    with path.open("rb") as src, gzip.open(tmp_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, READ_SIZE)
+    os.replace(tmp_path, path.with_suffix(".log.gz"))
+    path.unlink()
+
+
+class LogStream:
+    """
+    The logs of a run being written by this process.
+
+    Every chunk is appended to the active segment before it is handed to
+    the subscribers, so the segments always hold at least what was
+    broadcast, and a subscriber can read what it missed from them.
+    """
+
+    def __init__(self, logs_dir: Path, segment_size: int) -> None:
+        self.dir = logs_dir
+        self.segment_size = segment_size
+        shutil.rmtree(logs_dir, ignore_errors=True)
+        logs_dir.mkdir(parents=True)
+        self.size = 0
+        self.lines = 0
+        self.closed = False
+        self.segments: list[dict[str, Any]] = []
+        self._subscribers: set["asyncio.Queue[object]"] = set()
+        self._open_segment()
+
+    def _open_segment(self) -> None:
+        name = f"{len(self.segments):06d}"
+        self._file = (self.dir / f"{name}.log").open("wb", buffering=0)
+        self._active: dict[str, Any] = {"name": name, "offset": self.size, "line": self.lines, "checkpoints": []}
+        self._write_index()
+
+    def _write_index(self) -> None:
+        index = {"closed": self.closed, "segments": self.segments, "active": None if self.closed else self._active}
+        tmp_path = self.dir / "index.json.tmp"
+        tmp_path.write_text(json.dumps(index))
+        os.replace(tmp_path, self.dir / "index.json")
+
+    def _checkpoint(self, data: bytes, offset: int) -> None:
+        """Record where every `INDEX_INTERVAL`-th line of `data` starts."""
+        line = self.lines
+        count = data.count(b"\n")
+        target = (line // INDEX_INTERVAL + 1) * INDEX_INTERVAL
+        position = 0
+        while target <= self.lines + count:
+            while line < target:
+                position = data.index(b"\n", position) + 1
+                line += 1
+            self._active["checkpoints"].append([target, offset + position])
+            target += INDEX_INTERVAL
+        self.lines += count
+
+    def _close_segment(self) -> Path:
+        self._file.close()
+        self._active["size"] = self.size - self._active["offset"]
+        self._active["lines"] = self.lines - self._active["line"]
+        self.segments.append(self._active)
+        return self.dir / f"{self._active['name']}.log"
+
+    def publish(self, data: bytes) -> None:
+        """Append data to the logs and send it to the subscribers."""
+        if not data:
+            return
+        self._file.write(data)
+        start = self.size
+        self._checkpoint(data, start)
+        self.size += len(data)
+        if self.size - self._active["offset"] >= self.segment_size:
+            closed_path = self._close_segment()
+            self._open_segment()
+            asyncio.get_running_loop().run_in_executor(None, compress_segment, closed_path)
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait((start, data))
+            except asyncio.QueueFull:
+                # Drop what is queued, the subscriber reads it back from the segments
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_LAGGED)
+
+    def subscribe(self) -> "asyncio.Queue[object]":
+        queue: "asyncio.Queue[object]" = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: "asyncio.Queue[object]") -> None:
+        self._subscribers.discard(queue)
+
+    def close(self) -> None:
+        """Close the last segment, kept uncompressed for tails, and end every subscription."""
+        self._close_segment()
+        self.closed = True
+        self._write_index()
+        for queue in self._subscribers:
+            while queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+class LogBroadcaster:
+    """Log streams of the runs of this process, by logs directory."""
+
+    def __init__(self) -> None:
+        self._streams: dict[Path, LogStream] = {}
+
+    def open(self, logs_dir: Path) -> LogStream:
+        """Start new logs in `logs_dir`, removing what it held."""
+        logs_dir = logs_dir.resolve()
+        stream = LogStream(logs_dir, segment_size=settings.log_segment_size)
+        self._streams[logs_dir] = stream
+        return stream
+
+    def close(self, stream: LogStream) -> None:
+        stream.close()
+        if self._streams.get(stream.dir) is stream:
+            del self._streams[stream.dir]
+
+    def get(self, logs_dir: Path) -> LogStream | None:
+        return self._streams.get(logs_dir.resolve())
+
+
+class LogReader:
+    """Random access to the logs of a result, from any process."""
+
+    def __init__(self, logs_dir: Path) -> None:
+        self.dir = logs_dir
+        self.closed = True
+        self.segments: list[dict[str, Any]] = []
+        try:
+            index = json.loads((logs_dir / "index.json").read_text())
+        except (OSError, ValueError):
+            legacy_path = logs_dir.parent / "stdout.log"
+            if legacy_path.exists():
+                self.segments = [{"path": legacy_path, "offset": 0, "line": 0, "checkpoints": []}]
+            return
+        self.closed = index["closed"]
+        self.segments = list(index["segments"])
+        if index["active"] is not None:
+            self.segments.append(index["active"])
+        for segment in self.segments:
+            plain_path = logs_dir / f"{segment['name']}.log"
+            segment["path"] = plain_path if plain_path.exists() else plain_path.with_suffix(".log.gz")
+
+    def _open(self, segment: dict[str, Any]) -> BinaryIO:
+        path = segment["path"]
+        if path.suffix == ".log":
+            try:
+                return path.open("rb")
+            except FileNotFoundError:
+                # Compressed since the index was read
+                path = path.with_suffix(".log.gz")
+        return gzip.open(path, "rb")  # type: ignore[return-value]
+
+    def _segment_size(self, segment: dict[str, Any]) -> int:
+        if "size" in segment:
+            return segment["size"]
+        try:
+            return segment["path"].stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def size(self) -> int:
+        """Bytes written so far."""
+        if not self.segments:
+            return 0
+        last = self.segments[-1]
+        return last["offset"] + self._segment_size(last)
+
+    def iter_bytes(self, start: int, end: int | None = None) -> Generator[tuple[int, bytes], None, None]:
+        """Yield `(offset, data)` chunks from `start` up to `end`, or the current end."""
+        for segment in self.segments:
+            segment_end = segment["offset"] + self._segment_size(segment)
+            if segment_end <= start:
+                continue
+            with self._open(segment) as f:
+                position = max(start, segment["offset"])
+                f.seek(position - segment["offset"])
+                while end is None or position < end:
+                    data = f.read(READ_SIZE if end is None else min(READ_SIZE, end - position))
+                    if not data:
+                        break
+                    yield position, data
+                    position += len(data)
+            start = position
+            if end is not None and position >= end:
+                return
+
+    def read_range(self, start: int, end: int | None = None) -> bytes:
+        """Read the logs from `start` up to `end`, or the current end."""
+        return b"".join(data for _, data in self.iter_bytes(start, end))
+
+    def _checkpoints(self) -> list[list[int]]:
+        """`[line, offset]` of the start of each segment and of each checkpoint, in order."""
+        checkpoints = [[segment["line"], segment["offset"]] for segment in self.segments]
+        checkpoints += [checkpoint for segment in self.segments for checkpoint in segment["checkpoints"]]
+        checkpoints.sort()
+        return checkpoints
+
+    def line_offset(self, line: int) -> int:
+        """Byte offset where a line starts, found from the nearest checkpoint."""
+        checkpoints = self._checkpoints()
+        if not checkpoints:
+            return 0
+        index = bisect.bisect_right(checkpoints, line, key=lambda checkpoint: checkpoint[0]) - 1
+        known_line, offset = checkpoints[max(index, 0)]
+        for position, data in self.iter_bytes(offset):
+            start = 0
+            while known_line < line:
+                newline = data.find(b"\n", start)
+                if newline < 0:
+                    break
+                start = newline + 1
+                known_line += 1
+            if known_line == line:
+                return position + start
+        return self.size
+
+    def iter_lines(self, line: int = 0) -> Iterator[tuple[int, bytes]]:
+        """Yield `(line number, line)` from a line number, lines without their newline."""
+        pending = b""
+        for _, data in self.iter_bytes(self.line_offset(line)):
+            pending += data
+            *complete, pending = pending.split(b"\n")
+            for text in complete:
+                yield line, text
+                line += 1
+        if pending:
+            yield line, pending
+
+    def page(self, start: int, limit: int) -> list[tuple[int, str]]:
+        """Up to `limit` lines from line `start`."""
+        lines: list[tuple[int, str]] = []
+        for number, text in self.iter_lines(start):
+            if len(lines) >= limit:
+                break
+            lines.append((number, text.decode("utf-8", errors="replace")))
+        return lines
+
+    def tail(self, count: int) -> list[tuple[int, str]]:
+        """The last `count` lines, read back from the end."""
+        end = self.size
+        position = end
+        data = b""
+        while position > 0 and data.count(b"\n") <= count:
+            start = max(0, position - READ_SIZE)
+            data = self.read_range(start, position) + data
+            position = start
+        # Lines ended before `end`, from the last checkpoint and the bytes after it
+        checkpoints = self._checkpoints()
+        checkpoint_line, checkpoint_offset = checkpoints[-1] if checkpoints else [0, 0]
+        ended = checkpoint_line + data[max(checkpoint_offset - position, 0):].count(b"\n")
+        if checkpoint_offset < position:
+            ended += self.read_range(checkpoint_offset, position).count(b"\n")
+        last = ended - 1 if not data or data.endswith(b"\n") else ended
+        lines = data.split(b"\n")
+        if lines and lines[-1] == b"":
+            lines.pop()
+        if position > 0:
+            # The first line read is only the end of a line
+            lines = lines[1:]
+        lines = lines[-count:] if count else []
+        first = last - len(lines) + 1
+        return [(first + i, text.decode("utf-8", errors="replace")) for i, text in enumerate(lines)]
+
+    def search(self, pattern: str, regex: bool, limit: int, start: int = 0) -> list[tuple[int, str]]:
+        """Lines from line `start` matching a substring or a regular expression, up to `limit`."""
+        matcher = re.compile(pattern.encode("utf-8")) if regex else None
+        needle = pattern.encode("utf-8")
+        matches = []
+        for number, text in self.iter_lines(start):
+            if (matcher.search(text) if matcher is not None else needle in text):
+                matches.append((number, text.decode("utf-8", errors="replace")))
+                if len(matches) >= limit:
+                    break
+        return matches
+
+
+def _next_chunk(chunks: Generator[tuple[int, bytes], None, None]) -> tuple[int, bytes] | None:
+    return next(chunks, None)
+
+
+async def _catch_up(logs_dir: Path, position: int, end: int | None) -> AsyncIterator[tuple[int, bytes]]:
+    reader = await asyncio.to_thread(LogReader, logs_dir)
+    # One pass over the segments, a compressed one is not decompressed again from its start for each chunk
+    chunks = reader.iter_bytes(position, end)
+    try:
+        while (chunk := await asyncio.to_thread(_next_chunk, chunks)) is not None:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+async def follow_stream(stream: LogStream, offset: int) -> AsyncIterator[tuple[int, bytes]]:
+    """Yield the logs from `offset`, then chunks as they are published, until the stream closes."""
+    queue = stream.subscribe()
+    position = offset
+    try:
+        async for start, data in _catch_up(stream.dir, position, stream.size):
+            position = start + len(data)
+            yield start, data
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if item is _LAGGED:
+                async for start, data in _catch_up(stream.dir, position, stream.size):
+                    position = start + len(data)
+                    yield start, data
+                continue
+            start, data = item  # type: ignore[misc]
+            if start + len(data) <= position:
+                continue
+            if start < position:
+                data, start = data[position - start:], position
+            position = start + len(data)
+            yield start, data
+        async for start, data in _catch_up(stream.dir, position, None):
+            position = start + len(data)
+            yield start, data
+    finally:
+        stream.unsubscribe(queue)
+
+
+def _inotify_watch(path: Path) -> int | None:
+    """An inotify descriptor watching the files of a directory, None where inotify is not available."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF
+    if libc.inotify_add_watch(fd, str(path).encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+async def follow_dir(logs_dir: Path, offset: int, timeout: float = 30) -> AsyncIterator[tuple[int, bytes]]:
+    """
+    Yield logs written by another process, following them with inotify.
+
+    Reading stops once the index says the logs are closed, or at their
+    current end where inotify is not available. `timeout` bounds the wait
+    for an event, after which the logs are read again in case one was missed.
+    """
+    position = offset
+    fd = _inotify_watch(logs_dir) if logs_dir.is_dir() else None
+    if fd is None:
+        async for start, data in _catch_up(logs_dir, position, None):
+            yield start, data
+        return
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    loop.add_reader(fd, changed.set)
+    try:
+        while True:
+            closed = (await asyncio.to_thread(LogReader, logs_dir)).closed
+            async for start, data in _catch_up(logs_dir, position, None):
+                position = start + len(data)
+                yield start, data
+            if closed:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            changed.clear()
+            try:
+                while os.read(fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+async def follow_log(logs_dir: Path, offset: int = 0, live: bool = True) -> AsyncIterator[tuple[int, bytes]]:
+    """
+    Yield `(offset, data)` chunks of the logs of a run from a byte offset.
+
+    Parameters:
+    - logs_dir (Path): The logs directory of the result.
+    - offset (int, optional): Where to resume from. Defaults to 0.
+    - live (bool, optional): Whether the run is still going, so the logs are followed. Defaults to True.
+    """
+    stream = log_broadcaster.get(logs_dir)
+    if stream is not None:
+        async for item in follow_stream(stream, offset):
+            yield item
+    elif live:
+        async for item in follow_dir(logs_dir, offset):
+            yield item
+    else:
+        async for item in _catch_up(logs_dir, offset, None):
+            yield item
+
+
+async def pump_process_output(process: asyncio.subprocess.Process, stream: LogStream) -> None:
+    """Publish the output of a process as it comes, cut at line ends where possible."""
+    assert process.stdout is not None
+    pending = b""
+    while chunk := await process.stdout.read(READ_SIZE):
+        pending += chunk
+        # Progress bars redraw with carriage returns, so they count as line ends
+        cut = max(pending.rfind(b"\n"), pending.rfind(b"\r")) + 1
+        if cut == 0 and len(pending) < READ_SIZE:
+            continue
+        cut = cut or len(pending)
+        stream.publish(pending[:cut])
+        pending = pending[cut:]
+    stream.publish(pending)
+
+
+log_broadcaster = LogBroadcaster()
@@ -0,0 +1,95 @@
+"""Manifest of the files of each result, kept in the result_files table."""
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from typing import Any
+
+from server.db.models.result_files import ResultFile
+from server.db.models.results import Result
+from server.web.api.utils import get_files_in_path, job_get_dirs
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def result_dir_of(result: Result) -> Path:
+    """Directory holding the files of a result."""
+    job_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
+    return Path(f"{job_base_dir}/{str(result.id)}")
+
+
+def hash_file(path: Path) -> str:
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_result_dir(
+    result_dir: Path,
+    known: dict[str, ResultFile],
+    hashes: dict[str, str],
+) -> tuple[list[dict[str, Any]], list[str]]:
+    """
+    Find files added or changed since they were indexed, and files removed.
+
+    Files whose size and mtime match their manifest entry are not read
+    again, comparing the stored size of files kept compressed. Hashes already computed by the caller, while writing the file,
+    are used instead of reading it back.
+
+    Returns:
+    - tuple[list[dict[str, Any]], list[str]]: New or changed entries, and names no longer on disk.
+    """
+    changed = []
+    names = get_files_in_path(result_dir)
+    for name in names:
+        path = result_dir / name
+        stat = path.stat()
+        entry = known.get(name)
+        if entry is not None and entry.mtime == stat.st_mtime and stat.st_size == (
+            entry.stored_size if entry.encoding else entry.size
+        ):
+            continue
+        changed.append({
+            "name": name,
+            "size": stat.st_size,
+            "sha256": hashes.get(name) or hash_file(path),
+            "mtime": stat.st_mtime,
+            "encoding": None,
+            "stored_size": None,
+        })
+    on_disk = set(names)
+    removed = [name for name in known if name not in on_disk]
+    return changed, removed
+
+
+async def index_result_files(result: Result, hashes: dict[str, str] | None = None) -> list[ResultFile]:
+    """
+    Bring the manifest of a result up to date with its directory.
+
+    Parameters:
+    - result (Result): The result whose directory is indexed.
+    - hashes (dict[str, str] | None, optional): SHA-256 of files already known, by name.
+
+    Returns:
+    - list[ResultFile]: The manifest of the result.
+    """
+    known = {entry.name: entry for entry in await ResultFile.objects.filter(result=result.id).all()}
+    result_dir = result_dir_of(result)
+    if not os.path.isdir(result_dir):
+        return list(known.values())
+    changed, removed = await asyncio.to_thread(scan_result_dir, result_dir, known, hashes or {})
+    created = []
+    for entry in changed:
+        existing = known.get(entry["name"])
+        if existing is None:
+            created.append(ResultFile(result=result.id, **entry))
+            continue
+        await existing.update(**entry)
+    if created:
+        await ResultFile.objects.bulk_create(created)
+    if removed:
+        await ResultFile.objects.filter(result=result.id, name__in=removed).delete()
+    return await ResultFile.objects.filter(result=result.id).order_by("name").all()
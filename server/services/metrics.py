@@ -0,0 +1,308 @@
+"""Metric points reported while runs go, written in batches, read back downsampled and compared across results."""
+import asyncio
+import datetime
+import math
+import uuid
+from collections import OrderedDict
+from typing import Any, NamedTuple
+
+import sqlalchemy as sa
+
+from server.db.config import database
+from server.db.models.metric_points import MetricPoint
+from server.db.models.results import Result
+from server.settings import settings
+
+# Rows per INSERT statement, well under the bind parameter limit of Postgres
+INSERT_BATCH = 5000
+# Results whose owner was checked, so reporting does not read the results table every time
+KNOWN_RESULTS = 10000
+
+
+class BufferFullError(Exception):
+    """Raised when more points are waiting than the writer accepts, so callers can back off."""
+
+
+class Point(NamedTuple):
+    """A metric value at a step"""
+
+    name: str
+    step: int
+    value: float
+
+
+class MetricsWriter:
+    """
+    Buffer reported points and insert them in batches.
+
+    Reporting only appends to an in-memory buffer. A single task inserts
+    the buffer with multi-row INSERT statements every `flush_interval`
+    seconds, or as soon as `flush_size` points are waiting, so the cost of a
+    round trip is shared by thousands of points from every run.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float, max_buffer: int) -> None:
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer: list[dict[str, Any]] = []
+        self._wakeup = asyncio.Event()
+        self._known: OrderedDict[tuple[uuid.UUID, str], None] = OrderedDict()
+
+    async def check_owner(self, result_id: uuid.UUID, owner_id: str) -> None:
+        """Make sure the result exists and belongs to the user, remembering results already checked."""
+        key = (result_id, owner_id)
+        if key in self._known:
+            self._known.move_to_end(key)
+            return
+        await Result.objects.get(id=result_id, owner_id=owner_id)
+        self._known[key] = None
+        if len(self._known) > KNOWN_RESULTS:
+            self._known.popitem(last=False)
+
+    def add(self, result_id: uuid.UUID, points: list[Point]) -> None:
+        """
+        Queue points of a result for the next insert.
+
+        Raises:
+        - BufferFullError: If the buffer cannot take the points.
+        """
+        if len(self._buffer) + len(points) > self.max_buffer:
+            raise BufferFullError(f"{len(self._buffer)} metric points are waiting to be written")
+        now = datetime.datetime.now()
+        self._buffer.extend(
+            {"result": result_id, "name": point.name, "step": point.step, "value": point.value, "created": now}
+            for point in points
+        )
+        if len(self._buffer) >= self.flush_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """Insert every waiting point."""
+        rows, self._buffer = self._buffer, []
+        table = MetricPoint.Meta.table
+        for start in range(0, len(rows), INSERT_BATCH):
+            batch = rows[start:start + INSERT_BATCH]
+            try:
+                await database.execute(table.insert().values(batch))
+            except Exception:
+                # A result deleted in the meantime fails the batch, the points of the others are written one result at a time
+                await self._insert_by_result(batch)
+
+    async def _insert_by_result(self, rows: list[dict[str, Any]]) -> None:
+        """Insert the points of each result on their own, dropping those of results that cannot take them."""
+        table = MetricPoint.Meta.table
+        by_result: dict[uuid.UUID, list[dict[str, Any]]] = {}
+        for row in rows:
+            by_result.setdefault(row["result"], []).append(row)
+        for result_id, result_rows in by_result.items():
+            try:
+                await database.execute(table.insert().values(result_rows))
+            except Exception as e:
+                print(f"Could not write {len(result_rows)} metric points of result {result_id}: {e}")
+                for key in [key for key in self._known if key[0] == result_id]:
+                    del self._known[key]
+
+    async def run_forever(self) -> None:
+        """Flush the buffer until cancelled."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+async def metric_series(
+    result_id: uuid.UUID,
+    names: list[str],
+    points: int,
+    start: int | None = None,
+    end: int | None = None,
+) -> dict[str, list[dict[str, Any]]]:
+    """
+    Curves of the metrics of a result, with at most `points` points each.
+
+    Steps are grouped in equal buckets in SQL, and each bucket gives its last
+    step with the mean, min and max of the values in it.
+
+    Parameters:
+    - result_id (uuid.UUID): The result.
+    - names (list[str]): Metrics to return, all of them when empty.
+    - points (int): Maximum points per metric.
+    - start (int | None, optional): First step. Defaults to the first reported.
+    - end (int | None, optional): Last step. Defaults to the last reported.
+
+    Returns:
+    - dict[str, list[dict[str, Any]]]: Points of each metric, by step.
+    """
+    table = MetricPoint.Meta.table
+    conditions = [table.c.result == result_id]
+    if names:
+        conditions.append(table.c.name.in_(names))
+    if start is not None:
+        conditions.append(table.c.step >= start)
+    if end is not None:
+        conditions.append(table.c.step <= end)
+    bounds = await database.fetch_one(sa.select(sa.func.min(table.c.step), sa.func.max(table.c.step)).where(*conditions))
+    if bounds is None or bounds[0] is None:
+        return {}
+    low, high = bounds[0], bounds[1]
+    width = max(1, math.ceil((high - low + 1) / max(points, 1)))
+    bucket = sa.func.floor((table.c.step - low) / float(width)).label("bucket")
+    query = (
+        sa.select(
+            table.c.name,
+            bucket,
+            sa.func.max(table.c.step).label("step"),
+            sa.func.avg(table.c.value).label("value"),
+            sa.func.min(table.c.value).label("min"),
+            sa.func.max(table.c.value).label("max"),
+        )
+        .where(*conditions)
+        .group_by(table.c.name, bucket)
+        .order_by(table.c.name, bucket)
+    )
+    series: dict[str, list[dict[str, Any]]] = {}
+    for row in await database.fetch_all(query):
+        series.setdefault(row["name"], []).append({
+            "step": row["step"],
+            "value": row["value"],
+            "min": row["min"],
+            "max": row["max"],
+        })
+    return series
+
+
+
+COMPARE_QUERY = """
+WITH selected AS (
+    SELECT r.id, r.name
+    FROM results r JOIN jobs j ON j.id = r.job
+    WHERE r.owner_id = :owner_id {filters}
+    ORDER BY r.modified DESC
+    {limit}
+),
+reported AS (
+    SELECT r.id, kv.key AS metric, (kv.value::text)::double precision AS value
+    FROM results r,
+        json_each(CASE WHEN json_typeof(r.metrics) = 'object' THEN r.metrics ELSE '{{}}'::json END) kv
+    WHERE r.id IN (SELECT id FROM selected) AND json_typeof(kv.value) = 'number' {metric_filter}
+),
+series AS (
+    SELECT DISTINCT ON (p.result, p.name) p.result AS id, p.name AS metric, p.value
+    FROM metric_points p
+    WHERE p.result IN (SELECT id FROM selected) {series_metric_filter}
+    ORDER BY p.result, p.name, p.step DESC
+),
+metric_values AS (
+    SELECT id, metric, value FROM reported
+    UNION ALL
+    SELECT s.id, s.metric, s.value FROM series s
+    WHERE NOT EXISTS (SELECT 1 FROM reported r WHERE r.id = s.id AND r.metric = s.metric)
+)
+SELECT
+    s.id, s.name, v.metric, v.value,
+    min(v.value) OVER per_metric AS min,
+    max(v.value) OVER per_metric AS max,
+    avg(v.value) OVER per_metric AS mean,
+    count(v.value) OVER per_metric AS count,
+    first_value(s.id) OVER (PARTITION BY v.metric ORDER BY v.value ASC NULLS LAST) AS best_min,
+    first_value(s.id) OVER (PARTITION BY v.metric ORDER BY v.value DESC NULLS LAST) AS best_max
+FROM selected s LEFT JOIN metric_values v ON v.id = s.id
+WINDOW per_metric AS (PARTITION BY v.metric)
+"""
+
+
+async def compare_results(
+    owner_id: str,
+    result_ids: list[uuid.UUID],
+    job_id: uuid.UUID | None = None,
+    model_id: uuid.UUID | None = None,
+    result_type: str | None = None,
+    metrics: list[str] | None = None,
+    limit: int = 500,
+) -> dict[str, Any]:
+    """
+    Align the metrics of results in a table and aggregate each metric, in one query.
+
+    A result's metrics are the numbers of its `metrics` JSON, completed by the
+    last reported point of metrics that are only in its time series.
+
+    Parameters:
+    - owner_id (str): The owner of the results.
+    - result_ids (list[uuid.UUID]): Results to compare, or any when empty.
+    - job_id (uuid.UUID | None, optional): Only results of this job.
+    - model_id (uuid.UUID | None, optional): Only results of jobs on this model.
+    - result_type (str | None, optional): Only train or test results.
+    - metrics (list[str] | None, optional): Metrics to compare, all of them when empty.
+    - limit (int, optional): Most recent results to compare when no result ids
+      are given, every given result is compared. Defaults to 500.
+
+    Returns:
+    - dict[str, Any]: The metric names, a row of metrics per result, and min, max,
+      mean, count and the results with the lowest and highest value of each metric.
+    """
+    filters = []
+    params: dict[str, Any] = {"owner_id": owner_id}
+    expanding = []
+    if result_ids:
+        filters.append("AND r.id IN :ids")
+        params["ids"] = [result_id.hex for result_id in result_ids]
+        expanding.append("ids")
+    else:
+        params["limit"] = limit
+    if job_id is not None:
+        filters.append("AND r.job = :job_id")
+        params["job_id"] = job_id.hex
+    if model_id is not None:
+        filters.append("AND j.model_id = :model_id")
+        params["model_id"] = model_id.hex
+    if result_type is not None:
+        filters.append("AND r.result_type = :result_type")
+        params["result_type"] = result_type
+    metric_filter = series_metric_filter = ""
+    if metrics:
+        metric_filter = "AND kv.key IN :metrics"
+        series_metric_filter = "AND p.name IN :metrics"
+        params["metrics"] = metrics
+        expanding.append("metrics")
+    query = sa.text(COMPARE_QUERY.format(
+        filters=" ".join(filters),
+        limit="" if result_ids else "LIMIT :limit",
+        metric_filter=metric_filter,
+        series_metric_filter=series_metric_filter,
+    )).bindparams(
+        *(sa.bindparam(name, value=params.pop(name), expanding=True) for name in expanding),
+        **params,
+    )
+    rows: dict[str, dict[str, Any]] = {}
+    aggregates: dict[str, dict[str, Any]] = {}
+    for row in await database.fetch_all(query):
+        result_id = str(uuid.UUID(row["id"]))
+        entry = rows.setdefault(result_id, {"id": result_id, "name": row["name"], "metrics": {}})
+        metric = row["metric"]
+        if metric is None:
+            continue
+        entry["metrics"][metric] = row["value"]
+        aggregates.setdefault(metric, {
+            "min": row["min"],
+            "max": row["max"],
+            "mean": row["mean"],
+            "count": row["count"],
+            "best_min": str(uuid.UUID(row["best_min"])),
+            "best_max": str(uuid.UUID(row["best_max"])),
+        })
+    return {
+        "metrics": sorted(aggregates),
+        "results": list(rows.values()),
+        "aggregates": aggregates,
+    }
+
+
+metrics_writer = MetricsWriter(
+    flush_size=settings.metrics_flush_size,
+    flush_interval=settings.metrics_flush_interval,
+    max_buffer=settings.metrics_max_buffer,
+)
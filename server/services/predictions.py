@@ -0,0 +1,332 @@
+"""
+Columnar storage of test predictions.
+
+Predictions are kept in the `predictions` directory of a result, one file per
+column. Numeric columns are `.npy` arrays, read at any row with a seek.
+Other columns are JSON lines, with a `.npy` array of the offset of each row,
+so any slice is read without going through the rows before it. `meta.json`
+lists the columns, and the result row only keeps a pointer and a summary.
+"""
+import array
+import ast
+import json
+import math
+import struct
+import sys
+from collections import Counter
+from pathlib import Path
+from typing import Any, Callable
+
+from fastapi import HTTPException
+
+PREDICTIONS_DIR = "predictions"
+# Rows read at once when scanning a column
+SCAN_ROWS = 65536
+# Most common values kept in the summary of a non-numeric column
+SUMMARY_TOP_VALUES = 10
+
+_ENDIAN = "<" if sys.byteorder == "little" else ">"
+# Column kinds stored as arrays: array typecode and numpy dtype
+_ARRAY_KINDS = {"f8": ("d", "f8"), "i8": ("q", "i8")}
+
+
+def _npy_header(descr: str, length: int) -> bytes:
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({length},), }}"
+    # Data starts on a 64 byte boundary, as numpy writes it
+    padding = 64 - (10 + len(header) + 1) % 64
+    header += " " * padding + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin-1")
+
+
+def write_npy(path: Path, typecode: str, dtype: str, values: list[Any]) -> None:
+    """Write a one dimensional array in the .npy format, readable by numpy."""
+    with path.open("wb") as f:
+        f.write(_npy_header(_ENDIAN + dtype, len(values)))
+        f.write(array.array(typecode, values).tobytes())
+
+
+class NpyColumn:
+    """Random access to a one dimensional .npy array."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with path.open("rb") as f:
+            prefix = f.read(10)
+            if prefix[:6] != b"\x93NUMPY":
+                raise ValueError(f"{path} is not a .npy file")
+            header_length = struct.unpack("<H", prefix[8:10])[0]
+            header = ast.literal_eval(f.read(header_length).decode("latin-1"))
+        descr = header["descr"]
+        self.typecode = {"f8": "d", "i8": "q", "u8": "Q"}[descr[1:]]
+        self.swap = descr[0] not in ("|", _ENDIAN)
+        self.length = header["shape"][0]
+        self.itemsize = 8
+        self.data_offset = 10 + header_length
+
+    def read(self, start: int, stop: int) -> list[Any]:
+        """Values of rows `start` to `stop`."""
+        start, stop = max(start, 0), min(stop, self.length)
+        if start >= stop:
+            return []
+        values = array.array(self.typecode)
+        with self.path.open("rb") as f:
+            f.seek(self.data_offset + start * self.itemsize)
+            values.frombytes(f.read((stop - start) * self.itemsize))
+        if self.swap:
+            values.byteswap()
+        return values.tolist()
+
+
+class JsonColumn:
+    """Random access to a column of JSON lines through its row offsets."""
+
+    def __init__(self, path: Path, offsets_path: Path) -> None:
+        self.path = path
+        self.offsets = NpyColumn(offsets_path)
+        self.length = self.offsets.length - 1
+
+    def read(self, start: int, stop: int) -> list[Any]:
+        """Values of rows `start` to `stop`."""
+        start, stop = max(start, 0), min(stop, self.length)
+        if start >= stop:
+            return []
+        offsets = self.offsets.read(start, stop + 1)
+        with self.path.open("rb") as f:
+            f.seek(offsets[0])
+            data = f.read(offsets[-1] - offsets[0])
+        return [json.loads(line) for line in data.splitlines()]
+
+
+def to_columns(predictions: Any) -> dict[str, list[Any]]:
+    """
+    Turn a predictions payload into named columns of the same length.
+
+    Rows given as a list of objects, columns given as an object of lists of
+    the same length, and a plain list of values (a single `prediction`
+    column) are understood. Any other object is kept as one row, and any
+    other value, like a string that is not JSON, as the one row of a
+    `prediction` column, so every payload stored before predictions were
+    tables is still stored.
+    """
+    if isinstance(predictions, str):
+        if not predictions.strip():
+            return {}
+        try:
+            parsed = json.loads(predictions)
+        except ValueError:
+            parsed = None
+        if not isinstance(parsed, (list, dict)):
+            return {"prediction": [predictions]}
+        predictions = parsed
+    if isinstance(predictions, dict):
+        if all(isinstance(values, list) for values in predictions.values()):
+            if len({len(values) for values in predictions.values()}) <= 1:
+                return {str(name): values for name, values in predictions.items()}
+        return {str(name): [value] for name, value in predictions.items()}
+    if isinstance(predictions, list) and predictions and all(isinstance(row, dict) for row in predictions):
+        names: dict[str, None] = {}
+        for row in predictions:
+            names.update(dict.fromkeys(row))
+        return {str(name): [row.get(name) for row in predictions] for name in names}
+    if isinstance(predictions, list):
+        return {"prediction": predictions} if predictions else {}
+    return {"prediction": [predictions]}
+
+
+def _column_kind(values: list[Any]) -> str:
+    if values and all(isinstance(v, int) and not isinstance(v, bool) and -2 ** 63 <= v < 2 ** 63 for v in values):
+        return "i8"
+    if values and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return "f8"
+    return "json"
+
+
+def _summarize(kind: str, values: list[Any]) -> dict[str, Any]:
+    if kind != "json":
+        finite = [v for v in values if math.isfinite(v)]
+        if not finite:
+            return {}
+        return {"min": min(finite), "max": max(finite), "mean": sum(finite) / len(finite)}
+    hashable = [
+        v for v in values
+        if isinstance(v, (str, int, bool)) or v is None or (isinstance(v, float) and math.isfinite(v))
+    ]
+    counts = Counter(hashable)
+    return {
+        "distinct": len(counts),
+        "top": [{"value": value, "count": count} for value, count in counts.most_common(SUMMARY_TOP_VALUES)],
+    }
+
+
+def store_predictions(result_dir: Path, predictions: Any) -> dict[str, Any]:
+    """
+    Write predictions as columns next to a result.
+
+    Parameters:
+    - result_dir (Path): The result directory.
+    - predictions (Any): The submitted predictions, JSON text or already parsed.
+
+    Returns:
+    - dict[str, Any]: The pointer and summary kept in `Result.predictions`.
+    """
+    columns = to_columns(predictions)
+    directory = result_dir / PREDICTIONS_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    rows = len(next(iter(columns.values()))) if columns else 0
+    meta_columns = []
+    summary = {}
+    for index, (name, values) in enumerate(columns.items()):
+        kind = _column_kind(values)
+        file_name = f"c{index}"
+        if kind in _ARRAY_KINDS:
+            typecode, dtype = _ARRAY_KINDS[kind]
+            write_npy(directory / f"{file_name}.npy", typecode, dtype, values)
+        else:
+            offsets = [0]
+            with (directory / f"{file_name}.jsonl").open("wb") as f:
+                for value in values:
+                    line = json.dumps(value, separators=(",", ":")).encode("utf-8") + b"\n"
+                    f.write(line)
+                    offsets.append(offsets[-1] + len(line))
+            write_npy(directory / f"{file_name}.offsets.npy", "Q", "u8", offsets)
+        meta_columns.append({"name": name, "kind": kind, "file": file_name})
+        summary[name] = _summarize(kind, values)
+    meta = {"rows": rows, "columns": meta_columns}
+    (directory / "meta.json").write_text(json.dumps(meta))
+    return {
+        "format": "columnar",
+        "path": PREDICTIONS_DIR,
+        "rows": rows,
+        "columns": [column["name"] for column in meta_columns],
+        "summary": summary,
+    }
+
+
+def is_stored(predictions: Any) -> bool:
+    """Whether `Result.predictions` is a pointer to stored columns, not inline predictions."""
+    return isinstance(predictions, dict) and predictions.get("format") == "columnar"
+
+
+class PredictionsTable:
+    """The stored predictions of a result, read a slice at a time."""
+
+    def __init__(self, result_dir: Path) -> None:
+        directory = result_dir / PREDICTIONS_DIR
+        try:
+            meta = json.loads((directory / "meta.json").read_text())
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail="Predictions not found") from e
+        self.rows: int = meta["rows"]
+        self.names = [column["name"] for column in meta["columns"]]
+        self.columns: dict[str, NpyColumn | JsonColumn] = {}
+        for column in meta["columns"]:
+            file_name = column["file"]
+            if column["kind"] == "json":
+                self.columns[column["name"]] = JsonColumn(directory / f"{file_name}.jsonl", directory / f"{file_name}.offsets.npy")
+            else:
+                self.columns[column["name"]] = NpyColumn(directory / f"{file_name}.npy")
+
+    def _column(self, name: str) -> NpyColumn | JsonColumn:
+        if name not in self.columns:
+            raise HTTPException(status_code=400, detail=f"Unknown predictions column {name}")
+        return self.columns[name]
+
+    def _matching_rows(self, offset: int, limit: int, where: list[tuple[str, Callable[[Any], bool]]]) -> tuple[list[int], int]:
+        """Indices of up to `limit` rows from `offset` passing every filter, and where the scan stopped."""
+        if not where:
+            stop = min(offset + limit, self.rows)
+            return list(range(offset, stop)), stop
+        matches: list[int] = []
+        start = offset
+        while start < self.rows and len(matches) < limit:
+            stop = min(start + SCAN_ROWS, self.rows)
+            passing = [True] * (stop - start)
+            for name, test in where:
+                for i, value in enumerate(self._column(name).read(start, stop)):
+                    if passing[i] and not test(value):
+                        passing[i] = False
+            for i, keep in enumerate(passing):
+                if keep:
+                    matches.append(start + i)
+                    if len(matches) == limit:
+                        return matches, start + i + 1
+            start = stop
+        return matches, start
+
+    def _read_rows(self, name: str, indices: list[int]) -> list[Any]:
+        """Values of a column at sorted row indices, reading contiguous runs at once."""
+        column = self._column(name)
+        values: list[Any] = []
+        run_start = 0
+        for i in range(1, len(indices) + 1):
+            if i == len(indices) or indices[i] != indices[i - 1] + 1:
+                values.extend(column.read(indices[run_start], indices[i - 1] + 1))
+                run_start = i
+        return values
+
+    def page(
+        self,
+        offset: int,
+        limit: int,
+        columns: list[str],
+        where: list[tuple[str, Callable[[Any], bool]]],
+    ) -> dict[str, Any]:
+        """
+        Rows from row `offset` that pass the filters, with the offset to continue from.
+
+        Parameters:
+        - offset (int): Row to start scanning at.
+        - limit (int): Maximum rows returned.
+        - columns (list[str]): Columns returned, all of them when empty.
+        - where (list[tuple[str, Callable[[Any], bool]]]): Column filters.
+        """
+        names = columns or self.names
+        indices, next_offset = self._matching_rows(offset, limit, where)
+        data = {name: self._read_rows(name, indices) for name in names}
+        # NaN and infinities have no JSON form
+        for name in names:
+            if isinstance(self.columns[name], NpyColumn):
+                data[name] = [v if math.isfinite(v) else None for v in data[name]]
+        return {
+            "rows": self.rows,
+            "columns": names,
+            "indices": indices,
+            "data": [{name: data[name][i] for name in names} for i in range(len(indices))],
+            "next_offset": next_offset if next_offset < self.rows else None,
+        }
+
+
+_OPERATORS: dict[str, Callable[[Any, Any], bool]] = {
+    "eq": lambda a, b: a == b,
+    "ne": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and a > b,
+    "ge": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "le": lambda a, b: a is not None and a <= b,
+}
+
+
+def parse_filter(expression: str) -> tuple[str, Callable[[Any], bool]]:
+    """
+    Parse a `column:operator:value` filter, like `score:gt:0.5` or `label:eq:cat`.
+
+    The value is read as JSON when it can be, as a string otherwise.
+    """
+    try:
+        name, operator, raw = expression.split(":", 2)
+        compare = _OPERATORS[operator]
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter {expression}, expected column:{'|'.join(_OPERATORS)}:value") from e
+    try:
+        expected = json.loads(raw)
+    except ValueError:
+        expected = raw
+
+    def test(value: Any) -> bool:
+        try:
+            return compare(value, expected)
+        except TypeError:
+            return False
+
+    return name, test
+
@@ -0,0 +1,313 @@
+"""Long-lived predictors that serve online predictions with dynamic batching."""
+import asyncio
+import json
+import os
+import time
+import urllib.error
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from ormar.exceptions import NoMatch
+
+from server.db.models.ml_models import Model
+from server.db.models.results import Result
+from server.services.cog import head_commit, replace_source_with_destination
+from server.services.containers import CogContainer
+from server.settings import settings
+from server.web.api.utils import job_get_dirs
+
+
+class PredictorKey(NamedTuple):
+    """A model served with the weights of one of its training results, at a model commit."""
+
+    model_id: str
+    result_id: str
+    commit: str
+
+
+class QueueFullError(Exception):
+    """Raised when a predictor has more waiting requests than it accepts."""
+
+
+class PredictionError(Exception):
+    """Raised when the predictor container fails a batch."""
+
+
+class Predictor:
+    """
+    A started cog container fed with batches of queued inputs.
+
+    Inputs wait in a bounded queue. A single worker takes the first waiting
+    input and keeps collecting until the batch is full or `max_wait` passed,
+    then posts the whole batch to cog's `/predictions` as a JSON list in the
+    `inputs` input, along with `trained_model`. The model answers with a list
+    of outputs in the same order.
+    """
+
+    def __init__(
+        self,
+        key: PredictorKey,
+        container: CogContainer,
+        trained_model: str,
+        max_batch_size: int,
+        max_wait: float,
+        max_queue: int,
+    ) -> None:
+        self.key = key
+        self.container = container
+        self.trained_model = trained_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: asyncio.Queue[tuple[Any, asyncio.Future[Any]]] = asyncio.Queue(maxsize=max_queue)
+        self._worker: asyncio.Task[None] | None = None
+        self._dead = False
+
+    async def start(self) -> None:
+        """Start the container and the batching worker."""
+        await self.container.start()
+        self._worker = asyncio.create_task(self._batch_loop())
+
+    @property
+    def alive(self) -> bool:
+        """Whether the worker runs and the container answered its last request."""
+        return not self._dead and self._worker is not None and not self._worker.done()
+
+    async def predict(self, item: Any) -> Any:
+        """
+        Queue one input and wait for its output.
+
+        Raises:
+        - QueueFullError: If the queue is full, so callers can shed load.
+        - PredictionError: If the batch holding the input failed.
+        """
+        return (await self.predict_many([item]))[0]
+
+    async def predict_many(self, items: list[Any]) -> list[Any]:
+        """
+        Queue inputs, all of them or none, and wait for their outputs.
+
+        Inputs not predicted yet when the caller stops waiting, or when one
+        of them failed, are dropped from the queue instead of run for nobody.
+
+        Raises:
+        - QueueFullError: If the queue has no room for every input, so callers can shed load.
+        - PredictionError: If a batch holding one of the inputs failed.
+        """
+        if not self.alive:
+            raise PredictionError(f"Predictor {self.key.model_id}/{self.key.result_id} stopped")
+        if self._queue.maxsize - self._queue.qsize() < len(items):
+            raise QueueFullError(f"Predictor {self.key.model_id}/{self.key.result_id} is busy")
+        loop = asyncio.get_running_loop()
+        futures: list[asyncio.Future[Any]] = [loop.create_future() for _ in items]
+        # Nothing is awaited between the check and the last put, so the room cannot be taken meanwhile
+        for item, future in zip(items, futures):
+            self._queue.put_nowait((item, future))
+        try:
+            return list(await asyncio.gather(*futures))
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def _collect(self) -> list[tuple[Any, asyncio.Future[Any]]]:
+        """Wait for a first input, then gather more until the batch is full or times out."""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self) -> None:
+        while True:
+            batch = [(item, future) for item, future in await self._collect() if not future.done()]
+            if not batch:
+                continue
+            inputs = {
+                "inputs": json.dumps([item for item, _ in batch]),
+                "trained_model": self.trained_model,
+            }
+            try:
+                response = await self.container.request("/predictions", inputs, settings.predictor_request_timeout)
+                if response.get("status") != "succeeded":
+                    raise PredictionError(str(response.get("error")))
+                outputs = response.get("output")
+                if not isinstance(outputs, list) or len(outputs) != len(batch):
+                    raise PredictionError("Predictor did not return one output per input")
+            except asyncio.CancelledError:
+                # Stopped mid-batch, its callers would wait forever otherwise
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(PredictionError("Predictor stopped"))
+                raise
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e if isinstance(e, PredictionError) else PredictionError(str(e)))
+                if _is_unreachable(e):
+                    # The container died or hangs, the cache replaces the predictor on its next use
+                    self._dead = True
+                    self._fail_queued("Predictor container stopped answering")
+                    return
+                continue
+            for (_, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+    async def stop(self) -> None:
+        """Stop the worker, fail what is still queued and remove the container."""
+        if self._worker is not None:
+            self._worker.cancel()
+        self._fail_queued("Predictor stopped")
+        await self.container.stop()
+
+    def _fail_queued(self, message: str) -> None:
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(PredictionError(message))
+
+
+def _is_unreachable(error: Exception) -> bool:
+    """Whether a request failed because the container is gone or hangs, not because of its answer."""
+    if isinstance(error, urllib.error.HTTPError):
+        return False
+    return isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError))
+
+
+class PredictorCache:
+    """
+    Live predictors kept in least recently used order under a memory budget.
+
+    The cost of a predictor is the size of its weights file, a close measure
+    of what loading it costs in memory. When the total goes over budget the
+    least recently used predictors are stopped. A predictor whose container
+    died is replaced by a new one on its next use.
+    """
+
+    def __init__(self, memory_budget: int) -> None:
+        self.memory_budget = memory_budget
+        self._predictors: OrderedDict[PredictorKey, tuple[Predictor, int]] = OrderedDict()
+        self._locks: dict[PredictorKey, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.restarts = 0
+
+    @property
+    def used(self) -> int:
+        """Memory used by live predictors."""
+        return sum(cost for _, cost in self._predictors.values())
+
+    async def get(self, key: PredictorKey, factory: Callable[[], Awaitable[tuple[Predictor, int]]]) -> Predictor:
+        """Return the live predictor for a key, starting it with `factory` on a miss."""
+        entry = self._predictors.get(key)
+        if entry is not None and entry[0].alive:
+            self.hits += 1
+            self._predictors.move_to_end(key)
+            return entry[0]
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            entry = self._predictors.get(key)
+            if entry is not None and not entry[0].alive:
+                del self._predictors[key]
+                self.restarts += 1
+                await entry[0].stop()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                entry = await factory()
+                self._predictors[key] = entry
+                await self._evict(keep=key)
+            else:
+                self.hits += 1
+        return entry[0]
+
+    async def _evict(self, keep: PredictorKey) -> None:
+        """Stop least recently used predictors until the cache fits its budget."""
+        while self.used > self.memory_budget and len(self._predictors) > 1:
+            key = next(iter(self._predictors))
+            if key == keep:
+                self._predictors.move_to_end(key)
+                continue
+            predictor, _ = self._predictors.pop(key)
+            self.evictions += 1
+            await predictor.stop()
+
+    def stats(self) -> dict[str, Any]:
+        """Cache metrics."""
+        lookups = self.hits + self.misses
+        return {
+            "predictors": len(self._predictors),
+            "memory_used": self.used,
+            "memory_budget": self.memory_budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "restarts": self.restarts,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def shutdown(self) -> None:
+        """Stop every predictor."""
+        entries = list(self._predictors.values())
+        self._predictors.clear()
+        await asyncio.gather(*(predictor.stop() for predictor, _ in entries))
+
+
+async def predictor_for_result(model: Model, result: Result) -> Predictor:
+    """
+    Get the predictor serving the weights of a training result.
+
+    Parameters:
+    - model (Model): The model the result was trained on.
+    - result (Result): A done training result, with its job loaded.
+
+    Returns:
+    - Predictor: A live predictor from the cache, started on a miss.
+
+    Raises:
+    - ContainerError: If the predictor container cannot be started.
+    """
+    job_base_dir, _, model_path = job_get_dirs(result.job.id, "", model.git_name)
+    trained_model = f"{job_base_dir}/{str(result.id)}/{result.pretrained_model}"
+    key = PredictorKey(model_id=str(model.id), result_id=str(result.id), commit=head_commit(model_path))
+
+    async def start_predictor() -> tuple[Predictor, int]:
+        predictor = Predictor(
+            key=key,
+            container=CogContainer(image=str(result.job.id), base_dir=job_base_dir),
+            trained_model=replace_source_with_destination(trained_model, job_base_dir),
+            max_batch_size=settings.predictor_max_batch_size,
+            max_wait=settings.predictor_max_wait_ms / 1000,
+            max_queue=settings.predictor_max_queue,
+        )
+        await predictor.start()
+        cost = os.path.getsize(trained_model) if os.path.exists(trained_model) else 0
+        return predictor, cost
+
+    return await predictors.get(key, start_predictor)
+
+
+async def preload_predictors() -> None:
+    """Start predictors for the latest done training result of every model."""
+    for model in await Model.objects.all():
+        try:
+            result = await Result.objects.select_related("job").filter(
+                job__model_id=model.id,
+                result_type="train",
+                status="done",
+                pretrained_model__isnull=False,
+            ).order_by("-modified").first()
+        except NoMatch:
+            continue
+        try:
+            await predictor_for_result(model, result)
+        except Exception as e:
+            print(f"Could not preload predictor for model {model.id}: {e}")
+
+
+predictors = PredictorCache(memory_budget=settings.predictor_cache_memory_bytes)
@@ -0,0 +1,203 @@
+"""
+Previews of result files, made once and cached.
+
+A preview is the first rows of a CSV, a truncated JSON document, the head of
+a text file or a thumbnail of an image. Previews are made in a thread pool
+and cached under `{job_base_dir}/.previews/{result_id}`, named after the
+content hash of the file so a changed file gets a new preview. Thumbnails
+need Pillow; without it images have no preview.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Any
+
+from server.db.models.result_files import ResultFile
+from server.services.compression import open_stored
+from server.settings import settings
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+TABLE_SUFFIXES = {".csv": ",", ".tsv": "\t"}
+JSON_SUFFIXES = {".json"}
+TEXT_SUFFIXES = {".txt", ".log", ".jsonl", ".md", ".yaml", ".yml", ".xml", ".html", ".py", ".cfg", ".ini"}
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+# Images larger than this are not decoded for a thumbnail
+MAX_IMAGE_SIZE = 256 * 1024 ** 2
+# Items kept per JSON array or object, and characters per JSON string
+JSON_ITEMS = 50
+JSON_STRING = 1000
+
+
+def preview_kind(name: str) -> str | None:
+    """Kind of preview a result file gets: `table`, `json`, `text`, `image`, or None."""
+    suffix = PurePosixPath(name).suffix.lower()
+    if suffix in TABLE_SUFFIXES:
+        return "table"
+    if suffix in JSON_SUFFIXES:
+        return "json"
+    if suffix in TEXT_SUFFIXES:
+        return "text"
+    if suffix in IMAGE_SUFFIXES and Image is not None:
+        return "image"
+    return None
+
+
+def preview_path(cache_dir: Path, entry: ResultFile) -> Path:
+    """Cached preview of a manifest entry."""
+    suffix = ".png" if preview_kind(entry.name) == "image" else ".json"
+    return cache_dir / f"{entry.sha256}{suffix}"
+
+
+def _read_head(path: Path, limit: int) -> tuple[bytes, bool]:
+    """The first `limit` bytes of the content of a file, and whether there is more."""
+    with open_stored(path) as f:
+        data = f.read(limit + 1)
+    return data[:limit], len(data) > limit
+
+
+def _truncate(value: Any, depth: int = 0) -> tuple[Any, bool]:
+    if depth > 20:
+        return "…", True
+    if isinstance(value, str) and len(value) > JSON_STRING:
+        return value[:JSON_STRING] + "…", True
+    if isinstance(value, list):
+        elements = [_truncate(item, depth + 1) for item in value[:JSON_ITEMS]]
+        return [item for item, _ in elements], len(value) > JSON_ITEMS or any(cut for _, cut in elements)
+    if isinstance(value, dict):
+        members = {key: _truncate(item, depth + 1) for key, item in list(value.items())[:JSON_ITEMS]}
+        truncated = len(value) > JSON_ITEMS or any(cut for _, cut in members.values())
+        return {key: item for key, (item, _) in members.items()}, truncated
+    return value, False
+
+
+def _table_preview(path: Path, delimiter: str) -> dict[str, Any]:
+    data, more = _read_head(path, settings.preview_max_bytes)
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8", errors="replace"), newline=""), delimiter=delimiter))
+    if more and rows:
+        # The last row was cut by the byte limit
+        rows.pop()
+    header, body = (rows[0], rows[1:]) if rows else ([], [])
+    return {
+        "kind": "table",
+        "columns": header,
+        "rows": body[:settings.preview_rows],
+        "truncated": more or len(body) > settings.preview_rows,
+    }
+
+
+def _json_preview(path: Path) -> dict[str, Any]:
+    data, more = _read_head(path, settings.preview_max_bytes)
+    if not more:
+        try:
+            value, truncated = _truncate(json.loads(data))
+            return {"kind": "json", "value": value, "truncated": truncated}
+        except ValueError:
+            pass
+    # Too large or invalid documents are shown as text
+    return {"kind": "text", "text": data.decode("utf-8", errors="replace"), "truncated": more}
+
+
+def _text_preview(path: Path) -> dict[str, Any]:
+    data, more = _read_head(path, settings.preview_max_bytes)
+    return {"kind": "text", "text": data.decode("utf-8", errors="replace"), "truncated": more}
+
+
+def _thumbnail(path: Path, destination: Path) -> None:
+    if path.stat().st_size > MAX_IMAGE_SIZE:
+        raise ValueError(f"{path} is too large for a thumbnail")
+    with Image.open(path) as image:
+        image.draft("RGB", (settings.preview_thumbnail_size, settings.preview_thumbnail_size))
+        image.thumbnail((settings.preview_thumbnail_size, settings.preview_thumbnail_size))
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+    _write_atomic(destination, buffer.getvalue())
+
+
+def _write_atomic(destination: Path, data: bytes) -> None:
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, destination)
+
+
+def make_preview(path: Path, name: str, destination: Path) -> None:
+    """Make the preview of a file and write it to `destination`."""
+    kind = preview_kind(name)
+    suffix = PurePosixPath(name).suffix.lower()
+    if kind == "image":
+        _thumbnail(path, destination)
+        return
+    if kind == "table":
+        preview = _table_preview(path, TABLE_SUFFIXES[suffix])
+    elif kind == "json":
+        preview = _json_preview(path)
+    elif kind == "text":
+        preview = _text_preview(path)
+    else:
+        raise ValueError(f"{name} has no preview")
+    _write_atomic(destination, json.dumps(preview).encode("utf-8"))
+
+
+class PreviewPool:
+    """
+    Make previews in a thread pool, at most once per file at a time.
+
+    Requests for a preview being made wait for it instead of starting
+    another, so a page listing many files costs one pass per file.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: dict[Path, asyncio.Future[None]] = {}
+
+    def _submit(self, path: Path, name: str, destination: Path) -> asyncio.Future[None]:
+        future = self._pending.get(destination)
+        if future is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="preview")
+            future = asyncio.wrap_future(self._executor.submit(make_preview, path, name, destination))
+            self._pending[destination] = future
+            future.add_done_callback(lambda _: self._pending.pop(destination, None))
+        return future
+
+    async def get(self, result_dir: Path, cache_dir: Path, entry: ResultFile) -> Path:
+        """
+        The cached preview of a result file, made now if it is not cached yet.
+
+        Raises:
+        - ValueError: If the file has no preview.
+        """
+        destination = preview_path(cache_dir, entry)
+        if not destination.exists():
+            await asyncio.shield(self._submit(result_dir / entry.name, entry.name, destination))
+        return destination
+
+    def schedule(self, result_dir: Path, cache_dir: Path, entries: list[ResultFile]) -> None:
+        """Make the previews of result files in the background."""
+        for entry in entries:
+            if preview_kind(entry.name) is None or preview_path(cache_dir, entry).exists():
+                continue
+            future = self._submit(result_dir / entry.name, entry.name, preview_path(cache_dir, entry))
+            # Failures are reported when the preview is asked for
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def shutdown(self) -> None:
+        """Stop the pool without waiting for previews being made."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+preview_pool = PreviewPool(workers=settings.preview_workers)
@@ -0,0 +1,272 @@
+"""
+Tiered retention of result files.
+
+Results nobody touched for a while are moved off the hot volume. With the
+local storage backend the result directory is packed into one compressed
+tar under `settings.archive_dir`; with a remote backend, which already keeps
+every file, the local working copy is dropped. The result row and its
+manifest stay, so archived results are still listed, and their files come
+back on the first read that needs them.
+"""
+import asyncio
+import datetime
+import os
+import shutil
+import tarfile
+import uuid
+from pathlib import Path
+
+import ormar
+import sqlalchemy as sa
+
+from server.db.config import database
+from server.db.models.result_files import ResultFile
+from server.db.models.results import Result
+from server.services.cas import dedupe_result
+from server.services.compression import zstandard
+from server.services.manifest import index_result_files, result_dir_of
+from server.services.storage import ensure_result_local, storage, storage_key, store_files
+from server.settings import settings
+from server.web.api.utils import get_files_in_path
+
+ARCHIVE_SUFFIXES = (".tar.zst", ".tar.gz")
+FINISHED_STATUSES = ["done", "error", "stopped"]
+
+_restore_locks: dict[uuid.UUID, asyncio.Lock] = {}
+
+
+def archive_path(result: Result, suffix: str | None = None) -> Path:
+    """Archive of a result, the existing one or where a new one is written."""
+    base = Path(settings.archive_dir) / str(result.job.id) / str(result.id)
+    if suffix is not None:
+        return base.with_name(base.name + suffix)
+    for known in ARCHIVE_SUFFIXES:
+        path = base.with_name(base.name + known)
+        if path.exists():
+            return path
+    return base.with_name(base.name + (".tar.zst" if zstandard is not None else ".tar.gz"))
+
+
+def pack(result_dir: Path, destination: Path) -> int:
+    """
+    Write a result directory into a compressed tar, atomically.
+
+    Returns:
+    - int: Size of the archive.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with tmp_path.open("wb") as raw:
+            if destination.name.endswith(".tar.zst"):
+                with zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=False) as writer:
+                    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                        tar.add(result_dir, arcname=".")
+            else:
+                with tarfile.open(fileobj=raw, mode="w:gz", format=tarfile.PAX_FORMAT, compresslevel=6) as tar:
+                    tar.add(result_dir, arcname=".")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, destination)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return destination.stat().st_size
+
+
+def unpack(archive: Path, result_dir: Path) -> None:
+    """Extract the archive of a result into its directory, atomically."""
+    tmp_dir = result_dir.with_name(f".{result_dir.name}.{uuid.uuid4().hex}.restoring")
+    try:
+        # The stubs of the pinned mypy predate the extraction filters of Python 3.11.4
+        if archive.name.endswith(".tar.zst"):
+            if zstandard is None:
+                raise RuntimeError(f"{archive} is compressed with zstd, install zstandard to restore it")
+            with archive.open("rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    tar.extractall(tmp_dir, filter="data")  # type: ignore[call-arg]
+        else:
+            with tarfile.open(archive, mode="r:gz") as tar:
+                tar.extractall(tmp_dir, filter="data")  # type: ignore[call-arg]
+        if result_dir.exists():
+            # Files written since the result was archived, like a new log, are kept
+            shutil.copytree(result_dir, tmp_dir, dirs_exist_ok=True)
+            shutil.rmtree(result_dir)
+        os.replace(tmp_dir, result_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _snapshot(result_dir: Path) -> dict[str, tuple[int, float]]:
+    """Size and mtime of every file of a result directory, by name."""
+    snapshot = {}
+    for name in get_files_in_path(result_dir):
+        stat = (result_dir / name).stat()
+        snapshot[name] = (stat.st_size, stat.st_mtime)
+    return snapshot
+
+
+def _remove_unchanged(result_dir: Path, snapshot: dict[str, tuple[int, float]]) -> int:
+    """
+    Remove the files that did not change since the snapshot, and the directories left empty.
+
+    Files written since, like a log segment, are kept.
+
+    Returns:
+    - int: Bytes freed.
+    """
+    freed = 0
+    for name, (size, mtime) in snapshot.items():
+        path = result_dir / name
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if (stat.st_size, stat.st_mtime) == (size, mtime):
+            path.unlink()
+            freed += size
+    for root, _, _ in sorted(os.walk(result_dir), key=lambda walked: -len(walked[0])):
+        try:
+            os.rmdir(root)
+        except OSError:
+            # Not empty
+            pass
+    return freed
+
+
+async def archive_result(result: Result) -> int:
+    """
+    Move the files of a result to the archive tier.
+
+    Only files that are in the archive, or stored in the backend with their
+    size, and did not change since are removed. The tier is switched once
+    they are gone, under the lock restores take.
+
+    Parameters:
+    - result (Result): The result, with its job.
+
+    Returns:
+    - int: Bytes freed on the hot volume.
+    """
+    result_dir = result_dir_of(result)
+    if not result_dir.is_dir():
+        return 0
+    if storage.is_local:
+        snapshot = await asyncio.to_thread(_snapshot, result_dir)
+        await asyncio.to_thread(pack, result_dir, archive_path(result))
+    else:
+        # Files written since the last submit are indexed and stored first
+        manifest = await index_result_files(result)
+        snapshot = await asyncio.to_thread(_snapshot, result_dir)
+        if set(snapshot) != {entry.name for entry in manifest}:
+            # Changed while it was indexed
+            return 0
+        keys = {name: storage_key(result_dir / name) for name in snapshot}
+        sizes = {name: await asyncio.to_thread(storage.size, key) for name, key in keys.items()}
+        await store_files(result_dir / name for name, (size, _) in snapshot.items() if sizes[name] != size)
+        for name, (size, _) in snapshot.items():
+            if await asyncio.to_thread(storage.size, keys[name]) != size:
+                return 0
+    async with _restore_locks.setdefault(result.id, asyncio.Lock()):
+        await result.load()
+        if result.tier != "hot":
+            return 0
+        freed = await asyncio.to_thread(_remove_unchanged, result_dir, snapshot)
+        result.tier = "archived"
+        result.archived = datetime.datetime.now()
+        await result.update(_columns=["tier", "archived"])
+    _restore_locks.pop(result.id, None)
+    return freed
+
+
+async def ensure_hot(result: Result) -> None:
+    """Bring the files of an archived result back to the hot volume, once for concurrent reads."""
+    if result.tier != "archived":
+        return
+    lock = _restore_locks.setdefault(result.id, asyncio.Lock())
+    async with lock:
+        await result.load()
+        if result.tier != "archived":
+            return
+        result_dir = result_dir_of(result)
+        entries = await ResultFile.objects.filter(result=result.id).all()
+        if storage.is_local:
+            archive = archive_path(result)
+            if not archive.exists():
+                raise FileNotFoundError(f"Archive of result {result.id} not found")
+            await asyncio.to_thread(unpack, archive, result_dir)
+        else:
+            await ensure_result_local(result_dir, [entry.name for entry in entries])
+        # Extracted files keep their size but their mtime can differ slightly from the manifest
+        for entry in entries:
+            try:
+                stat = (result_dir / entry.name).stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_size == (entry.stored_size if entry.encoding else entry.size) and stat.st_mtime != entry.mtime:
+                await entry.update(mtime=stat.st_mtime)
+        result.tier = "hot"
+        result.restored = datetime.datetime.now()
+        await result.update(_columns=["tier", "restored"])
+        if storage.is_local:
+            await asyncio.to_thread(archive_path(result).unlink, True)
+        if settings.cas_enabled:
+            await dedupe_result(result)
+    _restore_locks.pop(result.id, None)
+
+
+async def cold_results(batch: int = 50) -> list[Result]:
+    """
+    Results the retention policy moves to the archive tier.
+
+    A result is cold when it finished, is not pinned, was neither modified nor
+    restored for `retention_min_age` seconds and holds at least
+    `retention_min_size` bytes.
+    """
+    horizon = datetime.datetime.now() - datetime.timedelta(seconds=settings.retention_min_age)
+    candidates = await Result.objects.select_related("job").filter(
+        ormar.and_(
+            tier="hot",
+            pinned=False,
+            status__in=FINISHED_STATUSES,
+            modified__lt=horizon,
+        ),
+        ormar.or_(restored__isnull=True, restored__lt=horizon),
+    ).order_by("modified").limit(batch).all()
+    if not candidates or settings.retention_min_size <= 0:
+        return candidates
+    files = ResultFile.Meta.table
+    sizes = {
+        uuid.UUID(str(row["result"])): row["size"]
+        for row in await database.fetch_all(
+            sa.select(files.c.result, sa.func.sum(sa.func.coalesce(files.c.stored_size, files.c.size)).label("size"))
+            .where(files.c.result.in_([result.id for result in candidates]))
+            .group_by(files.c.result)
+        )
+    }
+    return [result for result in candidates if (sizes.get(result.id) or 0) >= settings.retention_min_size]
+
+
+async def apply_retention() -> int:
+    """
+    Archive the results the policy selects, a batch at a time.
+
+    Returns:
+    - int: Bytes freed on the hot volume.
+    """
+    freed = 0
+    for result in await cold_results():
+        try:
+            freed += await archive_result(result)
+        except Exception as e:
+            print(f"Could not archive result {result.id}: {e}")
+    return freed
+
+
+async def run_forever(interval: float) -> None:
+    """Apply the retention policy until cancelled."""
+    while True:
+        try:
+            await apply_retention()
+        except Exception as e:
+            print(f"Retention of results failed: {e}")
+        await asyncio.sleep(interval)
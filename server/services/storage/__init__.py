@@ -0,0 +1,18 @@
+"""Storage of result artifacts."""
+from .base import StorageBackend, StorageError
+from .local import LocalStorage
+from .main import download_url, ensure_local, ensure_result_local, storage, storage_key, store_files
+from .s3 import S3Storage
+
+__all__ = [
+    'StorageBackend',
+    'StorageError',
+    'LocalStorage',
+    'S3Storage',
+    'storage',
+    'storage_key',
+    'store_files',
+    'ensure_local',
+    'ensure_result_local',
+    'download_url',
+]
@@ -0,0 +1,53 @@
+"""Interface of artifact storage backends."""
+from pathlib import Path
+
+
+class StorageError(Exception):
+    """Raised when a backend cannot store or read an object."""
+
+
+class StorageBackend:
+    """
+    Store of result artifacts, addressed by keys relative to the results directory.
+
+    The results directory stays the working copy that runs write to and that
+    responses are read from; a backend keeps the artifacts that other nodes
+    fetch into their own working copy. Methods block and are called in threads.
+    """
+
+    # Whether objects are the files of the results directory themselves
+    is_local = False
+
+    def put_file(self, key: str, path: Path) -> None:
+        """Store the file at `path` under `key`, replacing any object with that key."""
+        raise NotImplementedError
+
+    def get_file(self, key: str, path: Path) -> None:
+        """
+        Write the object stored under `key` to `path`.
+
+        Raises:
+        - FileNotFoundError: If there is no such object.
+        """
+        raise NotImplementedError
+
+    def size(self, key: str) -> int | None:
+        """Size of the object stored under `key`, None if there is none."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """Remove the object stored under `key`, if any."""
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> list[str]:
+        """Keys of the objects starting with `prefix`."""
+        raise NotImplementedError
+
+    def presigned_url(self, key: str, expires: int, filename: str | None = None) -> str | None:
+        """
+        URL clients can download the object from directly for `expires` seconds.
+
+        Returns:
+        - str | None: The URL, None if the backend has no direct downloads.
+        """
+        return None
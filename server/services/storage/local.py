@@ -0,0 +1,58 @@
+"""Artifact storage in a local directory."""
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+from server.settings import settings
+
+from .base import StorageBackend
+
+
+class LocalStorage(StorageBackend):
+    """Objects are files under a root directory, the results directory itself by default."""
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        self.is_local = self.root.resolve() == Path(settings.results_dir).resolve()
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if not path.is_relative_to(self.root.resolve()):
+            raise ValueError(f"Key {key} is outside of the storage root")
+        return path
+
+    @staticmethod
+    def _copy(src: Path, dest: Path) -> None:
+        if dest.exists() and os.path.samefile(src, dest):
+            return
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dest)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def put_file(self, key: str, path: Path) -> None:
+        self._copy(path, self._path(key))
+
+    def get_file(self, key: str, path: Path) -> None:
+        self._copy(self._path(key), path)
+
+    def size(self, key: str) -> int | None:
+        try:
+            return self._path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+    def list(self, prefix: str) -> list[str]:
+        root = self.root.resolve()
+        return sorted(
+            path.relative_to(root).as_posix()
+            for path in root.rglob("*")
+            if path.is_file() and path.relative_to(root).as_posix().startswith(prefix)
+        )
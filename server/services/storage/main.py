@@ -0,0 +1,81 @@
+"""Artifact storage selected by the settings, and the results directory kept in step with it."""
+import asyncio
+from pathlib import Path
+from typing import Iterable
+
+from server.settings import settings
+
+from .base import StorageBackend, StorageError
+from .local import LocalStorage
+from .s3 import S3Storage
+
+
+def create_storage() -> StorageBackend:
+    """Backend named by `settings.storage_backend`."""
+    if settings.storage_backend == "s3":
+        return S3Storage(
+            endpoint_url=settings.storage_s3_endpoint_url,
+            bucket=settings.storage_s3_bucket,
+            access_key=settings.storage_s3_access_key,
+            secret_key=settings.storage_s3_secret_key,
+            region=settings.storage_s3_region,
+            prefix=settings.storage_s3_prefix,
+            part_size=settings.storage_s3_part_size,
+            max_concurrency=settings.storage_max_concurrency,
+        )
+    return LocalStorage(settings.storage_local_root or settings.results_dir)
+
+
+def storage_key(path: Path | str) -> str:
+    """Key of a file of the results directory."""
+    return Path(path).resolve().relative_to(Path(settings.results_dir).resolve()).as_posix()
+
+
+async def store_files(paths: Iterable[Path]) -> None:
+    """
+    Copy files of the results directory to the backend, a few at a time.
+
+    Raises:
+    - StorageError: If a file could not be stored.
+    """
+    if storage.is_local:
+        return
+    semaphore = asyncio.Semaphore(settings.storage_max_concurrency)
+
+    async def store(path: Path) -> None:
+        async with semaphore:
+            await asyncio.to_thread(storage.put_file, storage_key(path), path)
+
+    await asyncio.gather(*(store(path) for path in paths))
+
+
+async def ensure_local(path: Path | str) -> Path:
+    """
+    Make sure a file of the results directory is on this node, fetching it from the backend if not.
+
+    Raises:
+    - FileNotFoundError: If the file is neither here nor in the backend.
+    """
+    path = Path(path)
+    if not storage.is_local and not path.exists():
+        await asyncio.to_thread(storage.get_file, storage_key(path), path)
+    return path
+
+
+async def ensure_result_local(result_dir: Path, names: Iterable[str]) -> None:
+    """Fetch the files of a result that are not on this node, skipping those the backend does not have."""
+    if storage.is_local:
+        return
+    for name in names:
+        try:
+            await ensure_local(result_dir / name)
+        except (FileNotFoundError, StorageError) as e:
+            print(f"Could not fetch {result_dir / name}: {e}")
+
+
+def download_url(path: Path | str, filename: str) -> str | None:
+    """URL the client can download a file of the results directory from directly, None to send it from here."""
+    return storage.presigned_url(storage_key(path), settings.storage_url_expires, filename=filename)
+
+
+storage = create_storage()
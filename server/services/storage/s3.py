@@ -0,0 +1,247 @@
+"""Artifact storage in an S3-compatible object store, signed with AWS Signature Version 4."""
+import datetime
+import hashlib
+import hmac
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from .base import StorageBackend, StorageError
+
+CHUNK_SIZE = 1024 * 1024
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+# S3 takes at most this many parts, and parts of at least 5 MiB but the last
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024 ** 2
+
+
+def _quote(value: str, safe: str = "-_.~") -> str:
+    return urllib.parse.quote(value, safe=safe)
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _strip_namespace(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _find_text(root: ET.Element, name: str) -> str | None:
+    for element in root.iter():
+        if _strip_namespace(element.tag) == name:
+            return element.text
+    return None
+
+
+class S3Storage(StorageBackend):
+    """
+    Objects in a bucket of an S3-compatible store, like AWS S3 or MinIO.
+
+    Requests use path-style URLs (`{endpoint}/{bucket}/{key}`), which every
+    S3-compatible store accepts. Files larger than `part_size` are uploaded
+    in parts, `max_concurrency` at a time, each read at its offset with
+    `os.pread`, so at most `max_concurrency` parts are in memory at once.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+        prefix: str = "",
+        part_size: int = 64 * 1024 ** 2,
+        max_concurrency: int = 8,
+        timeout: float = 300,
+    ) -> None:
+        self.endpoint = urllib.parse.urlsplit(endpoint_url.rstrip("/"))
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+
+    def _bucket_path(self) -> str:
+        return "/" + "/".join(_quote(part) for part in [*filter(None, self.endpoint.path.split("/")), self.bucket])
+
+    def _object_path(self, key: str) -> str:
+        return self._bucket_path() + "/" + "/".join(_quote(part) for part in (self.prefix + key).split("/"))
+
+    def _signing_key(self, date: str) -> bytes:
+        key = _hmac(("AWS4" + self.secret_key).encode("utf-8"), date)
+        key = _hmac(key, self.region)
+        key = _hmac(key, "s3")
+        return _hmac(key, "aws4_request")
+
+    def _signature(self, method: str, path: str, query: dict[str, str], headers: dict[str, str], payload_hash: str, now: datetime.datetime) -> str:
+        canonical_query = "&".join(f"{_quote(k)}={_quote(v)}" for k, v in sorted(query.items()))
+        signed_headers = ";".join(sorted(headers))
+        canonical_headers = "".join(f"{name}:{headers[name].strip()}\n" for name in sorted(headers))
+        canonical_request = "\n".join([method, path, canonical_query, canonical_headers, signed_headers, payload_hash])
+        scope = f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            f"{now:%Y%m%dT%H%M%SZ}",
+            scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+        ])
+        return hmac.new(self._signing_key(f"{now:%Y%m%d}"), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _request(
+        self,
+        method: str,
+        key: str,
+        query: dict[str, str] | None = None,
+        body: Any = None,
+        headers: dict[str, str] | None = None,
+        payload_hash: str = EMPTY_SHA256,
+        bucket_level: bool = False,
+    ) -> Any:
+        """Send a signed request and return the open response."""
+        query = query or {}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        path = self._bucket_path() if bucket_level else self._object_path(key)
+        signed = {
+            "host": self.endpoint.netloc,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": f"{now:%Y%m%dT%H%M%SZ}",
+            **{name.lower(): value for name, value in (headers or {}).items()},
+        }
+        signature = self._signature(method, path, query, signed, payload_hash, now)
+        signed["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{now:%Y%m%d}/{self.region}/s3/aws4_request, "
+            f"SignedHeaders={';'.join(sorted(name for name in signed if name != 'authorization'))}, Signature={signature}"
+        )
+        del signed["host"]
+        url = f"{self.endpoint.scheme}://{self.endpoint.netloc}{path}"
+        if query:
+            url += "?" + "&".join(f"{_quote(k)}={_quote(v)}" for k, v in sorted(query.items()))
+        request = urllib.request.Request(url, data=body, method=method, headers=signed)
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)  # noqa: S310
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise FileNotFoundError(key) from e
+            raise StorageError(f"{method} {key} failed with {e.code}: {e.read()[:500]!r}") from e
+        except urllib.error.URLError as e:
+            raise StorageError(f"{method} {key} failed: {e.reason}") from e
+
+    def put_file(self, key: str, path: Path) -> None:
+        size = path.stat().st_size
+        if size <= self.part_size:
+            with path.open("rb") as f, self._request(
+                "PUT", key, body=f, headers={"content-length": str(size)}, payload_hash=UNSIGNED_PAYLOAD,
+            ):
+                return
+        self._put_multipart(key, path, size)
+
+    def _put_multipart(self, key: str, path: Path, size: int) -> None:
+        """Upload a file in parts, in parallel, and assemble them."""
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        with self._request("POST", key, query={"uploads": ""}) as response:
+            upload_id = _find_text(ET.fromstring(response.read()), "UploadId")
+        if not upload_id:
+            raise StorageError(f"No upload id for {key}")
+        fd = os.open(path, os.O_RDONLY)
+
+        def upload_part(number: int) -> tuple[int, str]:
+            offset = (number - 1) * part_size
+            data = os.pread(fd, min(part_size, size - offset), offset)
+            with self._request(
+                "PUT",
+                key,
+                query={"partNumber": str(number), "uploadId": upload_id},
+                body=data,
+                payload_hash=hashlib.sha256(data).hexdigest(),
+            ) as response:
+                return number, response.headers["ETag"]
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                parts = sorted(executor.map(upload_part, range(1, -(-size // part_size) + 1)))
+            body = (
+                "<CompleteMultipartUpload>"
+                + "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in parts)
+                + "</CompleteMultipartUpload>"
+            ).encode("utf-8")
+            with self._request(
+                "POST", key, query={"uploadId": upload_id}, body=body, payload_hash=hashlib.sha256(body).hexdigest(),
+            ) as response:
+                # Errors of the assembly can come with a 200 status
+                if _find_text(ET.fromstring(response.read()), "Code") is not None:
+                    raise StorageError(f"Could not assemble the parts of {key}")
+        except BaseException:
+            try:
+                self._request("DELETE", key, query={"uploadId": upload_id}).close()
+            except (StorageError, FileNotFoundError):
+                pass
+            raise
+        finally:
+            os.close(fd)
+
+    def get_file(self, key: str, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with self._request("GET", key) as response, tmp_path.open("wb") as f:
+                while chunk := response.read(CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def size(self, key: str) -> int | None:
+        try:
+            with self._request("HEAD", key) as response:
+                return int(response.headers["Content-Length"])
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            self._request("DELETE", key).close()
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix: str) -> list[str]:
+        keys = []
+        query = {"list-type": "2", "prefix": self.prefix + prefix}
+        while True:
+            with self._request("GET", "", query=query, bucket_level=True) as response:
+                root = ET.fromstring(response.read())
+            for element in root.iter():
+                if _strip_namespace(element.tag) == "Key" and element.text:
+                    keys.append(element.text[len(self.prefix):])
+            token = _find_text(root, "NextContinuationToken")
+            if not token:
+                return keys
+            query = {**query, "continuation-token": token}
+
+    def presigned_url(self, key: str, expires: int, filename: str | None = None) -> str | None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        path = self._object_path(key)
+        query = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.access_key}/{now:%Y%m%d}/{self.region}/s3/aws4_request",
+            "X-Amz-Date": f"{now:%Y%m%dT%H%M%SZ}",
+            "X-Amz-Expires": str(expires),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if filename is not None:
+            query["response-content-disposition"] = f'attachment; filename="{filename}"'
+        query["X-Amz-Signature"] = self._signature("GET", path, query, {"host": self.endpoint.netloc}, UNSIGNED_PAYLOAD, now)
+        return f"{self.endpoint.scheme}://{self.endpoint.netloc}{path}?" + "&".join(
+            f"{_quote(k)}={_quote(v)}" for k, v in query.items()
+        )
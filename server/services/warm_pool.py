@@ -0,0 +1,167 @@
+"""Warm pool of idle cog containers used to dispatch test runs."""
+import asyncio
+import math
+import subprocess
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, NamedTuple
+import uuid
+
+from server.services.containers import CogContainer, ContainerError
+from server.services.logs import log_broadcaster
+from server.settings import settings
+
+
+class PoolKey(NamedTuple):
+    """A model version: the job image together with the model commit it was built from."""
+
+    job_id: str
+    commit: str
+
+
+class WarmPool:
+    """
+    Keep a few started cog containers per model version.
+
+    The pool is sized from recent demand using Little's law: arrivals in the
+    demand window times the average run duration gives the number of runs
+    in flight, which is how many idle containers are worth keeping. Idle
+    containers past `idle_ttl` or beyond that target are evicted.
+    """
+
+    def __init__(self, max_size: int, idle_ttl: float, window: float) -> None:
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.window = window
+        self._idle: dict[PoolKey, list[CogContainer]] = {}
+        self._base_dirs: dict[PoolKey, str] = {}
+        self._demand: dict[PoolKey, deque[float]] = {}
+        self._durations: dict[PoolKey, float] = {}
+        self._starting: set[PoolKey] = set()
+        self._lock = asyncio.Lock()
+
+    def record_demand(self, key: PoolKey, base_dir: str) -> None:
+        """Note that a test run for this model version was requested."""
+        self._base_dirs[key] = base_dir
+        self._demand.setdefault(key, deque()).append(time.monotonic())
+
+    def target_size(self, key: PoolKey) -> int:
+        """Number of idle containers worth keeping for a model version."""
+        arrivals = self._demand.get(key)
+        if not arrivals:
+            return 0
+        horizon = time.monotonic() - self.window
+        while arrivals and arrivals[0] < horizon:
+            arrivals.popleft()
+        if not arrivals:
+            return 0
+        in_flight = len(arrivals) / self.window * self._durations.get(key, 60.0)
+        return min(self.max_size, max(1, math.ceil(in_flight)))
+
+    async def dispatch(self, key: PoolKey, inputs: dict[str, Any], logs_dir: Path) -> bool:
+        """
+        Run a test on an idle container of the model version if one is available.
+
+        Parameters:
+        - key (PoolKey): The model version to run on.
+        - inputs (dict[str, Any]): The cog inputs for the run.
+        - logs_dir (Path): Where the run logs are written.
+
+        Returns:
+        - bool: False when no warm container was available and the caller must run cold.
+
+        Raises:
+        - subprocess.CalledProcessError: If the run failed inside the container.
+        """
+        async with self._lock:
+            idle = self._idle.get(key)
+            container = idle.pop() if idle else None
+        if container is None:
+            return False
+        started = time.monotonic()
+        # cog returns the logs with the response, followers get them all at once
+        stream = log_broadcaster.open(logs_dir)
+        try:
+            response = await container.request("/trainings", inputs, settings.warm_pool_request_timeout)
+        except Exception:
+            log_broadcaster.close(stream)
+            await container.stop()
+            raise
+        logs = response.get("logs") or ""
+        stream.publish(logs.encode("utf-8"))
+        log_broadcaster.close(stream)
+        duration = time.monotonic() - started
+        previous = self._durations.get(key, duration)
+        self._durations[key] = 0.8 * previous + 0.2 * duration
+        async with self._lock:
+            self._idle.setdefault(key, []).append(container)
+        if response.get("status") != "succeeded":
+            raise subprocess.CalledProcessError(
+                1,
+                f"{container.name}/trainings",
+                output=logs.encode("utf-8"),
+                stderr=str(response.get("error") or "").encode("utf-8"),
+            )
+        return True
+
+    async def maintain(self) -> None:
+        """Evict idle containers that are not needed and start the missing ones."""
+        now = time.monotonic()
+        for key in set(self._idle) | set(self._demand):
+            target = self.target_size(key)
+            async with self._lock:
+                idle = self._idle.get(key, [])
+                idle.sort(key=lambda container: container.last_used, reverse=True)
+                keep = [c for c in idle[:target] if now - c.last_used < self.idle_ttl]
+                evicted = [c for c in idle if c not in keep]
+                self._idle[key] = keep
+            for container in evicted:
+                await container.stop()
+            if len(keep) < target and key not in self._starting:
+                asyncio.create_task(self._grow(key, target - len(keep)))
+
+    async def _grow(self, key: PoolKey, count: int) -> None:
+        """Start containers for a model version from its already built image."""
+        self._starting.add(key)
+        try:
+            for _ in range(count):
+                container = CogContainer(image=key.job_id, base_dir=self._base_dirs[key])
+                try:
+                    await container.start()
+                except ContainerError as e:
+                    print(f"Warm pool could not start {key.job_id}: {e}")
+                    return
+                async with self._lock:
+                    self._idle.setdefault(key, []).append(container)
+        finally:
+            self._starting.discard(key)
+
+    def discard_job(self, job_id: uuid.UUID) -> None:
+        """Forget the containers of a job whose containers were removed with `docker rm`."""
+        for key in [key for key in self._idle if key.job_id == str(job_id)]:
+            self._idle.pop(key, None)
+            self._demand.pop(key, None)
+
+    async def run_forever(self, interval: float = 30) -> None:
+        """Maintain the pool until cancelled."""
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                print(f"Warm pool maintenance failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def shutdown(self) -> None:
+        """Stop every idle container."""
+        async with self._lock:
+            containers = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        await asyncio.gather(*(container.stop() for container in containers))
+
+
+warm_pool = WarmPool(
+    max_size=settings.warm_pool_max_size,
+    idle_ttl=settings.warm_pool_idle_ttl,
+    window=settings.warm_pool_demand_window,
+)
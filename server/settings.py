@@ -82,6 +82,113 @@ class Settings(BaseSettings):
     cog_base_dir = os.getenv("COG_BASE_DIR", "/var/lib/docker/volumes/filez")
 
     results_dir: str = os.getenv("RESULTS_DIR", "/var/lib/docker/volumes/filez/results")
+
+    # Where result artifacts are kept, "local" or "s3", the results directory being the working copy of each node
+    storage_backend: str = "local"
+    # Root of the local backend, the results directory itself when empty
+    storage_local_root: str = ""
+    storage_s3_endpoint_url: str = "https://s3.amazonaws.com"
+    storage_s3_bucket: str = ""
+    storage_s3_access_key: str = ""
+    storage_s3_secret_key: str = ""
+    storage_s3_region: str = "us-east-1"
+    # Prefix of the keys in the bucket
+    storage_s3_prefix: str = ""
+    # Files larger than this are uploaded in parts of this size
+    storage_s3_part_size: int = 64 * 1024 ** 2
+    # Parts or files transferred at once
+    storage_max_concurrency: int = 8
+    # Seconds a direct download URL stays valid
+    storage_url_expires: int = 3600
+
+    # Files read at once while streaming an export of several results
+    export_read_workers: int = 8
+
+    # Largest file accepted in a result submission
+    submit_max_part_size: int = 50 * 1024 ** 3
+    # Largest form field, like metrics or predictions, accepted in a result submission
+    submit_max_field_size: int = 256 * 1024 ** 2
+    # Seconds the idempotency key of a submission is remembered
+    submit_idempotency_ttl: int = 7 * 24 * 3600
+    # Seconds after which a submission still being processed is considered lost and can be retried
+    submit_pending_timeout: int = 3600
+
+    # Largest form upload of test data, larger files go through upload sessions
+    upload_form_max_size: int = 2 * 1024 ** 3
+    # Largest file accepted by a resumable upload session
+    upload_max_size: int = 200 * 1024 ** 3
+    # Seconds an unfinished upload session is kept after its last chunk
+    upload_session_ttl: int = 24 * 3600
+
+    # Size at which a run log segment is closed and compressed
+    log_segment_size: int = 16 * 1024 ** 2
+
+    # Compress text files of finished results in the background, off by default since
+    # runs that mount a result directory read its files as they are
+    compress_at_rest: bool = False
+    # Seconds since a file of a finished result was written before it is compressed
+    compression_delay: int = 600
+    # Seconds between two passes of the background compressor
+    compression_interval: int = 300
+
+    # Move results nobody touched for a while off the hot volume
+    retention_enabled: bool = False
+    # Where archived results are kept with the local storage backend
+    archive_dir: str = os.getenv("ARCHIVE_DIR", "/var/lib/docker/volumes/filez/archive")
+    # Seconds since a result was modified or restored before it is archived
+    retention_min_age: int = 90 * 24 * 3600
+    # Smallest result archived, in bytes
+    retention_min_size: int = 0
+    # Seconds between two passes of the retention policy
+    retention_interval: int = 3600
+
+    # Keep large result artifacts once per content, linked from each result
+    cas_enabled: bool = True
+    # Smallest result file kept in the content-addressed store
+    cas_min_size: int = 1024 ** 2
+    # Seconds between two garbage collections of the store
+    cas_gc_interval: int = 3600
+
+    # Previews of result files
+    # Rows of a CSV preview
+    preview_rows: int = 50
+    # Bytes of a file read for a text, JSON or CSV preview
+    preview_max_bytes: int = 64 * 1024
+    # Largest side of an image thumbnail, in pixels
+    preview_thumbnail_size: int = 256
+    # Threads making previews
+    preview_workers: int = 2
+
+    # Metric points reported during runs
+    # Points waiting before they are written without waiting for the interval
+    metrics_flush_size: int = 5000
+    # Seconds between two writes of waiting points
+    metrics_flush_interval: float = 1.0
+    # Waiting points before reports are rejected
+    metrics_max_buffer: int = 500000
+
+    # Warm pool of started cog containers for test runs
+    warm_pool_enabled: bool = False
+    # Maximum idle containers kept per model version
+    warm_pool_max_size: int = 2
+    # Seconds an idle container is kept without being used
+    warm_pool_idle_ttl: int = 600
+    # Seconds of recent test requests used to size the pool
+    warm_pool_demand_window: int = 900
+    warm_pool_request_timeout: int = 3600
+
+    # Online predictions
+    # Largest batch of inputs sent to a predictor at once
+    predictor_max_batch_size: int = 16
+    # Milliseconds a batch waits for more inputs before running
+    predictor_max_wait_ms: int = 10
+    # Waiting inputs per predictor before requests are rejected
+    predictor_max_queue: int = 256
+    predictor_request_timeout: int = 60
+    # Memory budget of the live predictors cache, in bytes of loaded weights
+    predictor_cache_memory_bytes: int = 8 * 1024 ** 3
+    # Start predictors for the latest training result of every model on startup
+    predictor_preload: bool = False
     # datasets_dir: str = git_user_path + "/datasets"
     # models_dir: str = git_user_path + "/models"
 
@@ -0,0 +1,61 @@
+import gzip
+import io
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from server.web.api.results.utils import ZipSink, stream_zip
+
+
+def test_zip_sink() -> None:
+    """Checks that the sink hands out what was written once."""
+    sink = ZipSink()
+    assert sink.writable()
+    assert sink.write(b"abc") == 3
+    sink.write(memoryview(b"def"))
+    assert sink.drain() == b"abcdef"
+    assert sink.drain() == b""
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_stream_zip(tmp_path: Path, workers: int) -> None:
+    """
+    Checks that streamed archives hold every file and member, compressed files decompressed.
+
+    :param tmp_path: temporary directory.
+    :param workers: files read at once.
+    """
+    contents = {
+        "metrics.json": b'{"accuracy": 0.9}',
+        "model.pth": bytes(range(256)) * 8192,
+        "logs/train.log": b"epoch 1\n" * 10000,
+        "empty.txt": b"",
+    }
+    files = []
+    for name, content in contents.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        files.append((str(path), f"result/{name}"))
+    # Stored compressed at rest, with and without its content size known
+    compressed = tmp_path / "predictions.csv"
+    compressed.write_bytes(gzip.compress(b"label,score\n" + b"cat,0.9\n" * 10000))
+    files.append((str(compressed), "result/predictions.csv"))
+
+    chunks = list(stream_zip(
+        files,
+        members=[("manifest.json", b"[]")],
+        workers=workers,
+        sizes={str(tmp_path / "model.pth"): len(contents["model.pth"])},
+    ))
+    assert len(chunks) > 1
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist()[0] == "manifest.json"
+        assert archive.read("manifest.json") == b"[]"
+        for name, content in contents.items():
+            assert archive.read(f"result/{name}") == content
+        assert archive.read("result/predictions.csv") == b"label,score\n" + b"cat,0.9\n" * 10000
+        assert archive.getinfo("result/model.pth").compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("result/logs/train.log").compress_type == zipfile.ZIP_DEFLATED
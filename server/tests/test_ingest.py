@@ -0,0 +1,115 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.types import Message
+
+from server.web.api.results.ingest import SubmitFormParser, safe_relative_name
+
+BOUNDARY = "submitboundary"
+
+
+def multipart_body(fields: dict[str, str], files: dict[str, bytes]) -> bytes:
+    """A multipart body with text fields and file parts."""
+    body = b""
+    for name, value in fields.items():
+        body += f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    for filename, content in files.items():
+        body += (
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + content + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def make_request(body: bytes, chunk_size: int = 7) -> Request:
+    """A request whose body is received in small chunks."""
+    chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+
+    async def receive() -> Message:
+        data = chunks.pop(0) if chunks else b""
+        return {"type": "http.request", "body": data, "more_body": bool(chunks)}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/results/submit",
+        "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())],
+    }
+    return Request(scope, receive)
+
+
+@pytest.mark.parametrize(
+    "filename, name",
+    [
+        ("model.pth", "model.pth"),
+        ("checkpoints/last.pth", "checkpoints/last.pth"),
+        ("../../etc/passwd", "etc/passwd"),
+        ("/abs/path.txt", "abs/path.txt"),
+        ("..\\windows\\model.pth", "windows/model.pth"),
+    ],
+)
+def test_safe_relative_name(filename: str, name: str) -> None:
+    """
+    Checks that file names are kept inside the result directory.
+
+    :param filename: submitted file name.
+    :param name: expected name in the result directory.
+    """
+    assert safe_relative_name(filename) == name
+
+
+@pytest.mark.parametrize("filename", ["..", "/", "./.."])
+def test_safe_relative_name_empty(filename: str) -> None:
+    """
+    Checks that file names with nothing left are refused.
+
+    :param filename: submitted file name.
+    """
+    with pytest.raises(HTTPException) as error:
+        safe_relative_name(filename)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_parse_submission(tmp_path: Path) -> None:
+    """
+    Checks that fields are read and files are staged with their sizes and hashes.
+
+    :param tmp_path: temporary directory.
+    """
+    weights = bytes(range(256)) * 100
+    body = multipart_body(
+        {"result_id": "b2f2c5e4-0d8e-4b0b-9a43-7d4c6a0f5a11", "metrics": '{"accuracy": 0.9}'},
+        {"model.pth": weights, "../logs/train.log": b"epoch 1\n"},
+    )
+    form = await SubmitFormParser(tmp_path / "staging", max_part_size=1024 ** 2, max_field_size=1024).parse(make_request(body))
+    assert form.fields == {"result_id": "b2f2c5e4-0d8e-4b0b-9a43-7d4c6a0f5a11", "metrics": '{"accuracy": 0.9}'}
+    assert [(file.name, file.size) for file in form.files] == [("model.pth", len(weights)), ("logs/train.log", 8)]
+    assert form.files[0].sha256 == hashlib.sha256(weights).hexdigest()
+    assert form.files[0].staged_path.read_bytes() == weights
+    assert form.files[1].staged_path.read_bytes() == b"epoch 1\n"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "fields, files",
+    [
+        ({"predictions": "x" * 2000}, {}),
+        ({}, {"model.pth": b"x" * 2000}),
+    ],
+)
+async def test_parse_too_large(tmp_path: Path, fields: dict[str, str], files: dict[str, bytes]) -> None:
+    """
+    Checks that fields and files over their limit are refused while received.
+
+    :param tmp_path: temporary directory.
+    :param fields: submitted fields.
+    :param files: submitted files.
+    """
+    parser = SubmitFormParser(tmp_path / "staging", max_part_size=1024, max_field_size=1024)
+    with pytest.raises(HTTPException) as error:
+        await parser.parse(make_request(multipart_body(fields, files)))
+    assert error.value.status_code == 413
@@ -0,0 +1,99 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from server.services import logs
+from server.services.logs import LogReader, LogStream, follow_log
+
+
+async def write_logs(logs_dir: Path, lines: int, segment_size: int) -> bytes:
+    """Publish numbered lines in chunks cutting lines, and wait for closed segments to be compressed."""
+    stream = LogStream(logs_dir, segment_size=segment_size)
+    data = b"".join(f"line {i}\n".encode() for i in range(lines))
+    for start in range(0, len(data), 777):
+        stream.publish(data[start:start + 777])
+    stream.close()
+    for _ in range(100):
+        if not list(logs_dir.glob("*.tmp")) and len(list(logs_dir.glob("*.log.gz"))) == len(stream.segments) - 1:
+            break
+        await asyncio.sleep(0.01)
+    return data
+
+
+@pytest.mark.anyio
+async def test_rotation_and_reads(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Checks that rotated and compressed segments read back as the logs that were written.
+
+    :param tmp_path: temporary directory.
+    :param monkeypatch: pytest monkeypatch.
+    """
+    monkeypatch.setattr(logs, "INDEX_INTERVAL", 100)
+    logs_dir = tmp_path / "logs"
+    data = await write_logs(logs_dir, lines=5000, segment_size=8192)
+    assert len(list(logs_dir.glob("*.log.gz"))) > 1
+
+    reader = LogReader(logs_dir)
+    assert reader.closed
+    assert reader.size == len(data)
+    assert reader.read_range(0) == data
+    assert reader.read_range(10000, 20000) == data[10000:20000]
+    assert reader.line_offset(1234) == data.index(b"line 1234\n")
+    assert reader.page(1234, 3) == [(1234, "line 1234"), (1235, "line 1235"), (1236, "line 1236")]
+    assert reader.tail(3) == [(4997, "line 4997"), (4998, "line 4998"), (4999, "line 4999")]
+    assert reader.tail(0) == []
+    assert reader.search("line 42", regex=False, limit=3) == [(42, "line 42"), (420, "line 420"), (421, "line 421")]
+    assert reader.search(r"^line 49\d\d$", regex=True, limit=2, start=4950) == [(4950, "line 4950"), (4951, "line 4951")]
+
+
+@pytest.mark.anyio
+async def test_tail_unterminated(tmp_path: Path) -> None:
+    """
+    Checks that the last line is numbered and returned when it has no newline.
+
+    :param tmp_path: temporary directory.
+    """
+    stream = LogStream(tmp_path / "logs", segment_size=1024 ** 2)
+    stream.publish(b"first\nsecond\nthird")
+    reader = LogReader(tmp_path / "logs")
+    assert not reader.closed
+    assert reader.tail(2) == [(1, "second"), (2, "third")]
+    assert reader.tail(10) == [(0, "first"), (1, "second"), (2, "third")]
+    stream.close()
+
+
+@pytest.mark.anyio
+async def test_follow_stream(tmp_path: Path) -> None:
+    """
+    Checks that a follower gets what was written before it and what is published after.
+
+    :param tmp_path: temporary directory.
+    """
+    logs_dir = tmp_path / "logs"
+    stream = logs.log_broadcaster.open(logs_dir)
+    stream.publish(b"before\n")
+    received = []
+
+    async def follow() -> None:
+        async for _, data in follow_log(logs_dir, offset=2):
+            received.append(data)
+
+    follower = asyncio.create_task(follow())
+    await asyncio.sleep(0.05)
+    stream.publish(b"after\n")
+    logs.log_broadcaster.close(stream)
+    await asyncio.wait_for(follower, 1)
+    assert b"".join(received) == b"fore\nafter\n"
+
+
+def test_legacy_log(tmp_path: Path) -> None:
+    """
+    Checks that a result with a single stdout.log is read as one segment.
+
+    :param tmp_path: temporary directory.
+    """
+    (tmp_path / "stdout.log").write_bytes(b"a\nb\nc\n")
+    reader = LogReader(tmp_path / "logs")
+    assert reader.tail(2) == [(1, "b"), (2, "c")]
+    assert reader.page(0, 10) == [(0, "a"), (1, "b"), (2, "c")]
@@ -0,0 +1,81 @@
+import json
+import math
+from pathlib import Path
+from typing import Any
+
+import pytest
+from fastapi import HTTPException
+
+from server.services.predictions import PredictionsTable, is_stored, parse_filter, store_predictions, to_columns
+
+
+@pytest.mark.parametrize(
+    "predictions, columns",
+    [
+        ([{"label": "cat", "score": 0.9}, {"label": "dog"}], {"label": ["cat", "dog"], "score": [0.9, None]}),
+        ({"label": ["cat", "dog"], "score": [0.9, 0.1]}, {"label": ["cat", "dog"], "score": [0.9, 0.1]}),
+        ([1, 2, 3], {"prediction": [1, 2, 3]}),
+        ('[{"label": "cat"}]', {"label": ["cat"]}),
+        ({"label": "cat", "score": 0.9}, {"label": ["cat"], "score": [0.9]}),
+        ({"label": ["cat", "dog"], "score": [0.9]}, {"label": [["cat", "dog"]], "score": [[0.9]]}),
+        ("not json", {"prediction": ["not json"]}),
+        ("0.5", {"prediction": ["0.5"]}),
+        (0.5, {"prediction": [0.5]}),
+        ("", {}),
+        ([], {}),
+    ],
+)
+def test_to_columns(predictions: Any, columns: dict[str, list[Any]]) -> None:
+    """
+    Checks that every predictions payload is turned into columns of the same length.
+
+    :param predictions: submitted predictions.
+    :param columns: expected columns.
+    """
+    assert to_columns(predictions) == columns
+
+
+def test_predictions_table_page(tmp_path: Path) -> None:
+    """
+    Checks that stored predictions are read back a page at a time, with filters.
+
+    :param tmp_path: temporary directory.
+    """
+    rows = [
+        {"index": i, "score": i / 10 if i != 3 else math.nan, "label": "cat" if i % 2 else "dog", "extra": {"i": i}}
+        for i in range(10)
+    ]
+    pointer = store_predictions(tmp_path, json.dumps(rows))
+    assert is_stored(pointer)
+    assert pointer["rows"] == 10
+    assert pointer["summary"]["index"] == {"min": 0, "max": 9, "mean": 4.5}
+    assert pointer["summary"]["label"]["distinct"] == 2
+
+    table = PredictionsTable(tmp_path)
+    page = table.page(offset=2, limit=3, columns=[], where=[])
+    assert page["indices"] == [2, 3, 4]
+    assert page["data"][1] == {"index": 3, "score": None, "label": "cat", "extra": {"i": 3}}
+    assert page["next_offset"] == 5
+
+    page = table.page(offset=0, limit=2, columns=["index"], where=[parse_filter("label:eq:cat"), parse_filter("index:gt:1")])
+    assert page["data"] == [{"index": 3}, {"index": 5}]
+    assert page["next_offset"] == 6
+
+    page = table.page(offset=6, limit=10, columns=["index"], where=[parse_filter("label:eq:cat")])
+    assert page["indices"] == [7, 9]
+    assert page["next_offset"] is None
+
+    with pytest.raises(HTTPException) as error:
+        table.page(offset=0, limit=1, columns=["missing"], where=[])
+    assert error.value.status_code == 400
+
+
+def test_predictions_table_missing(tmp_path: Path) -> None:
+    """
+    Checks that a result without stored predictions is answered with a 404.
+
+    :param tmp_path: temporary directory.
+    """
+    with pytest.raises(HTTPException) as error:
+        PredictionsTable(tmp_path)
+    assert error.value.status_code == 404
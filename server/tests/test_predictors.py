@@ -0,0 +1,92 @@
+import asyncio
+import json
+from typing import Any
+
+import pytest
+
+from server.services.predictors import PredictionError, Predictor, PredictorCache, PredictorKey, QueueFullError
+
+
+class FakeContainer:
+    """Cog container answering each batch with its inputs doubled, once released."""
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+        self.requested = asyncio.Event()
+        self.batches: list[list[Any]] = []
+        self.stopped = False
+
+    async def start(self) -> None:
+        """Start nothing."""
+
+    async def stop(self) -> None:
+        """Stop nothing."""
+        self.stopped = True
+
+    async def request(self, path: str, inputs: dict[str, Any], timeout: float) -> dict[str, Any]:
+        """Answer a batch once released."""
+        batch = json.loads(inputs["inputs"])
+        self.batches.append(batch)
+        self.requested.set()
+        await self.release.wait()
+        return {"status": "succeeded", "output": [item * 2 for item in batch]}
+
+
+async def start_predictor(name: str, max_queue: int = 8) -> Predictor:
+    """A started predictor with a fake container."""
+    predictor = Predictor(
+        key=PredictorKey(model_id=name, result_id=name, commit="head"),
+        container=FakeContainer(),  # type: ignore[arg-type]
+        trained_model="model.pth",
+        max_batch_size=4,
+        max_wait=0.01,
+        max_queue=max_queue,
+    )
+    await predictor.start()
+    return predictor
+
+
+@pytest.mark.anyio
+async def test_predict_many_batches() -> None:
+    """Checks that queued inputs are predicted in batches and answered in order."""
+    predictor = await start_predictor("model")
+    predictor.container.release.set()  # type: ignore[attr-defined]
+    assert await predictor.predict_many([1, 2, 3, 4, 5]) == [2, 4, 6, 8, 10]
+    assert predictor.container.batches == [[1, 2, 3, 4], [5]]  # type: ignore[attr-defined]
+    await predictor.stop()
+
+
+@pytest.mark.anyio
+async def test_predict_many_queue_full() -> None:
+    """Checks that inputs that do not all fit in the queue are refused at once."""
+    predictor = await start_predictor("model", max_queue=2)
+    with pytest.raises(QueueFullError):
+        await predictor.predict_many([1, 2, 3])
+    assert predictor.container.batches == []  # type: ignore[attr-defined]
+    await predictor.stop()
+
+
+@pytest.mark.anyio
+async def test_eviction_mid_batch() -> None:
+    """Checks that callers of a batch in flight are failed when its predictor is evicted."""
+    cache = PredictorCache(memory_budget=10)
+    first = await start_predictor("first")
+    second = await start_predictor("second")
+
+    async def start_first() -> tuple[Predictor, int]:
+        return first, 10
+
+    async def start_second() -> tuple[Predictor, int]:
+        return second, 10
+
+    await cache.get(first.key, start_first)
+    waiting = asyncio.create_task(first.predict_many([1, 2]))
+    await asyncio.wait_for(first.container.requested.wait(), 1)  # type: ignore[attr-defined]
+
+    await cache.get(second.key, start_second)
+    assert cache.evictions == 1
+    with pytest.raises(PredictionError):
+        await asyncio.wait_for(waiting, 1)
+    assert first.container.stopped  # type: ignore[attr-defined]
+    assert not first.alive
+    await cache.shutdown()
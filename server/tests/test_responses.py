@@ -0,0 +1,169 @@
+import gzip
+from pathlib import Path
+
+import pytest
+from starlette.types import Message
+
+from server.web.api.results.responses import ResultFileResponse, accepts_encoding, parse_range
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.mark.parametrize(
+    "header, ranges",
+    [
+        ("bytes=0-99", [(0, 99)]),
+        ("bytes=100-", [(100, 1023)]),
+        ("bytes=-24", [(1000, 1023)]),
+        ("bytes=-5000", [(0, 1023)]),
+        ("bytes=0-99,50-149,500-599", [(0, 149), (500, 599)]),
+        ("bytes=900-2000", [(900, 1023)]),
+        ("bytes=2000-3000", []),
+        ("bytes=-0", []),
+        ("bytes=99-0", None),
+        ("bytes=a-b", None),
+        ("bytes=10", None),
+        ("items=0-10", None),
+        ("bytes=", None),
+    ],
+)
+def test_parse_range(header: str, ranges: list[tuple[int, int]] | None) -> None:
+    """
+    Checks that Range headers are parsed into merged ranges, or ignored when invalid.
+
+    :param header: Range header.
+    :param ranges: expected ranges.
+    """
+    assert parse_range(header, len(CONTENT)) == ranges
+
+
+@pytest.mark.parametrize(
+    "header, accepted",
+    [(None, False), ("gzip, deflate", True), ("br;q=1.0, gzip;q=0", False), ("*", True), ("identity", False)],
+)
+def test_accepts_encoding(header: str | None, accepted: bool) -> None:
+    """
+    Checks that Accept-Encoding headers are honoured with their quality.
+
+    :param header: Accept-Encoding header.
+    :param accepted: whether gzip is accepted.
+    """
+    assert accepts_encoding(header, "gzip") is accepted
+
+
+async def respond(response: ResultFileResponse, headers: dict[str, str], method: str = "GET") -> tuple[int, dict[str, str], bytes]:
+    """Run a response and return its status, headers and body."""
+    scope = {
+        "type": "http",
+        "method": method,
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    }
+    messages: list[Message] = []
+
+    async def receive() -> Message:
+        return {"type": "http.disconnect"}
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    await response(scope, receive, send)
+    start = messages[0]
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], {name.decode(): value.decode() for name, value in start["headers"]}, body
+
+
+@pytest.fixture
+def file_path(tmp_path: Path) -> Path:
+    """
+    A result file.
+
+    :param tmp_path: temporary directory.
+    :return: path of the file.
+    """
+    path = tmp_path / "weights.bin"
+    path.write_bytes(CONTENT)
+    return path
+
+
+@pytest.mark.anyio
+async def test_file_response_ranges(file_path: Path) -> None:
+    """
+    Checks whole, single range, multiple range and unsatisfiable range responses.
+
+    :param file_path: result file.
+    """
+    sha256 = "a" * 64
+    status, headers, body = await respond(ResultFileResponse(str(file_path), "weights.bin", sha256=sha256), {})
+    assert (status, body) == (200, CONTENT)
+    assert headers["etag"] == f'"{sha256}"'
+    assert headers["accept-ranges"] == "bytes"
+
+    status, headers, body = await respond(ResultFileResponse(str(file_path), "weights.bin"), {"range": "bytes=10-19"})
+    assert (status, body) == (206, CONTENT[10:20])
+    assert headers["content-range"] == f"bytes 10-19/{len(CONTENT)}"
+
+    status, headers, body = await respond(ResultFileResponse(str(file_path), "weights.bin"), {"range": "bytes=0-1,-2"})
+    assert status == 206
+    boundary = headers["content-type"].split("boundary=")[1]
+    assert int(headers["content-length"]) == len(body)
+    assert body.startswith(f"--{boundary}\r\n".encode())
+    assert body.endswith(f"\r\n--{boundary}--\r\n".encode())
+    assert CONTENT[:2] in body and CONTENT[-2:] in body
+
+    status, headers, _ = await respond(ResultFileResponse(str(file_path), "weights.bin"), {"range": "bytes=5000-"})
+    assert status == 416
+    assert headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+    status, _, body = await respond(ResultFileResponse(str(file_path), "weights.bin"), {"range": "bytes=0-9"}, method="HEAD")
+    assert (status, body) == (206, b"")
+
+
+@pytest.mark.anyio
+async def test_file_response_validators(file_path: Path) -> None:
+    """
+    Checks conditional requests and If-Range.
+
+    :param file_path: result file.
+    """
+    response = ResultFileResponse(str(file_path), "weights.bin", sha256="b" * 64)
+    etag, last_modified = response.etag, response.last_modified
+    status, _, body = await respond(response, {"if-none-match": f'"x", {etag}'})
+    assert (status, body) == (304, b"")
+    status, _, _ = await respond(ResultFileResponse(str(file_path), "weights.bin"), {"if-modified-since": last_modified})
+    assert status == 304
+
+    # A range of a file that changed since is answered with the whole file
+    status, _, body = await respond(
+        ResultFileResponse(str(file_path), "weights.bin", sha256="b" * 64), {"range": "bytes=0-9", "if-range": '"old"'},
+    )
+    assert (status, body) == (200, CONTENT)
+    status, _, body = await respond(
+        ResultFileResponse(str(file_path), "weights.bin", sha256="b" * 64), {"range": "bytes=0-9", "if-range": etag},
+    )
+    assert (status, body) == (206, CONTENT[:10])
+
+
+@pytest.mark.anyio
+async def test_file_response_compressed(tmp_path: Path) -> None:
+    """
+    Checks that a file stored compressed is sent as is or decompressed, by Accept-Encoding.
+
+    :param tmp_path: temporary directory.
+    """
+    path = tmp_path / "train.log"
+    stored = gzip.compress(CONTENT)
+    path.write_bytes(stored)
+
+    def response() -> ResultFileResponse:
+        return ResultFileResponse(str(path), "train.log", sha256="c" * 64, encoding="gzip", content_size=len(CONTENT))
+
+    status, headers, body = await respond(response(), {"accept-encoding": "gzip"})
+    assert (status, body) == (200, stored)
+    assert headers["content-encoding"] == "gzip"
+    assert headers["etag"] == f'"{"c" * 64}-gzip"'
+
+    status, headers, body = await respond(response(), {"range": "bytes=0-9"})
+    assert (status, body) == (200, CONTENT)
+    assert "content-encoding" not in headers
+    assert headers["accept-ranges"] == "none"
+    assert headers["content-length"] == str(len(CONTENT))
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import AsyncIterator
+
+import pytest
+from fastapi import HTTPException
+
+from server.web.api.jobs.uploads import UploadSession, merge_ranges, remove_stale_sessions
+
+CONTENT = os.urandom(100_000)
+
+
+async def body(data: bytes, chunk_size: int = 4096, fail_after: int | None = None) -> AsyncIterator[bytes]:
+    """A request body in chunks, dropping the connection after `fail_after` bytes."""
+    for start in range(0, len(data), chunk_size):
+        if fail_after is not None and start >= fail_after:
+            raise ConnectionError("Connection dropped")
+        yield data[start:start + chunk_size]
+
+
+def test_merge_ranges() -> None:
+    """Checks that received ranges are sorted and merged when they touch or overlap."""
+    assert merge_ranges([[50, 60], [0, 10], [10, 20], [15, 30], [70, 80]]) == [[0, 30], [50, 60], [70, 80]]
+    assert merge_ranges([]) == []
+
+
+@pytest.mark.anyio
+async def test_resume_and_finalize(tmp_path: Path) -> None:
+    """
+    Checks that an upload resumes after a dropped connection, in parallel chunks, and is moved once complete.
+
+    :param tmp_path: temporary directory.
+    """
+    uploads_dir = tmp_path / ".uploads"
+    session = UploadSession.create(uploads_dir, "../data/test.npy", len(CONTENT), hashlib.sha256(CONTENT).hexdigest())
+    half = len(CONTENT) // 2
+
+    with pytest.raises(ConnectionError):
+        await session.write(0, body(CONTENT[:half], fail_after=3 * 4096))
+    status = UploadSession.open(uploads_dir, session.id).status()
+    assert status["offset"] == 3 * 4096
+    assert not status["complete"]
+
+    with pytest.raises(HTTPException) as error:
+        await session.finalize(tmp_path / "job", None)
+    assert error.value.status_code == 409
+
+    # The second half and the rest of the first one are sent at once
+    await asyncio.gather(
+        session.write(half, body(CONTENT[half:])),
+        session.write(3 * 4096, body(CONTENT[3 * 4096:half])),
+    )
+    status = session.status()
+    assert status["received"] == [[0, len(CONTENT)]]
+    assert status["complete"]
+
+    path, digest = await session.finalize(tmp_path / "job", None)
+    assert path == tmp_path / "job" / "data" / "test.npy"
+    assert path.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert not session.dir.exists()
+    with pytest.raises(HTTPException) as error:
+        UploadSession.open(uploads_dir, session.id)
+    assert error.value.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_write_past_size(tmp_path: Path) -> None:
+    """
+    Checks that chunks outside of the announced size are refused.
+
+    :param tmp_path: temporary directory.
+    """
+    session = UploadSession.create(tmp_path, "test.csv", 10, None)
+    with pytest.raises(HTTPException) as error:
+        await session.write(11, body(b"x"))
+    assert error.value.status_code == 416
+    with pytest.raises(HTTPException) as error:
+        await session.write(5, body(b"0123456789"))
+    assert error.value.status_code == 416
+    assert session.status()["received"] == []
+
+
+@pytest.mark.anyio
+async def test_finalize_hash_mismatch(tmp_path: Path) -> None:
+    """
+    Checks that a complete upload whose hash does not match is refused and kept.
+
+    :param tmp_path: temporary directory.
+    """
+    session = UploadSession.create(tmp_path / ".uploads", "test.csv", 4, None)
+    await session.write(0, body(b"a,b\n"))
+    with pytest.raises(HTTPException) as error:
+        await session.finalize(tmp_path / "job", "0" * 64)
+    assert error.value.status_code == 422
+    assert session.data_path.exists()
+
+
+def test_remove_stale_sessions(tmp_path: Path) -> None:
+    """
+    Checks that only sessions idle for longer than the TTL are removed.
+
+    :param tmp_path: temporary directory.
+    """
+    stale = UploadSession.create(tmp_path, "old.csv", 1, None)
+    fresh = UploadSession.create(tmp_path, "new.csv", 1, None)
+    meta = stale.meta()
+    meta["modified"] = time.time() - 3600
+    stale.meta_path.write_text(json.dumps(meta))
+    remove_stale_sessions(tmp_path, ttl=60)
+    assert not stale.dir.exists()
+    assert fresh.dir.exists()
@@ -1,6 +1,7 @@
 """Routes for jobs API."""
 import datetime
 from enum import Enum
+import hashlib
 import os
 from pathlib import Path
 from typing import Annotated, Any, Optional
@@ -9,14 +10,20 @@ import uuid
 import asyncio
 import aiofiles
 from fastapi import APIRouter, File, HTTPException, Request, UploadFile
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from server.db.models.datasets import Dataset
 from server.db.models.jobs import Job
 from server.db.models.ml_models import Model
+from server.db.models.pipelines import Pipeline
 from server.db.models.results import Result
+from server.services.cas import link_upload, owns_object, store_upload
+from server.services.retention import ensure_hot
+from server.services.storage import StorageError, ensure_local
 from server.settings import settings
-from server.web.api.jobs.utils import setup_environment, stop_job_processes, train_model, test_model, remove_job_env
+from server.web.api.jobs.utils import setup_environment, stop_job_processes, train_model, test_model, test_model_batch, remove_job_env, run_pipeline_stage
+from server.web.api.jobs.uploads import UploadSession, remove_stale_sessions
+from server.web.api.results.ingest import safe_relative_name
 from server.web.api.utils import job_get_dirs
 
 api_router = APIRouter()
@@ -63,7 +70,8 @@ class UseModel(BaseModel):
 
 class UseDataset(BaseModel):
     type: DatasetType
-    branch: Optional[str]
+    # Branch of the job dataset to test on, each one is checked out on its own
+    branch: Optional[str] = Field(None, regex=r"^[\w.][\w./-]*$")
     path: Optional[str]
 class TestModelIn(BaseModel):
     """Test model in"""
@@ -71,7 +79,27 @@ class TestModelIn(BaseModel):
     job_id: uuid.UUID
     parameters: dict[str, Any] = {}
     model: UseModel
-    dataset: UseDataset
+    dataset: Optional[UseDataset]
+    # Test on all datasets in a single run, with a child result per dataset
+    datasets: list[UseDataset] = []
+
+class PipelineStageType(str,Enum):
+    train = "train"
+    test = "test"
+    export = "export"
+
+class PipelineStageIn(BaseModel):
+    """Pipeline stage in"""
+    type: PipelineStageType
+    name: str = ""
+    parameters: dict[str, Any] = {}
+    # Datasets of a test stage
+    datasets: list[UseDataset] = []
+
+class PipelineIn(BaseModel):
+    """Pipeline in"""
+    job_id: uuid.UUID
+    stages: list[PipelineStageIn]
 
 
 @api_router.get("", tags=["jobs"], summary="Get all jobs", response_model=list[Job])
@@ -227,26 +255,152 @@ async def run_train_model(
 async def upload_test_data(
     file: Annotated[UploadFile, File(description="Test data file")],
     job_id: uuid.UUID,
+    req: Request,
 ) -> str:
     """Upload test data for model."""
     dataset_id = uuid.uuid4()
     filename = file.filename
     if filename is None:
         raise HTTPException(status_code=400, detail="No file provided")
-    _, dataset_dir, _ = job_get_dirs(job_id=job_id, dataset_name=str(dataset_id), model_name="")
+    job_base_dir, dataset_dir, _ = job_get_dirs(job_id=job_id, dataset_name=str(dataset_id), model_name="")
     filepath = Path(f"{dataset_dir}/{filename}")
+    # Received next to the job, then kept once per content
+    partial_path = Path(f"{job_base_dir}/.uploads/{str(dataset_id)}.part")
+    partial_path.parent.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
     try:
-        async with aiofiles.open(filepath, "wb") as buffer:
+        async with aiofiles.open(partial_path, "wb") as buffer:
             while chunk := await file.read(CHUNK_SIZE):
+                digest.update(chunk)
                 await buffer.write(chunk)
+        if settings.cas_enabled:
+            await store_upload(partial_path, digest.hexdigest(), filepath, req.state.user_id)
+        else:
+            os.replace(partial_path, filepath)
     # Catch any errors and delete the file
     except Exception as e:
-        os.remove(filepath)
+        partial_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=str(e)) from e
     finally:
         await file.close()
     return Path(f"{str(dataset_id)}/{filename}").__str__()
 
+class UploadCheckIn(BaseModel):
+    """Upload check in"""
+
+    filename: str
+    size: int
+    sha256: str = Field(regex="^[0-9a-fA-F]{64}$")
+
+class UploadCheckResponse(BaseModel):
+    """Upload check response"""
+
+    exists: bool
+    # Test data path to use instead of uploading, when the content is already stored
+    path: Optional[str] = None
+
+@api_router.post("/upload/test/{job_id}/check", tags=["jobs", "models", "results"], summary="Check if test data was already uploaded")
+async def check_test_data(
+    job_id: uuid.UUID,
+    check_in: UploadCheckIn,
+    req: Request,
+) -> UploadCheckResponse:
+    """Check the hash of a file before uploading it, and add it as test data without uploading it when the user already stored its content."""
+    user_id = req.state.user_id
+    await Job.objects.get(id=job_id, owner_id=user_id)
+    filename = safe_relative_name(check_in.filename)
+    sha256 = check_in.sha256.lower()
+    if not settings.cas_enabled or not await owns_object(sha256, check_in.size, user_id):
+        return UploadCheckResponse(exists=False)
+    dataset_id = uuid.uuid4()
+    _, dataset_dir, _ = job_get_dirs(job_id=job_id, dataset_name=str(dataset_id), model_name="")
+    try:
+        await link_upload(sha256, Path(f"{dataset_dir}/{filename}"), user_id)
+    except FileNotFoundError:
+        # Collected since it was checked
+        return UploadCheckResponse(exists=False)
+    return UploadCheckResponse(exists=True, path=f"{str(dataset_id)}/{filename}")
+
+class UploadSessionIn(BaseModel):
+    """Upload session in"""
+
+    filename: str
+    size: int
+    sha256: Optional[str] = None
+
+class UploadFinalizeIn(BaseModel):
+    """Upload finalize in"""
+
+    sha256: Optional[str] = None
+
+async def job_uploads_dir(job_id: uuid.UUID, user_id: str) -> Path:
+    """Upload area of a job owned by the user"""
+    await Job.objects.get(id=job_id, owner_id=user_id)
+    job_base_dir, _, _ = job_get_dirs(job_id=job_id, dataset_name="", model_name="")
+    return Path(f"{job_base_dir}/.uploads")
+
+@api_router.post("/upload/test/{job_id}/sessions", tags=["jobs", "models", "results"], summary="Start a resumable test data upload")
+async def create_upload_session(
+    job_id: uuid.UUID,
+    upload_in: UploadSessionIn,
+    req: Request,
+) -> Any:
+    """Start a resumable test data upload."""
+    if upload_in.size < 0 or upload_in.size > settings.upload_max_size:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {settings.upload_max_size} bytes")
+    uploads_dir = await job_uploads_dir(job_id, req.state.user_id)
+    await asyncio.to_thread(remove_stale_sessions, uploads_dir, settings.upload_session_ttl)
+    session = await asyncio.to_thread(UploadSession.create, uploads_dir, upload_in.filename, upload_in.size, upload_in.sha256)
+    return session.status()
+
+@api_router.get("/upload/test/{job_id}/sessions/{session_id}", tags=["jobs", "models", "results"], summary="Get the received ranges of an upload")
+async def get_upload_session(
+    job_id: uuid.UUID,
+    session_id: uuid.UUID,
+    req: Request,
+) -> Any:
+    """Get the received ranges of an upload, to resume it."""
+    session = UploadSession.open(await job_uploads_dir(job_id, req.state.user_id), session_id)
+    return await asyncio.to_thread(session.status)
+
+@api_router.patch("/upload/test/{job_id}/sessions/{session_id}", tags=["jobs", "models", "results"], summary="Upload a chunk at an offset")
+async def upload_chunk(
+    job_id: uuid.UUID,
+    session_id: uuid.UUID,
+    offset: int,
+    req: Request,
+) -> Any:
+    """Write the request body at `offset` of the uploaded file."""
+    session = UploadSession.open(await job_uploads_dir(job_id, req.state.user_id), session_id)
+    return await session.write(offset, req.stream())
+
+@api_router.post("/upload/test/{job_id}/sessions/{session_id}/finalize", tags=["jobs", "models", "results"], summary="Finish a resumable upload")
+async def finalize_upload_session(
+    job_id: uuid.UUID,
+    session_id: uuid.UUID,
+    finalize_in: UploadFinalizeIn,
+    req: Request,
+) -> str:
+    """Verify the uploaded file and add it as test data, like a single request upload."""
+    session = UploadSession.open(await job_uploads_dir(job_id, req.state.user_id), session_id)
+    dataset_id = uuid.uuid4()
+    _, dataset_dir, _ = job_get_dirs(job_id=job_id, dataset_name=str(dataset_id), model_name="")
+    file_path, sha256 = await session.finalize(Path(dataset_dir), finalize_in.sha256)
+    if settings.cas_enabled:
+        await store_upload(file_path, sha256, file_path, req.state.user_id)
+    return str(file_path.relative_to(Path(dataset_dir).parent))
+
+@api_router.delete("/upload/test/{job_id}/sessions/{session_id}", tags=["jobs", "models", "results"], summary="Abort a resumable upload")
+async def delete_upload_session(
+    job_id: uuid.UUID,
+    session_id: uuid.UUID,
+    req: Request,
+) -> str:
+    """Abort a resumable upload."""
+    session = UploadSession.open(await job_uploads_dir(job_id, req.state.user_id), session_id)
+    await asyncio.to_thread(session.remove)
+    return f"Upload session {session_id} removed"
+
 @api_router.post("/test", tags=["jobs", "models", "results"], summary="Run job to test model")
 async def run_test_model(
     test_model_in: TestModelIn,
@@ -261,17 +415,14 @@ async def run_test_model(
         raise HTTPException(status_code=400, detail=f"Job {test_model_in.job_id} is not ready")
     job = await Job.objects.get(id=test_model_in.job_id)
 
-    if test_model_in.dataset.path is None:
-        dataset = await Dataset.objects.get(id=job.dataset_id, private=False)
-        if dataset is None and user_id is not None:
-            dataset = await Dataset.objects.get(id=job.dataset_id, private=True, owner_id=user_id)
-            if dataset is None:
-                raise HTTPException(status_code=404, detail=f"Dataset {job.dataset_id} not found")
-        _,dataset_path,_ = job_get_dirs(job_id=job.id, dataset_name=dataset.git_name, model_name="")
-    else:
-        test_dataset_parent = Path(test_model_in.dataset.path).parent.__str__()
-        _,dataset_path,_ = job_get_dirs(job_id=job.id, dataset_name=test_dataset_parent, model_name="")
-        dataset_path = Path(f"{dataset_path}/{test_model_in.dataset.path.split('/')[-1]}").__str__()
+    if test_model_in.dataset is not None and test_model_in.datasets:
+        raise HTTPException(status_code=400, detail="Provide either dataset or datasets, not both")
+    use_datasets = test_model_in.datasets
+    if not use_datasets:
+        if test_model_in.dataset is None:
+            raise HTTPException(status_code=400, detail="No dataset provided")
+        use_datasets = [test_model_in.dataset]
+    datasets = [await resolve_test_dataset(job, use_dataset, user_id) for use_dataset in use_datasets]
     model = await Model.objects.get(id=job.model_id, private=False)
     if model is None and user_id is not None:
         model = await Model.objects.get(id=job.model_id, private=True, owner_id=user_id)
@@ -287,27 +438,100 @@ async def run_test_model(
             train_result = await Result.objects.get(id=result_id)
             job_base_dir,_,_ = job_get_dirs(job_id=job.id, dataset_name="", model_name="")
             pretrained_model_path = f"{job_base_dir}/{str(train_result.id)}/{train_result.pretrained_model}"
+            # The model may have been trained on another node, or archived since
+            try:
+                await ensure_hot(train_result)
+                await ensure_local(pretrained_model_path)
+            except (FileNotFoundError, StorageError):
+                raise HTTPException(status_code=404, detail=f"Pretrained model of result {result_id} not found")
         case ModelType.custom:
             # model = await Model.objects.get(id=job.model_id)
             # pretrained_model_path = settings.results_dir + "/" + model.path
             raise HTTPException(status_code=400, detail="Custom model not supported yet")
     loop = asyncio.get_event_loop()
-    loop.create_task(test_model(
-        dataset_path=dataset_path,
-        job=job,
-        model=model,
-        result_name=test_model_in.name,
-        parameters=test_model_in.parameters,
-        pretrained_model=pretrained_model_path,
-        dataset_branch=test_model_in.dataset.branch,
-        model_branch=test_model_in.model.branch,
-        user_token=user_token,
-        dataset_type=test_model_in.dataset.type,
-        model_type=test_model_in.model.type,
-    ))
+    if test_model_in.datasets:
+        loop.create_task(test_model_batch(
+            datasets=datasets,
+            job=job,
+            model=model,
+            result_name=test_model_in.name,
+            parameters=test_model_in.parameters,
+            pretrained_model=pretrained_model_path,
+            user_token=user_token,
+        ))
+    else:
+        dataset_type, dataset_path, dataset_branch = datasets[0]
+        loop.create_task(test_model(
+            dataset_path=dataset_path,
+            job=job,
+            model=model,
+            result_name=test_model_in.name,
+            parameters=test_model_in.parameters,
+            pretrained_model=pretrained_model_path,
+            dataset_branch=dataset_branch,
+            model_branch=test_model_in.model.branch,
+            user_token=user_token,
+            dataset_type=dataset_type,
+            model_type=test_model_in.model.type,
+        ))
     job.ready = False
     job.modified = datetime.datetime.now()
     await job.update()
     return "Testing model"
 
+@api_router.post("/pipeline", tags=["jobs", "models", "results"], summary="Run a pipeline of stages on a job")
+async def run_pipeline(
+    pipeline_in: PipelineIn,
+    req: Request
+) -> Pipeline:
+    """Run a pipeline of stages on a job, each stage starts when the previous one is submitted."""
+    user_id = req.state.user_id
+    user_token = req.state.user_token
+    job = await Job.objects.get(id=pipeline_in.job_id, owner_id=user_id)
+    if not job.ready:
+        raise HTTPException(status_code=400, detail=f"Job {pipeline_in.job_id} is not ready")
+    if not pipeline_in.stages:
+        raise HTTPException(status_code=400, detail="Pipeline has no stages")
+    stages = []
+    for stage in pipeline_in.stages:
+        if stage.type == PipelineStageType.test and not stage.datasets:
+            raise HTTPException(status_code=400, detail="Test stage has no datasets")
+        stages.append({
+            "type": stage.type.value,
+            "name": stage.name,
+            "parameters": stage.parameters,
+            "datasets": [await resolve_test_dataset(job, use_dataset, user_id) for use_dataset in stage.datasets],
+        })
+    pipeline = await Pipeline.objects.create(
+        owner_id=user_id,
+        job=job,
+        stages=stages,
+    )
+    asyncio.create_task(run_pipeline_stage(pipeline, user_token=user_token))
+    job.ready = False
+    job.modified = datetime.datetime.now()
+    await job.update()
+    return pipeline
+
+@api_router.get("/pipeline/{pipeline_id}", tags=["jobs"], summary="Get a pipeline")
+async def get_pipeline(pipeline_id: uuid.UUID, req: Request) -> Pipeline:
+    """Get a pipeline with its stage timings."""
+    user_id = req.state.user_id
+    return await Pipeline.objects.get(id=pipeline_id, owner_id=user_id)
+
+async def resolve_test_dataset(job: Job, use_dataset: UseDataset, user_id: str | None) -> tuple[str, str, str | None]:
+    """Get the type, path and branch of a dataset to test on"""
+    if use_dataset.path is None:
+        dataset = await Dataset.objects.get(id=job.dataset_id, private=False)
+        if dataset is None and user_id is not None:
+            dataset = await Dataset.objects.get(id=job.dataset_id, private=True, owner_id=user_id)
+            if dataset is None:
+                raise HTTPException(status_code=404, detail=f"Dataset {job.dataset_id} not found")
+        _,dataset_path,_ = job_get_dirs(job_id=job.id, dataset_name=dataset.git_name, model_name="")
+    else:
+        test_dataset_parent = Path(use_dataset.path).parent.__str__()
+        _,dataset_path,_ = job_get_dirs(job_id=job.id, dataset_name=test_dataset_parent, model_name="")
+        dataset_path = Path(f"{dataset_path}/{use_dataset.path.split('/')[-1]}").__str__()
+    return use_dataset.type, dataset_path, use_dataset.branch if use_dataset.type == DatasetType.default else None
+
 # TODO: Add stop job route
@@ -0,0 +1,193 @@
+"""Resumable upload sessions for test data."""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator
+
+from fastapi import HTTPException
+
+from server.web.api.results.ingest import safe_relative_name
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def merge_ranges(ranges: list[list[int]]) -> list[list[int]]:
+    """Sort half-open byte ranges and merge the ones that touch or overlap"""
+    merged: list[list[int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class UploadSession:
+    """
+    A file uploaded in chunks sent at byte offsets, possibly in parallel.
+
+    Each session lives in `{job_base_dir}/.uploads/{session_id}` with the data
+    file, preallocated to the announced size, and a `session.json` sidecar
+    holding the byte ranges received so far. Chunks are written in place with
+    `pwrite`, and the sidecar is updated under a file lock, so any worker can
+    take any chunk. A dropped connection keeps what was written before it.
+    """
+
+    def __init__(self, uploads_dir: Path, session_id: uuid.UUID) -> None:
+        self.id = session_id
+        self.dir = uploads_dir / str(session_id)
+        self.data_path = self.dir / "data"
+        self.meta_path = self.dir / "session.json"
+        self.lock_path = self.dir / ".lock"
+
+    @classmethod
+    def create(cls, uploads_dir: Path, filename: str, size: int, sha256: str | None) -> "UploadSession":
+        """Create a session for a file of `size` bytes"""
+        session = cls(uploads_dir, uuid.uuid4())
+        session.dir.mkdir(parents=True)
+        with session.data_path.open("wb") as f:
+            f.truncate(size)
+        session._write_meta({
+            "filename": safe_relative_name(filename),
+            "size": size,
+            "sha256": sha256,
+            "received": [],
+            "modified": time.time(),
+        })
+        return session
+
+    @classmethod
+    def open(cls, uploads_dir: Path, session_id: uuid.UUID) -> "UploadSession":
+        """Open an existing session, 404 if it does not exist"""
+        session = cls(uploads_dir, session_id)
+        if not session.meta_path.exists():
+            raise HTTPException(status_code=404, detail=f"Upload session {session_id} not found")
+        return session
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with self.lock_path.open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_meta(self, meta: dict[str, Any]) -> None:
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, self.meta_path)
+
+    def meta(self) -> dict[str, Any]:
+        """The session sidecar"""
+        return json.loads(self.meta_path.read_text())
+
+    def status(self) -> dict[str, Any]:
+        """Size, received ranges and the offset up to which every byte was received"""
+        meta = self.meta()
+        received = meta["received"]
+        offset = received[0][1] if received and received[0][0] == 0 else 0
+        return {
+            "session_id": self.id,
+            "filename": meta["filename"],
+            "size": meta["size"],
+            "offset": offset,
+            "received": received,
+            "complete": offset == meta["size"],
+        }
+
+    def _record(self, start: int, end: int) -> None:
+        if end <= start:
+            return
+        with self._locked():
+            meta = self.meta()
+            meta["received"] = merge_ranges([*meta["received"], [start, end]])
+            meta["modified"] = time.time()
+            self._write_meta(meta)
+
+    async def write(self, offset: int, chunks: AsyncIterator[bytes]) -> dict[str, Any]:
+        """
+        Write a chunk streamed from the request at `offset`.
+
+        Parameters:
+        - offset (int): Where the chunk starts in the file.
+        - chunks (AsyncIterator[bytes]): The request body.
+
+        Returns:
+        - dict[str, Any]: The session status after the write.
+
+        Raises:
+        - HTTPException: If the chunk goes past the announced size.
+        """
+        size = self.meta()["size"]
+        if offset < 0 or offset > size:
+            raise HTTPException(status_code=416, detail=f"Offset {offset} is outside of the file")
+        position = offset
+        fd = os.open(self.data_path, os.O_WRONLY)
+        try:
+            async for data in chunks:
+                if position + len(data) > size:
+                    raise HTTPException(status_code=416, detail=f"Chunk at offset {offset} goes past the file size {size}")
+                await asyncio.to_thread(os.pwrite, fd, data, position)
+                position += len(data)
+        finally:
+            os.close(fd)
+            # Keep what was written even if the connection dropped, the client resumes from there
+            await asyncio.to_thread(self._record, offset, position)
+        return await asyncio.to_thread(self.status)
+
+    def _hash(self) -> str:
+        digest = hashlib.sha256()
+        with self.data_path.open("rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    async def finalize(self, destination_dir: Path, sha256: str | None) -> tuple[Path, str]:
+        """
+        Verify the upload and move the file to `destination_dir`.
+
+        Returns:
+        - tuple[Path, str]: Path of the file and its SHA-256.
+
+        Raises:
+        - HTTPException: If bytes are missing or the hash does not match.
+        """
+        status = await asyncio.to_thread(self.status)
+        if not status["complete"]:
+            raise HTTPException(status_code=409, detail=f"Upload is incomplete, received {status['received']}")
+        expected = sha256 or self.meta()["sha256"]
+        digest = await asyncio.to_thread(self._hash)
+        if expected is not None and expected.lower() != digest:
+            raise HTTPException(status_code=422, detail=f"SHA-256 mismatch, expected {expected} got {digest}")
+        file_path = destination_dir / status["filename"]
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self.data_path, file_path)
+        self.remove()
+        return file_path, digest
+
+    def remove(self) -> None:
+        """Delete the session and whatever it received"""
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def remove_stale_sessions(uploads_dir: Path, ttl: float) -> None:
+    """Delete sessions that received nothing for `ttl` seconds"""
+    if not uploads_dir.is_dir():
+        return
+    horizon = time.time() - ttl
+    for session_dir in uploads_dir.iterdir():
+        meta_path = session_dir / "session.json"
+        try:
+            modified = json.loads(meta_path.read_text())["modified"]
+        except (OSError, ValueError, KeyError):
+            modified = session_dir.stat().st_mtime
+        if modified < horizon:
+            shutil.rmtree(session_dir, ignore_errors=True)
@@ -1,20 +1,31 @@
 """UTILS FOR JOBS API"""
+import asyncio
 import datetime
+import json
 import os
 from pathlib import Path
 import subprocess
 from typing import Any
 import uuid
 from fastapi import HTTPException
+from ormar.exceptions import NoMatch
 
 from server.settings import settings
 from server.db.models.datasets import Dataset
 from server.db.models.jobs import Job
 from server.db.models.ml_models import Model
+from server.db.models.pipelines import Pipeline
+from server.db.models.result_files import ResultFile
 from server.db.models.results import Result
 import server.services.cog as cg
+from server.services.containers import ContainerError
+from server.services.manifest import index_result_files
+from server.services.retention import ensure_hot
+from server.services.storage import ensure_local, ensure_result_local
+from server.services.warm_pool import PoolKey, warm_pool
 
-from server.web.api.utils import job_get_dirs
+from server.web.api.results.utils import stream_zip
+from server.web.api.utils import get_files_in_path, job_get_dirs
 
 async def train_model(
     dataset: Dataset,
@@ -26,11 +37,13 @@ async def train_model(
     parameters: dict[str, Any] = {},
     dataset_branch: str | None = None,
     model_branch: str | None = None,
+    result_id: uuid.UUID | None = None,
+    prepare: bool = True,
     # layers: list[Layer] = []
 ) -> Result:
     """Train model with a provided dataset and store results"""
     job_base_dir, dataset_path, model_path = job_get_dirs(job.id, dataset.git_name, model.git_name)
-    result_id = uuid.uuid4()
+    result_id = result_id or uuid.uuid4()
     results_dir = f"{job_base_dir}/{str(result_id)}"
     os.makedirs(results_dir)
     config_path = f"{model_path}/config.train.txt"
@@ -51,9 +64,10 @@ async def train_model(
         match environment_type:
             case "docker":
                 try:
-                    await cg.prepare(job_id=job.id, dataset_name=dataset.git_name, model_name=model.git_name, dataset_type="default")
+                    if prepare:
+                        await cg.prepare(job_id=job.id, dataset_name=dataset.git_name, model_name=model.git_name, dataset_type="default")
                     update_config_file(config_path=config_path, parameters=parameters, results_dir=results_dir)
-                    await cg.run(
+                    run = await cg.run(
                         name="pymlab.train",
                         at=model_path,
                         result_id=result_id,
@@ -63,6 +77,7 @@ async def train_model(
                         dataset_dir=dataset_path,
                         job_id=job.id
                     )
+                    asyncio.create_task(supervise_run(run, result_id=result_id, results_dir=results_dir))
                 except subprocess.CalledProcessError as e:
                     await handle_subprocess_error(results_dir=results_dir, e=e, result=result, job=job)
             case _:
@@ -123,27 +138,200 @@ async def test_model(
                         model_name=model.git_name,
                         dataset_name=dataset_name,
                         results_dir=results_dir,
+                        dataset_branch=dataset_branch,
+                        model_branch=model_branch,
                     )
                     update_config_file(config_path=config_path, parameters=parameters, results_dir=results_dir)
-                    await cg.run(
+                    test_dataset_dir = dataset_path if dataset_type == "default" else str(Path(f"{results_dir}/{dataset_path.split('/')[-1]}"))
+                    await run_test(
                         name="pymlab.test",
-                        at=model_path,
+                        job=job,
+                        model_path=model_path,
+                        results_dir=results_dir,
                         result_id=result_id,
                         user_token=user_token,
-                        trained_model=pretrained_model,
-                        api_url=f"{settings.api_url}/results/submit",
-                        base_dir=job_base_dir,
-                        dataset_dir=dataset_path if dataset_type == "default" else str(Path(f"{results_dir}/{dataset_path.split('/')[-1]}")),
-                        job_id=job.id
+                        pretrained_model=pretrained_model,
+                        dataset_dir=test_dataset_dir,
+                    )
+                except subprocess.CalledProcessError as e:
+                    await handle_subprocess_error(results_dir=results_dir, e=e, result=result, job=job)
+            case _:
+                raise HTTPException(status_code=400, detail=f"Error Setting up Environment: {environment_type}")
+    except subprocess.CalledProcessError as e:
+        await handle_subprocess_error(results_dir=results_dir, e=e, result=result, job=job)
+    return result
+
+async def test_model_batch(
+    datasets: list[tuple[str, str, str | None]],
+    job: Job,
+    model: Model,
+    result_name: str,
+    user_token: str,
+    environment_type: str = "docker",
+    parameters: dict[str, Any] = {},
+    pretrained_model: str | None = None,
+    result_id: uuid.UUID | None = None,
+    prepare: bool = True,
+) -> Result:
+    """Test model on several datasets in a single run, with a child result per dataset"""
+    job_base_dir, _, model_path = job_get_dirs(job.id, "", model.git_name)
+    result_id = result_id or uuid.uuid4()
+    results_dir = f"{job_base_dir}/{str(result_id)}"
+    os.makedirs(results_dir)
+    config_path = f"{model_path}/config.test.txt"
+
+    result = await Result.objects.create(
+        id=result_id,
+        job=job,
+        dataset_id=job.dataset_id,
+        dataset_type="batch",
+        status="running",
+        result_type="test",
+        owner_id=job.owner_id,
+        parameters=parameters,
+        name=result_name,
+    )
+    children: list[Result] = []
+    try:
+        match environment_type:
+            case "docker":
+                try:
+                    default_dataset = await Dataset.objects.get(id=job.dataset_id)
+                    uses_default = any(
+                        dataset_type == "default" and branch is None for dataset_type, _, branch in datasets
+                    )
+                    # Only fetch the job dataset when a child tests on it, the model is always fetched
+                    if prepare:
+                        await cg.prepare(
+                            job_id=job.id,
+                            dataset_type="default" if uses_default else "none",
+                            model_name=model.git_name,
+                            dataset_name=default_dataset.git_name if uses_default else "",
+                        )
+                    batch = []
+                    for dataset_type, dataset_path, branch in datasets:
+                        if dataset_type == "default" and branch is not None:
+                            # Each branch has its own checkout, next to the one of the job
+                            dataset_path = cg.prepare_dataset_branch(job.id, default_dataset.git_name, branch)
+                        child_id = uuid.uuid4()
+                        child_dir = f"{job_base_dir}/{str(child_id)}"
+                        os.makedirs(child_dir)
+                        children.append(await Result.objects.create(
+                            id=child_id,
+                            job=job,
+                            dataset_id=job.dataset_id,
+                            dataset_type=dataset_type,
+                            status="running",
+                            result_type="test",
+                            owner_id=job.owner_id,
+                            parameters=parameters,
+                            name=f"{result_name} - {Path(dataset_path).name}",
+                            parent_id=result_id,
+                        ))
+                        if dataset_type == "upload":
+                            cg.linkfile(dataset_path, child_dir)
+                            dataset_path = f"{child_dir}/{Path(dataset_path).name}"
+                        batch.append({
+                            "result_id": str(child_id),
+                            "dataset": cg.replace_source_with_destination(dataset_path, job_base_dir),
+                        })
+                    # The run reads the datasets of the batch from this file and
+                    # submits the metrics of each one to its child result
+                    batch_file_path = f"{results_dir}/datasets.json"
+                    with open(batch_file_path, "w", encoding="utf-8") as f:
+                        json.dump(batch, f)
+                    update_config_file(config_path=config_path, parameters=parameters, results_dir=results_dir)
+                    await run_test(
+                        name="pymlab.test.batch",
+                        job=job,
+                        model_path=model_path,
+                        results_dir=results_dir,
+                        result_id=result_id,
+                        user_token=user_token,
+                        pretrained_model=pretrained_model,
+                        dataset_dir=batch_file_path,
                     )
                 except subprocess.CalledProcessError as e:
                     await handle_subprocess_error(results_dir=results_dir, e=e, result=result, job=job)
+                    await fail_child_results(children)
+                except HTTPException as e:
+                    # A dataset branch could not be fetched, nobody awaits this task to answer the error
+                    failure = subprocess.CalledProcessError(1, "prepare", output=b"", stderr=str(e.detail).encode("utf-8"))
+                    await handle_subprocess_error(results_dir=results_dir, e=failure, result=result, job=job)
+                    await fail_child_results(children)
             case _:
                 raise HTTPException(status_code=400, detail=f"Error Setting up Environment: {environment_type}")
     except subprocess.CalledProcessError as e:
         await handle_subprocess_error(results_dir=results_dir, e=e, result=result, job=job)
+        await fail_child_results(children)
     return result
 
+async def run_test(
+    name: str,
+    job: Job,
+    model_path: str,
+    results_dir: str,
+    result_id: uuid.UUID,
+    user_token: str,
+    dataset_dir: str,
+    pretrained_model: str | None = None,
+) -> None:
+    """Run a test on a warm container when one is available and answers, otherwise with cog train"""
+    job_base_dir, _, _ = job_get_dirs(job.id, "", "")
+    if settings.warm_pool_enabled:
+        key = PoolKey(job_id=str(job.id), commit=cg.head_commit(model_path))
+        warm_pool.record_demand(key, base_dir=job_base_dir)
+        inputs = cg.build_cog_inputs(
+            name=name,
+            dataset_dir=dataset_dir,
+            base_dir=job_base_dir,
+            result_id=result_id,
+            api_url=f"{settings.api_url}/results/submit",
+            user_token=user_token,
+            trained_model=pretrained_model,
+        )
+        try:
+            dispatched = await warm_pool.dispatch(key, inputs=inputs, logs_dir=Path(f"{results_dir}/logs"))
+        except (OSError, ValueError, ContainerError) as e:
+            # The container died, hung or answered garbage, its run is redone cold unless it submitted
+            print(f"Warm container failed the test of result {result_id}: {e}")
+            dispatched = (await Result.objects.get(id=result_id)).status != "running"
+        if dispatched:
+            await index_result_files(await Result.objects.get(id=result_id))
+            return
+    run = await cg.run(
+        name=name,
+        at=model_path,
+        result_id=result_id,
+        user_token=user_token,
+        trained_model=pretrained_model,
+        api_url=f"{settings.api_url}/results/submit",
+        base_dir=job_base_dir,
+        dataset_dir=dataset_dir,
+        job_id=job.id
+    )
+    asyncio.create_task(supervise_run(run, result_id=result_id, results_dir=results_dir))
+
+async def supervise_run(run: "asyncio.Future[None]", result_id: uuid.UUID, results_dir: str) -> None:
+    """Wait for a cog run to exit, record its failure if it did not submit, and index its files"""
+    try:
+        await run
+    except subprocess.CalledProcessError as e:
+        result = await Result.objects.select_related("job").get(id=result_id)
+        if result.status == "running":
+            await handle_subprocess_error(results_dir=results_dir, e=e, result=result, job=result.job)
+            await fail_child_results(await Result.objects.filter(parent_id=result_id).all())
+    result = await Result.objects.get(id=result_id)
+    await index_result_files(result)
+
+async def fail_child_results(children: list[Result]) -> None:
+    """Mark the child results of a failed batch test that were not submitted"""
+    for child in children:
+        if child.status == "running":
+            child.status = "error"
+            child.modified = datetime.datetime.now()
+            await child.update()
+
 async def setup_environment(
     job_id: uuid.UUID,
     dataset_name: str,
@@ -214,6 +402,7 @@ def stop_job_processes(job_id: uuid.UUID, environment_type: str = "docker") -> N
     match environment_type:
         case "docker":
             cg.stop(job_id=job_id)
+            warm_pool.discard_job(job_id)
         case _:
             raise HTTPException(status_code=400, detail=f"Error stoping jobs for Environment: {environment_type}")
 
@@ -224,6 +413,8 @@ def remove_job_env(job_id: uuid.UUID, dataset_name: str, model_name: str, enviro
     match environment_type:
         case "docker":
             cg.remove(job_id=job_id, dataset_name=dataset_name, model_name=model_name)
+            cg.stop(job_id=job_id)
+            warm_pool.discard_job(job_id)
             cg.remove_docker(job_id=job_id)
         case _:
             raise HTTPException(status_code=400, detail=f"Error removing Environment: {environment_type}")
@@ -267,3 +458,137 @@ async def handle_subprocess_error(
     job.modified = datetime.datetime.now()
     await result.update()
     await job.update()
+    await advance_pipeline(result, user_token="")
+
+def uses_job_dataset(stage: dict[str, Any]) -> bool:
+    """Whether a pipeline stage runs on the checkout of the job dataset"""
+    if stage["type"] == "train":
+        return True
+    if stage["type"] == "test":
+        return any(entry[0] == "default" and (len(entry) < 3 or entry[2] is None) for entry in stage["datasets"])
+    return False
+
+async def run_pipeline_stage(pipeline: Pipeline, user_token: str) -> None:
+    """Start the current stage of a pipeline"""
+    job = await Job.objects.get(id=pipeline.job.id)
+    model = await Model.objects.get(id=job.model_id)
+    dataset = await Dataset.objects.get(id=job.dataset_id)
+    stage = pipeline.stages[pipeline.current_stage]
+    result_id = uuid.uuid4()
+    pipeline.current_result_id = result_id
+    pipeline.timings = [*pipeline.timings, {
+        "type": stage["type"],
+        "result_id": str(result_id),
+        "started": datetime.datetime.now().isoformat(),
+        "finished": None,
+        "seconds": None,
+    }]
+    pipeline.modified = datetime.datetime.now()
+    await pipeline.update()
+    job.ready = False
+    job.modified = datetime.datetime.now()
+    await job.update()
+    # The first stage fetches the repositories and later stages reuse the prepared workspace,
+    # unless they are the first to need the job dataset, like a train stage after tests on uploads
+    prepare = pipeline.current_stage == 0 or (
+        uses_job_dataset(stage)
+        and not any(uses_job_dataset(earlier) for earlier in pipeline.stages[:pipeline.current_stage])
+    )
+    match stage["type"]:
+        case "train":
+            await train_model(
+                dataset=dataset,
+                job=job,
+                model=model,
+                result_name=stage["name"],
+                parameters=stage["parameters"],
+                user_token=user_token,
+                result_id=result_id,
+                prepare=prepare,
+            )
+        case "test":
+            await test_model_batch(
+                # Stages stored before dataset branches hold type and path only
+                datasets=[(entry[0], entry[1], entry[2] if len(entry) > 2 else None) for entry in stage["datasets"]],
+                job=job,
+                model=model,
+                result_name=stage["name"],
+                parameters=stage["parameters"],
+                pretrained_model=await pipeline_pretrained_model(pipeline, job, model),
+                user_token=user_token,
+                result_id=result_id,
+                prepare=prepare,
+            )
+        case "export":
+            job_base_dir, _, _ = job_get_dirs(job.id, "", "")
+            result_dirs = []
+            for timing in pipeline.timings[:-1]:
+                result_dirs.append(f"{job_base_dir}/{timing['result_id']}")
+                children = await Result.objects.filter(parent_id=uuid.UUID(timing["result_id"])).all()
+                result_dirs.extend(f"{job_base_dir}/{str(child.id)}" for child in children)
+            for result_dir in result_dirs:
+                # Results of the pipeline may have run on other nodes, or been archived since
+                await ensure_hot(await Result.objects.get(id=uuid.UUID(Path(result_dir).name)))
+                entries = await ResultFile.objects.filter(result=uuid.UUID(Path(result_dir).name)).all()
+                await ensure_result_local(Path(result_dir), [entry.name for entry in entries])
+            await asyncio.to_thread(
+                export_results,
+                result_dirs=result_dirs,
+                zip_file_path=f"{job_base_dir}/exports/{str(pipeline.id)}.zip",
+            )
+            job.ready = True
+            job.modified = datetime.datetime.now()
+            await job.update()
+            await finish_pipeline_stage(pipeline, status="done", user_token=user_token)
+
+async def pipeline_pretrained_model(pipeline: Pipeline, job: Job, model: Model) -> str:
+    """Get the model trained by the last train stage of a pipeline, or the default model"""
+    job_base_dir, _, model_path = job_get_dirs(job.id, "", model.git_name)
+    for timing in reversed(pipeline.timings):
+        if timing["type"] == "train":
+            train_result = await Result.objects.get(id=uuid.UUID(timing["result_id"]))
+            # The train stage may have run on another node, or been archived since
+            await ensure_hot(train_result)
+            return str(await ensure_local(f"{job_base_dir}/{str(train_result.id)}/{train_result.pretrained_model}"))
+    return f"{model_path}/{model.default_model}"
+
+async def finish_pipeline_stage(pipeline: Pipeline, status: str, user_token: str) -> None:
+    """Record the timing of the current stage and start the next one"""
+    finished = datetime.datetime.now()
+    timing = dict(pipeline.timings[-1])
+    timing["finished"] = finished.isoformat()
+    timing["seconds"] = (finished - datetime.datetime.fromisoformat(timing["started"])).total_seconds()
+    pipeline.timings = [*pipeline.timings[:-1], timing]
+    pipeline.modified = finished
+    if status != "done":
+        pipeline.status = "error"
+        await pipeline.update()
+        return
+    pipeline.current_stage += 1
+    if pipeline.current_stage >= len(pipeline.stages):
+        pipeline.status = "done"
+        pipeline.current_result_id = None  # type: ignore[assignment]
+        await pipeline.update()
+        return
+    await pipeline.update()
+    await run_pipeline_stage(pipeline, user_token)
+
+async def advance_pipeline(result: Result, user_token: str) -> None:
+    """Continue the pipeline whose current stage produced this result, if any"""
+    try:
+        pipeline = await Pipeline.objects.select_related("job").get(current_result_id=result.id, status="running")
+    except NoMatch:
+        return
+    await finish_pipeline_stage(pipeline, status=result.status, user_token=user_token)
+
+def export_results(result_dirs: list[str], zip_file_path: str) -> None:
+    """Write the files of results into a zip, in a folder per result"""
+    os.makedirs(Path(zip_file_path).parent, exist_ok=True)
+    files = [
+        (f"{result_dir}/{file}", f"{Path(result_dir).name}/{file}")
+        for result_dir in result_dirs
+        for file in get_files_in_path(Path(result_dir))
+    ]
+    with open(zip_file_path, "wb") as zip_file:
+        for chunk in stream_zip(files):
+            zip_file.write(chunk)
@@ -1,5 +1,6 @@
 
 from typing import Any
+import uuid
 from pydantic import BaseModel
 
 
@@ -19,3 +20,16 @@ class ModelResponse(BaseModel):
     layers: list[dict[str, Any]] = []
     files: list[Any] = []
     # tags: list = []
+
+
+class PredictIn(BaseModel):
+    """Predict in"""
+
+    result_id: uuid.UUID
+    inputs: list[Any]
+
+
+class PredictResponse(BaseModel):
+    """Predict response"""
+
+    outputs: list[Any]
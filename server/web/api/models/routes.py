@@ -7,8 +7,12 @@ from pydantic import BaseModel
 from fastapi import APIRouter, HTTPException, Request
 
 from server.db.models.ml_models import Model
-from server.web.api.models.dto import ModelResponse
+from server.db.models.results import Result
+from server.web.api.models.dto import ModelResponse, PredictIn, PredictResponse
+from server.services.containers import ContainerError
 from server.services.git import GitService, RepoNotFoundError, RepoTypes
+from server.services.predictors import PredictionError, QueueFullError, predictor_for_result, predictors
+from server.settings import settings
 
 api_router = APIRouter()
 
@@ -114,3 +118,32 @@ async def delete_model(model_id: str, req: Request) -> None:
     git = GitService()
     git.delete_repo(model.git_name)
     return None
+
+@api_router.get("/predictors/stats", tags=["models"], summary="Get live predictors cache metrics")
+async def get_predictors_stats() -> dict[str, Any]:
+    """Get live predictors cache metrics."""
+    return predictors.stats()
+
+@api_router.post("/{model_id}/predict", tags=["models", "results"], summary="Predict with a trained model")
+async def predict(model_id: str, predict_in: PredictIn, req: Request) -> PredictResponse:
+    """Predict with a trained model."""
+    user_id = req.state.user_id
+    model_uuid = uuid.UUID(model_id)
+    result = await Result.objects.select_related("job").get(id=predict_in.result_id, owner_id=user_id)
+    if result.job.model_id != model_uuid:
+        raise HTTPException(status_code=400, detail=f"Result {predict_in.result_id} was not trained on model {model_id}")
+    if result.status != "done" or result.pretrained_model is None:
+        raise HTTPException(status_code=400, detail=f"Result {predict_in.result_id} has no trained model")
+    if len(predict_in.inputs) > settings.predictor_max_queue:
+        raise HTTPException(status_code=413, detail=f"At most {settings.predictor_max_queue} inputs are predicted per request")
+    model = await Model.objects.get(id=model_uuid)
+    try:
+        predictor = await predictor_for_result(model, result)
+        outputs = await predictor.predict_many(predict_in.inputs)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"}) from e
+    except ContainerError as e:
+        raise HTTPException(status_code=502, detail=f"Predictor could not be started: {str(e)}") from e
+    except PredictionError as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    return PredictResponse(outputs=list(outputs))
@@ -0,0 +1,162 @@
+"""Streaming parser for result submissions."""
+import hashlib
+from pathlib import Path, PurePosixPath
+from typing import Any, NamedTuple
+
+import aiofiles  # type: ignore[import]
+import multipart
+from fastapi import HTTPException, Request
+from multipart.multipart import parse_options_header
+
+
+class SubmittedFile(NamedTuple):
+    """A file part written to the staging directory"""
+
+    field_name: str
+    name: str
+    staged_path: Path
+    size: int
+    sha256: str
+
+
+class SubmitForm(NamedTuple):
+    """Fields and staged files of a submission"""
+
+    fields: dict[str, str]
+    files: list[SubmittedFile]
+
+
+class _Part:
+    def __init__(self) -> None:
+        self.headers: list[tuple[bytes, bytes]] = []
+        self.field_name = ""
+        self.filename: str | None = None
+        # Fields grow in place, appending to bytes would copy them on every chunk
+        self.data = bytearray()
+        self.size = 0
+        self.digest: Any = None
+        self.file: Any = None
+        self.staged_path: Path | None = None
+
+
+def safe_relative_name(filename: str) -> str:
+    """Keep an uploaded file name inside the result directory"""
+    parts = [part for part in PurePosixPath(filename.replace("\\", "/")).parts if part not in ("/", ".", "..")]
+    if not parts:
+        raise HTTPException(status_code=400, detail=f"Invalid file name {filename}")
+    return "/".join(parts)
+
+
+class SubmitFormParser:
+    """
+    Parse a multipart submission while it is received.
+
+    Each file part is written in chunks straight to its own file in
+    `staging_dir` and hashed on the way, so a checkpoint never sits in
+    memory. The staging directory is on the results volume, so moving the
+    files to the result directory afterwards is a rename.
+    """
+
+    def __init__(self, staging_dir: Path, max_part_size: int, max_field_size: int) -> None:
+        self.staging_dir = staging_dir
+        self.max_part_size = max_part_size
+        self.max_field_size = max_field_size
+        self.fields: dict[str, str] = {}
+        self.files: list[SubmittedFile] = []
+        self._part = _Part()
+        self._header_field = b""
+        self._header_value = b""
+        self._events: list[tuple[str, _Part, bytes]] = []
+        self._opened: list[_Part] = []
+
+    def on_part_begin(self) -> None:
+        self._part = _Part()
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._part.headers.append((self._header_field.lower(), self._header_value))
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        disposition = dict(self._part.headers).get(b"content-disposition", b"")
+        _, options = parse_options_header(disposition)
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail='The Content-Disposition header field "name" must be provided.')
+        self._part.field_name = options[b"name"].decode("utf-8")
+        if b"filename" in options:
+            self._part.filename = safe_relative_name(options[b"filename"].decode("utf-8"))
+            self._events.append(("open", self._part, b""))
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        part = self._part
+        part.size += end - start
+        if part.filename is None:
+            if part.size > self.max_field_size:
+                raise HTTPException(status_code=413, detail=f"Field {part.field_name} is too large")
+            part.data.extend(data[start:end])
+            return
+        if part.size > self.max_part_size:
+            raise HTTPException(status_code=413, detail=f"File {part.filename} is too large")
+        self._events.append(("data", part, data[start:end]))
+
+    def on_part_end(self) -> None:
+        if self._part.filename is None:
+            self.fields[self._part.field_name] = self._part.data.decode("utf-8")
+        else:
+            self._events.append(("close", self._part, b""))
+
+    async def _flush(self) -> None:
+        """Write the file data received so far, off the event loop."""
+        for event, part, data in self._events:
+            if event == "open":
+                part.staged_path = self.staging_dir / str(len(self._opened))
+                part.digest = hashlib.sha256()
+                part.file = await aiofiles.open(part.staged_path, "wb")
+                self._opened.append(part)
+            elif event == "data":
+                part.digest.update(data)
+                await part.file.write(data)
+            else:
+                await part.file.close()
+                part.file = None
+                self.files.append(SubmittedFile(
+                    field_name=part.field_name,
+                    name=part.filename or part.field_name,
+                    staged_path=part.staged_path,  # type: ignore[arg-type]
+                    size=part.size,
+                    sha256=part.digest.hexdigest(),
+                ))
+        self._events.clear()
+
+    async def parse(self, request: Request) -> SubmitForm:
+        """Read the request body and return its fields and staged files."""
+        content_type, params = parse_options_header(request.headers.get("Content-Type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+        parser = multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                await self._flush()
+            parser.finalize()
+            await self._flush()
+        finally:
+            for part in self._opened:
+                if part.file is not None:
+                    await part.file.close()
+        return SubmitForm(fields=self.fields, files=self.files)
@@ -0,0 +1,290 @@
+"""File responses with validators and byte ranges for result downloads."""
+import mimetypes
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any
+
+import aiofiles  # type: ignore[import]
+import anyio
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from server.services.compression import open_stored
+
+CHUNK_SIZE = 1024 * 1024
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+
+
+def parse_range(header: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parse a Range header into sorted, merged, inclusive byte ranges.
+
+    Parameters:
+    - header (str): The Range header, like `bytes=0-99,200-`.
+    - size (int): The size of the file.
+
+    Returns:
+    - list[tuple[int, int]] | None: The ranges, an empty list when none can be
+      satisfied, or None when the header is invalid and must be ignored.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first == "":
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length == 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start > end and last:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    ranges.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def accepts_encoding(header: str | None, encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows a content coding."""
+    if not header:
+        return False
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() not in (encoding, "*"):
+            continue
+        quality = params.strip().removeprefix("q=")
+        try:
+            return not params or float(quality) > 0
+        except ValueError:
+            return False
+    return False
+
+
+class ResultFileResponse(Response):
+    """
+    Send a result file with ETag and Last-Modified validators.
+
+    Answers 304 to `If-None-Match` and `If-Modified-Since` requests that
+    match, 206 to single and multiple `Range` requests (honouring
+    `If-Range`) and 416 to ranges past the end of the file. The body is
+    sent with the ASGI zero-copy extension when the server offers it, so
+    the kernel copies the file with sendfile, otherwise in chunks.
+
+    Files stored compressed are sent as they are, with Content-Encoding, to
+    clients that accept their encoding, and decompressed on the fly, without
+    ranges, to the others.
+    """
+
+    # Always known, guessed from the file name
+    media_type: str
+
+    def __init__(
+        self,
+        path: str,
+        filename: str,
+        sha256: str | None = None,
+        encoding: str | None = None,
+        content_size: int | None = None,
+        background: BackgroundTask | None = None,
+    ) -> None:
+        self.background = background
+        self.raw_headers = []
+        self.path = path
+        self.filename = filename
+        self.stat = os.stat(path)
+        self.media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        # A strong ETag needs the content hash, otherwise fall back to a weak one
+        if sha256 is not None:
+            self.etag = f'"{sha256}"'
+        else:
+            self.etag = f'W/"{int(self.stat.st_mtime)}-{self.stat.st_size}"'
+        self.last_modified = formatdate(self.stat.st_mtime, usegmt=True)
+        self.encoding = encoding
+        self.content_size = content_size
+        self.decode = False
+
+    def _base_headers(self) -> list[tuple[bytes, bytes]]:
+        headers = [
+            (b"etag", self.etag.encode("latin-1")),
+            (b"last-modified", self.last_modified.encode("latin-1")),
+            (b"accept-ranges", b"none" if self.decode else b"bytes"),
+        ]
+        if self.encoding is not None:
+            headers.append((b"vary", b"Accept-Encoding"))
+        return headers
+
+    def _not_modified(self, headers: Headers) -> bool:
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag.removeprefix("W/") in tags
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                return int(self.stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _range_applies(self, headers: Headers) -> bool:
+        if_range = headers.get("if-range")
+        if if_range is None:
+            return True
+        if if_range.startswith('"'):
+            return not self.etag.startswith("W/") and if_range == self.etag
+        return if_range == self.last_modified
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self._respond(scope, send)
+        if self.background is not None:
+            await self.background()
+
+    async def _respond(self, scope: Scope, send: Send) -> None:
+        headers = Headers(scope=scope)
+        send_body = scope["method"] != "HEAD"
+        size = self.stat.st_size
+        if self.encoding is not None:
+            if accepts_encoding(headers.get("accept-encoding"), self.encoding):
+                # The stored bytes are another representation than the content, with their own tag
+                self.etag = self.etag[:-1] + f'-{self.encoding}"'
+            else:
+                self.decode = True
+        if self._not_modified(headers):
+            await send({"type": "http.response.start", "status": 304, "headers": self._base_headers()})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if self.decode:
+            await self._send_decoded(send, send_body)
+            return
+        ranges = None
+        if "range" in headers and self._range_applies(headers):
+            ranges = parse_range(headers["range"], size)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
+        if ranges == []:
+            await send({
+                "type": "http.response.start",
+                "status": 416,
+                "headers": [*self._base_headers(), (b"content-range", f"bytes */{size}".encode("latin-1"))],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+        response_headers = self._content_headers()
+        if self.encoding is not None:
+            response_headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        if ranges is None:
+            response_headers += [(b"content-type", self.media_type.encode("latin-1")), (b"content-length", str(size).encode("latin-1"))]
+            await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+            await self._send_parts(scope, send, [(b"", 0, size)] if send_body else [])
+            return
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response_headers += [
+                (b"content-type", self.media_type.encode("latin-1")),
+                (b"content-range", f"bytes {start}-{end}/{size}".encode("latin-1")),
+                (b"content-length", str(end - start + 1).encode("latin-1")),
+            ]
+            await send({"type": "http.response.start", "status": 206, "headers": response_headers})
+            await self._send_parts(scope, send, [(b"", start, end - start + 1)] if send_body else [])
+            return
+        boundary = uuid.uuid4().hex
+        parts = [
+            (
+                (
+                    f"--{boundary}\r\nContent-Type: {self.media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode("latin-1"),
+                start,
+                end - start + 1,
+            )
+            for start, end in ranges
+        ]
+        closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        # Every part but the first starts on a new line after the previous part's data
+        length = sum(len(head) + count for head, _, count in parts) + 2 * (len(parts) - 1) + len(closing)
+        response_headers += [
+            (b"content-type", f"multipart/byteranges; boundary={boundary}".encode("latin-1")),
+            (b"content-length", str(length).encode("latin-1")),
+        ]
+        await send({"type": "http.response.start", "status": 206, "headers": response_headers})
+        if send_body:
+            parts = [(head if i == 0 else b"\r\n" + head, start, count) for i, (head, start, count) in enumerate(parts)]
+            await self._send_parts(scope, send, parts, closing)
+        else:
+            await send({"type": "http.response.body", "body": b""})
+
+    def _content_headers(self) -> list[tuple[bytes, bytes]]:
+        return [
+            *self._base_headers(),
+            (b"content-disposition", f'attachment; filename="{os.path.basename(self.filename)}"'.encode("utf-8")),
+        ]
+
+    async def _send_decoded(self, send: Send, send_body: bool) -> None:
+        """Send the whole content of a file stored compressed, decompressing it in chunks."""
+        response_headers = [*self._content_headers(), (b"content-type", self.media_type.encode("latin-1"))]
+        if self.content_size is not None:
+            response_headers.append((b"content-length", str(self.content_size).encode("latin-1")))
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        if send_body:
+            f = await anyio.to_thread.run_sync(open_stored, self.path)
+            try:
+                while chunk := await anyio.to_thread.run_sync(f.read, CHUNK_SIZE):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            finally:
+                f.close()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_parts(
+        self,
+        scope: Scope,
+        send: Send,
+        parts: list[tuple[bytes, int, int]],
+        trailer: bytes = b"",
+    ) -> None:
+        """Send each part's header bytes followed by `count` bytes of the file from `offset`."""
+        zero_copy = "http.response.zerocopysend" in scope.get("extensions", {})
+        async with aiofiles.open(self.path, "rb") as f:
+            for head, offset, count in parts:
+                if head:
+                    await send({"type": "http.response.body", "body": head, "more_body": True})
+                if zero_copy:
+                    message: dict[str, Any] = {
+                        "type": "http.response.zerocopysend",
+                        "file": f.fileno(),
+                        "offset": offset,
+                        "count": count,
+                        "more_body": True,
+                    }
+                    await send(message)
+                    continue
+                await f.seek(offset)
+                remaining = count
+                while remaining > 0:
+                    chunk = await f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": trailer, "more_body": False})
@@ -4,17 +4,35 @@ import datetime
 import os
 from pathlib import Path
 import uuid
-import zipfile
 import json
-from typing import Any
-import starlette
-from fastapi import APIRouter, HTTPException, Request, UploadFile, WebSocket
-from fastapi.responses import FileResponse
+import re
+import shutil
+from typing import Any, AsyncIterator
+from fastapi import APIRouter, HTTPException, Query, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel # pylint: disable=no-name-in-module
+from ormar.exceptions import NoMatch
 from server.db.models.datasets import Dataset
 from server.db.models.ml_models import Model
 
+from server.db.models.result_files import ResultFile
 from server.db.models.results import Result
+from server.services.auth_bearer import verify_jwt
+from server.services.cas import cas_stats, dedupe_result
+from server.services.idempotency import MAX_KEY_LENGTH, claim_submit, complete_submit, release_submit
+from server.services.compression import stored_encoding
+from server.services.previews import preview_kind, preview_path, preview_pool
+from server.services.retention import ensure_hot
+from server.services.storage import StorageError, download_url, ensure_local, ensure_result_local, store_files
+from server.services.logs import LogReader
+from server.services.manifest import index_result_files
+from server.services.metrics import BufferFullError, Point, compare_results, metric_series, metrics_writer
+from server.services.predictions import PredictionsTable, is_stored, parse_filter, store_predictions
+from server.settings import settings
+from server.web.api.jobs.utils import advance_pipeline, fail_child_results
+from server.web.api.results.ingest import SubmitFormParser
+from server.web.api.results.responses import ResultFileResponse
+from server.web.api.results.utils import check_declared_artifacts, finish_batch_result, is_unchanged, log_messages, metrics_csv, stream_zip
 from server.web.api.utils import get_files_in_path, job_get_dirs
 
 
@@ -53,6 +71,8 @@ class ResultResponse(BaseModel):
 
         name: str
         size: int
+        # Kind of preview the file has, if any
+        preview: str | None = None
     size: int
     id: uuid.UUID
     owner_id: str
@@ -71,8 +91,100 @@ class ResultResponse(BaseModel):
     dataset_name: str
     dataset_description: str
     pretrained_model: str | None
+    pinned: bool = False
+    tier: str = "hot"
 
 
+@api_router.get("/storage", tags=["results"], summary="Get deduplication statistics of result artifacts")
+async def get_storage_stats(req: Request) -> Any:
+    """Get the objects of the content-addressed store the user put in, the bytes they save and the dedup ratio."""
+    return await cas_stats(req.state.user_id)
+
+@api_router.get("/export", tags=["results"], summary="Export results as a single archive")
+async def export_results_archive(
+    req: Request,
+    ids: list[uuid.UUID] = Query(default=[]),
+    job_id: uuid.UUID | None = None,
+) -> Any:
+    """
+    Stream one zip with a folder per result, `metrics.csv` with the metrics of every
+    result and `manifest.json` with the files of each result and their hashes.
+    """
+    if not ids and job_id is None:
+        raise HTTPException(status_code=400, detail="Give result ids or a job id")
+    query = Result.objects.select_related("job").filter(owner_id=req.state.user_id)
+    if ids:
+        query = query.filter(id__in=ids)
+    if job_id is not None:
+        query = query.filter(job=job_id)
+    results = await query.order_by("created").all()
+    if not results:
+        raise HTTPException(status_code=404, detail="No results to export")
+    entries = await ResultFile.objects.filter(result__in=[result.id for result in results]).order_by("name").all()
+    by_result: dict[uuid.UUID, list[ResultFile]] = {}
+    for entry in entries:
+        by_result.setdefault(entry.result.id, []).append(entry)
+    files: list[tuple[str, str]] = []
+    sizes: dict[str, int] = {}
+    manifest = []
+    for result in results:
+        jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
+        result_dir = Path(f"{jobs_base_dir}/{str(result.id)}")
+        result_entries = by_result.get(result.id, [])
+        await restore_files(result)
+        if not result_entries:
+            # Results submitted before manifests existed are indexed on first read
+            result_entries = await index_result_files(result)
+        # Files stored by another node are fetched first
+        await ensure_result_local(result_dir, [entry.name for entry in result_entries])
+        files.extend(
+            (str(result_dir / entry.name), f"{str(result.id)}/{entry.name}")
+            for entry in result_entries
+            if (result_dir / entry.name).is_file()
+        )
+        sizes.update((str(result_dir / entry.name), entry.size) for entry in result_entries)
+        manifest.append({
+            "id": str(result.id),
+            "name": result.name,
+            "job_id": str(result.job.id),
+            "result_type": result.result_type,
+            "status": result.status,
+            "files": [{"name": entry.name, "size": entry.size, "sha256": entry.sha256} for entry in result_entries],
+        })
+    members = [
+        ("metrics.csv", metrics_csv(results)),
+        ("manifest.json", json.dumps(manifest, indent=2).encode("utf-8")),
+    ]
+    name = f"job-{job_id}" if job_id is not None and not ids else f"results-{datetime.datetime.now():%Y%m%d-%H%M%S}"
+    return StreamingResponse(
+        stream_zip(files, members=members, workers=settings.export_read_workers, sizes=sizes),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{name}.zip"'},
+    )
+
+@api_router.get("/compare", tags=["results"], summary="Compare the metrics of results")
+async def compare(
+    req: Request,
+    ids: list[uuid.UUID] = Query(default=[]),
+    job_id: uuid.UUID | None = None,
+    model_id: uuid.UUID | None = None,
+    result_type: str | None = None,
+    metrics: list[str] = Query(default=[]),
+    limit: int = 500,
+) -> Any:
+    """Compare the metrics of the given results, or of the results of a job or model, with aggregates per metric."""
+    if not ids and job_id is None and model_id is None:
+        raise HTTPException(status_code=400, detail="Provide result ids, a job_id or a model_id")
+    return await compare_results(
+        owner_id=req.state.user_id,
+        result_ids=ids,
+        job_id=job_id,
+        model_id=model_id,
+        result_type=result_type,
+        metrics=metrics,
+        limit=min(max(limit, 1), 2000),
+    )
+
 @api_router.get("/{result_id}", tags=["results"], summary="Get a result", response_model=ResultResponse)
 async def get_result(result_id: str, req: Request) -> ResultResponse:
     """Get a result."""
@@ -82,21 +194,17 @@ async def get_result(result_id: str, req: Request) -> ResultResponse:
     result = await Result.objects.select_related("job").get(id=uuid_result_id, owner_id=user_id)
     model = await Model.objects.get(id=result.job.model_id)
     dataset = await Dataset.objects.get(id=result.dataset_id)
-    files: list[ResultResponse.FileResponse] = []
-    jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
-    result_dir = Path(f"{jobs_base_dir}/{str(result_id)}")
     if result is None:
         raise HTTPException(status_code=404, detail=f"Result {result_id} not found")
-    result_files = get_files_in_path(result_dir)
-    result_size = 0
-    for file in result_files:
-        size = os.path.getsize(f"{result_dir}/{file}")
-        file_response = ResultResponse.FileResponse(
-            name=file,
-            size=os.path.getsize(f"{result_dir}/{file}"), # type: ignore
-        )
-        files.append(file_response)
-        result_size += size
+    manifest = await ResultFile.objects.filter(result=result.id).order_by("name").all()
+    if not manifest:
+        # Results submitted before manifests existed are indexed on first read
+        manifest = await index_result_files(result)
+    files = [
+        ResultResponse.FileResponse(name=entry.name, size=entry.size, preview=preview_kind(entry.name))
+        for entry in manifest
+    ]
+    result_size = sum(entry.size for entry in manifest)
     result_response = ResultResponse(
         size=result_size,
         id=result.id,
@@ -116,70 +224,209 @@ async def get_result(result_id: str, req: Request) -> ResultResponse:
         dataset_name=dataset.name,
         dataset_description=dataset.description,
         pretrained_model=result.pretrained_model,
+        pinned=bool(result.pinned),
+        tier=result.tier or "hot",
     )
     return result_response
 
+class MetricsStepIn(BaseModel):
+    """Metrics of a step"""
+
+    step: int
+    metrics: dict[str, float]
+
+class MetricsIn(BaseModel):
+    """Metrics in"""
+
+    points: list[MetricsStepIn]
+
+@api_router.post("/{result_id}/metrics", tags=["results", "jobs"], summary="Report metrics of a running result", status_code=202)
+async def report_metrics(
+    result_id: uuid.UUID,
+    metrics_in: MetricsIn,
+    req: Request,
+) -> Any:
+    """Report metrics while a run goes, they are written in batches."""
+    await metrics_writer.check_owner(result_id, req.state.user_id)
+    points = [
+        Point(name=name, step=step_in.step, value=value)
+        for step_in in metrics_in.points
+        for name, value in step_in.metrics.items()
+    ]
+    try:
+        metrics_writer.add(result_id, points)
+    except BufferFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"}) from e
+    return {"accepted": len(points)}
+
+@api_router.get("/{result_id}/metrics", tags=["results"], summary="Get the metric curves of a result")
+async def get_metric_series(
+    result_id: uuid.UUID,
+    req: Request,
+    names: list[str] = Query(default=[]),
+    points: int = 500,
+    start: int | None = None,
+    end: int | None = None,
+) -> Any:
+    """Get the metric curves of a result, downsampled to at most `points` points per metric."""
+    await Result.objects.get(id=result_id, owner_id=req.state.user_id)
+    return await metric_series(result_id, names=names, points=min(max(points, 1), 10000), start=start, end=end)
+
+@api_router.get("/{result_id}/predictions", tags=["results"], summary="Get a page of the predictions of a result")
+async def get_predictions(
+    result_id: uuid.UUID,
+    req: Request,
+    offset: int = 0,
+    limit: int = 100,
+    columns: list[str] = Query(default=[]),
+    where: list[str] = Query(default=[]),
+) -> Any:
+    """
+    Get up to `limit` predictions from row `offset`, keeping rows that pass every `where`
+    filter, like `score:gt:0.5`. Continue from `next_offset` for the next page.
+    """
+    result = await Result.objects.select_related("job").get(id=result_id, owner_id=req.state.user_id)
+    jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
+    result_dir = Path(f"{jobs_base_dir}/{str(result_id)}")
+    await restore_files(result)
+    if not is_stored(result.predictions):
+        # Predictions submitted inline before columnar storage are moved out of the row on first read
+        result.predictions = await asyncio.to_thread(store_predictions, result_dir, result.predictions or [])
+        await result.update(_columns=["predictions"])
+        await index_result_files(result)
+    filters = [parse_filter(expression) for expression in where]
+    table = await asyncio.to_thread(PredictionsTable, result_dir)
+    return await asyncio.to_thread(table.page, max(offset, 0), min(max(limit, 0), 10000), columns, filters)
+
 @api_router.post("/submit", tags=["results", "jobs"], summary="Submit pm results for a job")
 async def submit_pm_results(
     request: Request,
     error: bool = False,
+    result_id: uuid.UUID | None = None,
 ) -> None:
-    """Submit training results for a job."""
+    """Submit training results for a job, once per `Idempotency-Key` header and `result_id`."""
+    user_id = request.state.user_id
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key is None:
+        await ingest_submission(request, error, result_id)
+        return
+    if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency keys are 1 to {MAX_KEY_LENGTH} characters")
+    if result_id is None:
+        # The key is bound to the result before the body is read
+        raise HTTPException(status_code=400, detail="Submissions with an Idempotency-Key give the result_id in the query")
+    claim = await claim_submit(user_id, idempotency_key, result_id)
+    if claim == "done":
+        # A retry of a submission already stored, its body is not read
+        return
+    if claim == "pending":
+        raise HTTPException(status_code=409, detail="This submission is still being processed")
+    if claim == "conflict":
+        raise HTTPException(status_code=422, detail="This Idempotency-Key was used for another result")
+    try:
+        result = await ingest_submission(request, error, result_id)
+        await complete_submit(user_id, idempotency_key, result.status)
+    except BaseException:
+        await release_submit(user_id, idempotency_key)
+        raise
+
+async def ingest_submission(request: Request, error: bool, expected_result_id: uuid.UUID | None = None) -> Result:
+    """Store the files and outcome of a submission, and advance the job."""
     user_id = request.state.user_id
     result: Result
-    form = await request.form()
-    result_id: uuid.UUID = uuid.UUID(form["result_id"]) # type: ignore
-    result = await Result.objects.select_related("job").get(id=result_id, owner_id=user_id)
-    if result is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Result {result_id} not found",
+    staging_dir = Path(f"{settings.results_dir}/.incoming/{uuid.uuid4()}")
+    try:
+        form = await SubmitFormParser(
+            staging_dir=staging_dir,
+            max_part_size=settings.submit_max_part_size,
+            max_field_size=settings.submit_max_field_size,
+        ).parse(request)
+        result_id: uuid.UUID = uuid.UUID(form.fields["result_id"])
+        if expected_result_id is not None and result_id != expected_result_id:
+            raise HTTPException(status_code=400, detail=f"The form is for result {result_id}, not {expected_result_id}")
+        result = await Result.objects.select_related("job").get(id=result_id, owner_id=user_id)
+        if result is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Result {result_id} not found",
+            )
+        # error file is a file with name error.txt
+        job_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
+        known = {entry.name: entry for entry in await ResultFile.objects.filter(result=result.id).all()}
+        for file in form.files:
+            file_path = Path(f"{job_base_dir}/{str(result_id)}/{file.name}")
+            if is_unchanged(file_path, known.get(file.name), file.sha256):
+                # Sent again by a retry, the file and its manifest entry are kept as they are
+                continue
+            os.makedirs(file_path.parent, exist_ok=True)
+            os.replace(file.staged_path, file_path)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    hashes = {file.name: file.sha256 for file in form.files}
+    if "artifacts" in form.fields:
+        # Files the run already wrote into the mounted result directory are only checked and indexed
+        declared = await asyncio.to_thread(
+            check_declared_artifacts, Path(f"{job_base_dir}/{str(result_id)}"), form.fields["artifacts"],
         )
+        hashes = {**declared, **hashes}
     if error:
         result.status = "error"
-        for key, value in form.items():
-            # error file is a file with name error.txt
-            if type(value) == starlette.datastructures.UploadFile:
-                job_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
-                file_path = Path(f"{job_base_dir}/{str(result_id)}/{value.filename}")
-                os.makedirs(file_path.parent, exist_ok=True)
-                with open(file_path, "wb") as f:
-                    f.write(value.file.read())
-
         result.modified = datetime.datetime.now()
         await result.update()
     else:
-        form = await request.form()
         metrics = {}
         predictions = [] # type: ignore
-        for key, value in form.items():
+        for key, value in form.fields.items():
             if key.startswith("metrics"):
-                metrics = json.loads(value) # type: ignore
+                metrics = json.loads(value)
             elif key.startswith("pretrained_model"):
-                pretrained_model = str(value)
+                pretrained_model = value
             elif key.startswith("predictions"):
                 predictions = value # type: ignore
             elif key.startswith("pkg_name"):
-                pkg_name = str(value)
-            elif isinstance(value, starlette.datastructures.UploadFile):
-                file_name = value.filename if value.filename is not None else key
-                job_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
-                file_path = Path(f"{job_base_dir}/{str(result_id)}/{file_name}")
-                os.makedirs(file_path.parent, exist_ok=True)
-                with file_path.open("wb") as f:
-                    f.write(value.file.read())
+                pkg_name = value
         result.metrics = metrics
         result.status = "done"
         if pkg_name == "pymlab.train":
             result.pretrained_model = pretrained_model
         else:
-            result.predictions = predictions
+            # Only a pointer and a summary are kept in the row, the predictions are stored as columns
+            result.predictions = await asyncio.to_thread(
+                store_predictions, Path(f"{job_base_dir}/{str(result_id)}"), predictions,
+            )
 
         result.modified = datetime.datetime.now()
         await result.update()
+    manifest = await index_result_files(result, hashes=hashes)
+    if settings.cas_enabled:
+        # Checkpoints equal to ones of other results, like re-runs, are stored once
+        await dedupe_result(result)
+    try:
+        await store_files(
+            Path(f"{job_base_dir}/{str(result_id)}/{entry.name}")
+            for entry in manifest
+            if entry.name not in known or (known[entry.name].sha256, known[entry.name].mtime) != (entry.sha256, entry.mtime)
+        )
+    except StorageError as e:
+        # The files stay available from this node
+        print(f"Could not store the files of result {result_id}: {e}")
+    preview_pool.schedule(
+        Path(f"{job_base_dir}/{str(result_id)}"), Path(f"{job_base_dir}/.previews/{str(result_id)}"), manifest,
+    )
+    finished = result
+    if result.parent_id is not None:
+        if not await finish_batch_result(result.parent_id):
+            # Other datasets of the batch test are still running
+            return result
+        finished = await Result.objects.get(id=result.parent_id)
+    if result.dataset_type == "batch" and error:
+        await fail_child_results(await Result.objects.filter(parent_id=result.id).all())
     result.job.ready = True
     result.job.modified = datetime.datetime.now()
     await result.job.update()
+    # Start the next stage of the pipeline the result belongs to, if any
+    asyncio.create_task(advance_pipeline(finished, user_token=getattr(request.state, "user_token", "")))
+    return result
 
 @api_router.get("/download/{result_id}", tags=["results"], summary="Download a result")
 async def zip_files_for_download(
@@ -194,52 +441,219 @@ async def zip_files_for_download(
     result_dir = Path(f"{jobs_base_dir}/{str(result_id)}")
     if result is None:
         raise HTTPException(status_code=404, detail=f"Result {result_id} not found")
-    zip_file_path = f"{result_id}.zip"
-    zip_file = zipfile.ZipFile(zip_file_path, "w")
+    await restore_files(result)
+    # Files stored by another node are fetched first
+    await ensure_result_local(result_dir, [entry.name for entry in await ResultFile.objects.filter(result=result.id).all()])
     result_files = get_files_in_path(result_dir)
-    for file in result_files:
-        # write file to zip without directory structure
-        file_name = "results/" + file
-        zip_file.write(
-            f"{jobs_base_dir}/{str(result_id)}/{file}",
-            arcname=file_name,
-        )
-    zip_file.close()
-    return FileResponse(zip_file_path, filename=f"{result_id}.zip", media_type="application/zip")
+    # write files to zip without directory structure
+    files = [(f"{result_dir}/{file}", "results/" + file) for file in result_files]
+    # The archive is produced in a thread while it is sent, without a temporary file
+    return StreamingResponse(
+        stream_zip(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{result_id}.zip"'},
+    )
 
-@api_router.get("/download/{result_id}/{file_name:path}", tags=["results"], summary="Download a file from a result")
+@api_router.api_route(
+    "/download/{result_id}/{file_name:path}",
+    methods=["GET", "HEAD"],
+    tags=["results"],
+    summary="Download a file from a result",
+)
 async def download_file(
     result_id: str,
     file_name: str,
     req: Request
 ) -> Any:
-    """Download a file from a result."""
+    """Download a file from a result, with byte ranges and conditional requests."""
     user_id = req.state.user_id
     result_uuid = uuid.UUID(result_id)
     result = await Result.objects.select_related("job").get(id=result_uuid, owner_id=user_id)
     if result is None:
         raise HTTPException(status_code=404, detail=f"Result {result_id} not found")
     jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
-    file_path = Path(f"{jobs_base_dir}/{str(result_id)}/{file_name}")
-    return FileResponse(file_path, filename=file_name)
-
-# @api_router.get("/stream/{result_id}/{file_name}")
-# async def stream_file(
-#     result_id: str,
-#     file_name: str,
-#     websocket: WebSocket,
-#     req: Request,
-# ) -> None:
-#     """Stream a file from a result."""
-#     user_id = req.state.user_id
-#     result_uuid = uuid.UUID(result_id)
-#     result = await Result.objects.select_related("job").get(id=result_uuid, owner_id=user_id)
-#     if result is None:
-#         raise HTTPException(status_code=404, detail=f"Result {result_id} not found")
-#     jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
-#     file_path = Path(f"{jobs_base_dir}/{str(result_id)}/{file_name}")
-#     await websocket.accept()
-#     while True:
-#         await asyncio.sleep(0.1)
-#         payload = next(file_path.open("r"))
-#         await websocket.send_json(payload)
+    result_dir = Path(f"{jobs_base_dir}/{str(result_id)}").resolve()
+    file_path = (result_dir / file_name).resolve()
+    if not file_path.is_relative_to(result_dir):
+        raise HTTPException(status_code=404, detail=f"File {file_name} not found")
+    # The manifest hash is a strong ETag as long as the file did not change since it was indexed
+    entry = await ResultFile.objects.get_or_none(result=result.id, name=file_name)
+    if entry is not None:
+        # Backends with direct downloads serve indexed files themselves
+        url = download_url(file_path, os.path.basename(file_name))
+        if url is not None:
+            return RedirectResponse(url, status_code=307)
+    await restore_files(result)
+    try:
+        await ensure_local(file_path)
+    except (FileNotFoundError, StorageError):
+        raise HTTPException(status_code=404, detail=f"File {file_name} not found")
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail=f"File {file_name} not found")
+    stat = file_path.stat()
+    if entry is not None and entry.mtime == stat.st_mtime and stat.st_size == (
+        entry.stored_size if entry.encoding else entry.size
+    ):
+        # The manifest entry describes the file as it is
+        return ResultFileResponse(
+            str(file_path),
+            filename=file_name,
+            sha256=entry.sha256,
+            encoding=entry.encoding,
+            content_size=entry.size if entry.encoding else None,
+        )
+    return ResultFileResponse(str(file_path), filename=file_name, encoding=stored_encoding(file_path))
+
+async def restore_files(result: Result) -> None:
+    """Bring back the files of an archived result before they are read"""
+    try:
+        await ensure_hot(result)
+    except (FileNotFoundError, StorageError) as e:
+        raise HTTPException(status_code=404, detail=f"Files of result {result.id} not found") from e
+
+@api_router.put("/{result_id}/pin", tags=["results"], summary="Pin or unpin a result")
+async def pin_result(result_id: uuid.UUID, req: Request, pinned: bool = True) -> None:
+    """Pin a result so it is never moved to the archive tier, or unpin it."""
+    result = await Result.objects.get(id=result_id, owner_id=req.state.user_id)
+    result.pinned = pinned
+    await result.update(_columns=["pinned"])
+
+@api_router.post("/{result_id}/restore", tags=["results"], summary="Restore an archived result")
+async def restore_result(result_id: uuid.UUID, req: Request) -> None:
+    """Bring the files of an archived result back to the hot tier ahead of reading them."""
+    result = await Result.objects.select_related("job").get(id=result_id, owner_id=req.state.user_id)
+    await restore_files(result)
+
+@api_router.get("/{result_id}/preview/{file_name:path}", tags=["results"], summary="Preview a file of a result")
+async def preview_file(result_id: uuid.UUID, file_name: str, req: Request) -> Any:
+    """Get the first rows of a CSV, a truncated JSON or text file, or a thumbnail of an image of a result."""
+    result = await Result.objects.select_related("job").get(id=result_id, owner_id=req.state.user_id)
+    entry = await ResultFile.objects.get_or_none(result=result.id, name=file_name)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"File {file_name} not found")
+    if preview_kind(file_name) is None:
+        raise HTTPException(status_code=415, detail=f"File {file_name} has no preview")
+    jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
+    result_dir = Path(f"{jobs_base_dir}/{str(result_id)}")
+    cache_dir = Path(f"{jobs_base_dir}/.previews/{str(result_id)}")
+    try:
+        if not preview_path(cache_dir, entry).exists():
+            # Cached previews of archived results are served without restoring them
+            await ensure_hot(result)
+            await ensure_local(result_dir / file_name)
+        preview = await preview_pool.get(result_dir, cache_dir, entry)
+    except (FileNotFoundError, StorageError):
+        raise HTTPException(status_code=404, detail=f"File {file_name} not found")
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Could not preview {file_name}: {e}")
+    media_type = "image/png" if preview.suffix == ".png" else "application/json"
+    # Previews are named after the content hash, they never change
+    return FileResponse(preview, media_type=media_type, headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+async def result_logs_dir(result_id: uuid.UUID, user_id: str) -> tuple[Path, bool]:
+    """Logs directory of a result owned by the user, and whether its run is still going"""
+    result = await Result.objects.select_related("job").get(id=result_id, owner_id=user_id)
+    await restore_files(result)
+    jobs_base_dir, _, _ = job_get_dirs(result.job.id, "", "")
+    return Path(f"{jobs_base_dir}/{str(result_id)}/logs"), result.status == "running"
+
+class LogLinesResponse(BaseModel):
+    """Log lines response"""
+
+    class LogLine(BaseModel):
+        """Log line"""
+        line: int
+        text: str
+
+    lines: list[LogLine]
+
+def log_lines_response(lines: list[tuple[int, str]]) -> LogLinesResponse:
+    return LogLinesResponse(lines=[LogLinesResponse.LogLine(line=line, text=text) for line, text in lines])
+
+@api_router.get("/logs/{result_id}", tags=["results"], summary="Get a page of the logs of a result", response_model=LogLinesResponse)
+async def get_logs(
+    result_id: uuid.UUID,
+    req: Request,
+    start: int = 0,
+    limit: int = 1000,
+) -> LogLinesResponse:
+    """Get up to `limit` lines of the logs of a result from line `start`."""
+    logs_dir, _ = await result_logs_dir(result_id, req.state.user_id)
+    reader = await asyncio.to_thread(LogReader, logs_dir)
+    return log_lines_response(await asyncio.to_thread(reader.page, max(start, 0), min(max(limit, 0), 10000)))
+
+@api_router.get("/logs/{result_id}/tail", tags=["results"], summary="Get the last lines of the logs of a result", response_model=LogLinesResponse)
+async def tail_logs(
+    result_id: uuid.UUID,
+    req: Request,
+    lines: int = 100,
+) -> LogLinesResponse:
+    """Get the last lines of the logs of a result."""
+    logs_dir, _ = await result_logs_dir(result_id, req.state.user_id)
+    reader = await asyncio.to_thread(LogReader, logs_dir)
+    return log_lines_response(await asyncio.to_thread(reader.tail, min(max(lines, 0), 10000)))
+
+@api_router.get("/logs/{result_id}/search", tags=["results"], summary="Search the logs of a result", response_model=LogLinesResponse)
+async def search_logs(
+    result_id: uuid.UUID,
+    q: str,
+    req: Request,
+    regex: bool = False,
+    start: int = 0,
+    limit: int = 100,
+) -> LogLinesResponse:
+    """Find the lines of the logs of a result that contain `q`, or match it as a regular expression."""
+    logs_dir, _ = await result_logs_dir(result_id, req.state.user_id)
+    reader = await asyncio.to_thread(LogReader, logs_dir)
+    try:
+        matches = await asyncio.to_thread(reader.search, q, regex, min(max(limit, 0), 1000), max(start, 0))
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid pattern: {e}") from e
+    return log_lines_response(matches)
+
+@api_router.get("/logs/{result_id}/stream", tags=["results"], summary="Follow the logs of a result")
+async def stream_logs(
+    result_id: uuid.UUID,
+    req: Request,
+    offset: int = 0,
+) -> Any:
+    """Follow the logs of a result as server-sent events, resuming from a byte offset or Last-Event-ID."""
+    logs_dir, live = await result_logs_dir(result_id, req.state.user_id)
+    last_event_id = req.headers.get("Last-Event-ID")
+    if last_event_id is not None and last_event_id.isdigit():
+        offset = int(last_event_id)
+
+    async def events() -> AsyncIterator[str]:
+        async for next_offset, message in log_messages(logs_dir, offset=offset, live=live):
+            yield f"id: {next_offset}\ndata: {message}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@api_router.websocket("/logs/{result_id}/ws")
+async def websocket_logs(
+    websocket: WebSocket,
+    result_id: uuid.UUID,
+    token: str = "",
+    offset: int = 0,
+) -> None:
+    """Follow the logs of a result over a WebSocket, authenticated with a `token` query parameter."""
+    try:
+        user_id = verify_jwt(token).get("username")
+    except Exception:
+        user_id = None
+    if not isinstance(user_id, str):
+        await websocket.close(code=1008)
+        return
+    try:
+        logs_dir, live = await result_logs_dir(result_id, user_id)
+    except NoMatch:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        async for _, message in log_messages(logs_dir, offset=offset, live=live):
+            await websocket.send_text(message)
+    except WebSocketDisconnect:
+        return
+    await websocket.close()
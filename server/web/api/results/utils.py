@@ -0,0 +1,247 @@
+"""UTILS FOR RESULTS API"""
+import codecs
+import csv
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
+import io
+import json
+import os
+from pathlib import Path
+from typing import IO, Any, AsyncIterator, Iterable, Iterator, cast
+import uuid
+import zipfile
+
+from fastapi import HTTPException
+
+from server.db.models.result_files import ResultFile
+from server.db.models.results import Result
+from server.services.compression import open_stored, stored_encoding
+from server.services.logs import follow_log
+from server.services.manifest import hash_file
+from server.web.api.results.ingest import safe_relative_name
+
+CHUNK_SIZE = 1024 * 1024
+# Files up to this size are read ahead whole when archives are made with several workers
+PREFETCH_SIZE = 4 * 1024 ** 2
+
+# Files that are already compressed or barely compress, like model weights,
+# are stored in archives as they are instead of being deflated again
+STORED_SUFFIXES = {
+    ".pt", ".pth", ".ckpt", ".bin", ".safetensors", ".h5", ".onnx", ".pb", ".tflite", ".npy", ".npz",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".mp3", ".ogg", ".mp4", ".webm",
+}
+
+
+async def finish_batch_result(parent_id: uuid.UUID) -> bool:
+    """Close a batch test once every child result has been submitted"""
+    children = await Result.objects.filter(parent_id=parent_id).all()
+    if any(child.status == "running" for child in children):
+        return False
+    parent = await Result.objects.get(id=parent_id)
+    # The metrics of a batch are those of each child, by child name
+    batch_metrics: dict[str, Any] = {child.name: child.metrics for child in children}
+    parent.metrics = batch_metrics
+    parent.status = "done" if all(child.status == "done" for child in children) else "error"
+    parent.modified = datetime.datetime.now()
+    await parent.update()
+    return True
+
+
+def is_unchanged(path: Path, entry: ResultFile | None, sha256: str) -> bool:
+    """Whether a submitted file has the content its manifest entry records and the file on disk still has."""
+    if entry is None or entry.sha256 != sha256:
+        return False
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    return entry.mtime == stat.st_mtime and stat.st_size == (entry.stored_size if entry.encoding else entry.size)
+
+
+def check_declared_artifacts(result_dir: Path, artifacts: str) -> dict[str, str]:
+    """
+    Check the files a run declares it wrote straight into its mounted result directory.
+
+    Runs write into the job directory mounted in the container, so they can
+    declare artifacts instead of uploading them again. Each artifact is
+    either a path relative to the result directory or an object with
+    `name` and optionally `size` and `sha256`, computed while writing.
+    A declared hash is checked against the file, so the manifest only holds
+    hashes the server computed. The files are read, call it in a thread.
+
+    Parameters:
+    - result_dir (Path): The result directory on the host.
+    - artifacts (str): JSON list of the declared artifacts.
+
+    Returns:
+    - dict[str, str]: Checked SHA-256 by artifact name, for the file manifest.
+
+    Raises:
+    - HTTPException: If an artifact is malformed, outside the result directory, missing, or of another size or hash.
+    """
+    try:
+        declared = json.loads(artifacts)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="Artifacts must be a JSON list") from e
+    if not isinstance(declared, list):
+        raise HTTPException(status_code=400, detail="Artifacts must be a JSON list")
+    root = result_dir.resolve()
+    hashes = {}
+    for artifact in declared:
+        if isinstance(artifact, str):
+            artifact = {"name": artifact}
+        if not isinstance(artifact, dict):
+            raise HTTPException(status_code=400, detail="Artifacts must be names or objects with a name")
+        name = safe_relative_name(str(artifact.get("name", "")))
+        path = (result_dir / name).resolve()
+        if root not in path.parents or not path.is_file():
+            raise HTTPException(status_code=400, detail=f"Artifact {name} was not found in the result directory")
+        if "size" in artifact and os.path.getsize(path) != artifact["size"]:
+            raise HTTPException(status_code=400, detail=f"Artifact {name} is not the declared size")
+        if artifact.get("sha256"):
+            sha256 = hash_file(path)
+            if sha256 != str(artifact["sha256"]).lower():
+                raise HTTPException(status_code=400, detail=f"Artifact {name} does not match the declared sha256")
+            hashes[name] = sha256
+    return hashes
+
+
+class ZipSink(io.RawIOBase):
+    """Unseekable stream collecting what zipfile writes, so the archive can be sent as it is produced"""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: bytes) -> int:  # type: ignore[override]
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        """Take what was written since the last drain."""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _read_content(path: str) -> bytes:
+    with open_stored(path) as f:
+        return f.read()
+
+
+def _content_size(path: str, sizes: dict[str, int]) -> int | None:
+    """Size of the content of a file, None when it is stored compressed and not in `sizes`."""
+    if path in sizes:
+        return sizes[path]
+    if stored_encoding(path) is not None:
+        return None
+    return os.path.getsize(path)
+
+
+def stream_zip(
+    files: Iterable[tuple[str, str]],
+    members: Iterable[tuple[str, bytes]] = (),
+    workers: int = 1,
+    sizes: dict[str, int] | None = None,
+) -> Iterator[bytes]:
+    """
+    Zip files while reading them and yield the archive in chunks.
+
+    The archive is written to an unseekable sink, so zipfile puts sizes and
+    CRCs in data descriptors after each entry and uses ZIP64 records for big
+    files. Memory use is bounded by the chunk size whatever the file sizes.
+    Files stored compressed are decompressed into the archive.
+
+    With more than one worker, the next small files are read in threads
+    while the current one is compressed, so archives of many small files
+    are not bound by the latency of each read. Larger files are streamed,
+    and so are compressed files of unknown content size, which can expand
+    far beyond their size on disk.
+
+    Parameters:
+    - files (Iterable[tuple[str, str]]): Path of each file and its name in the archive.
+    - members (Iterable[tuple[str, bytes]], optional): Generated files, name and content, written first.
+    - workers (int, optional): Files read at once. Defaults to 1.
+    - sizes (dict[str, int] | None, optional): Content size of files by path, from their manifest entry.
+
+    Yields:
+    - bytes: The next part of the archive.
+    """
+    files = list(files)
+    sink = ZipSink()
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    ahead: dict[int, Future[bytes]] = {}
+    try:
+        with zipfile.ZipFile(cast(IO[bytes], sink), "w") as zip_file:
+            for arcname, content in members:
+                zip_file.writestr(arcname, content, compress_type=zipfile.ZIP_DEFLATED)
+                yield sink.drain()
+            for index, (path, arcname) in enumerate(files):
+                if executor is not None:
+                    for following in range(index, min(index + workers, len(files))):
+                        size = _content_size(files[following][0], sizes or {})
+                        if following not in ahead and size is not None and size <= PREFETCH_SIZE:
+                            ahead[following] = executor.submit(_read_content, files[following][0])
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                info.compress_type = zipfile.ZIP_STORED if Path(path).suffix.lower() in STORED_SUFFIXES else zipfile.ZIP_DEFLATED
+                # The stat gives the stored size, ZIP64 cannot be ruled out from it for compressed files
+                force_zip64 = stored_encoding(path) is not None
+                prefetched = ahead.pop(index, None)
+                with zip_file.open(info, "w", force_zip64=force_zip64) as dest:
+                    if prefetched is not None:
+                        content = prefetched.result()
+                        for offset in range(0, len(content), CHUNK_SIZE):
+                            dest.write(content[offset:offset + CHUNK_SIZE])
+                            yield sink.drain()
+                    else:
+                        with open_stored(path) as src:
+                            while chunk := src.read(CHUNK_SIZE):
+                                dest.write(chunk)
+                                data = sink.drain()
+                                if data:
+                                    yield data
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _flatten_metrics(metrics: Any, prefix: str = "") -> dict[str, Any]:
+    """Metrics as flat columns, nested metrics (like those of batch tests) named with dots"""
+    if not isinstance(metrics, dict):
+        return {prefix: metrics} if prefix else {}
+    columns: dict[str, Any] = {}
+    for key, value in metrics.items():
+        columns.update(_flatten_metrics(value, f"{prefix}.{key}" if prefix else str(key)))
+    return columns
+
+
+def metrics_csv(results: list[Result]) -> bytes:
+    """A CSV with a row per result and a column per metric, for results exported together"""
+    rows = [_flatten_metrics(result.metrics or {}) for result in results]
+    names = sorted({name for row in rows for name in row})
+    buffer = io.StringIO(newline="")
+    writer = csv.writer(buffer)
+    writer.writerow(["result_id", "name", "result_type", "status", *names])
+    for result, row in zip(results, rows):
+        writer.writerow([
+            str(result.id),
+            result.name,
+            result.result_type,
+            result.status,
+            *(json.dumps(row[name]) if isinstance(row.get(name), (list, dict)) else row.get(name, "") for name in names),
+        ])
+    return buffer.getvalue().encode("utf-8")
+
+
+async def log_messages(logs_dir: Path, offset: int, live: bool) -> AsyncIterator[tuple[int, str]]:
+    """Follow the logs of a run from a byte offset, as `(next offset, JSON message)` pairs"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    async for start, data in follow_log(logs_dir, offset=offset, live=live):
+        text = decoder.decode(data)
+        yield start + len(data), json.dumps({"offset": start, "text": text})
@@ -11,7 +11,7 @@ from server.services.auth_bearer import JWTPayload, verify_jwt
 from server.settings import settings
 from server.web.api.router import api_router
 from server.web.lifetime import register_shutdown_event, register_startup_event
-from server.web.middleware import file_upload_middleware
+from server.web.middleware import UploadGuardMiddleware
 
 
 def get_app() -> FastAPI:
@@ -31,6 +31,9 @@ def get_app() -> FastAPI:
         default_response_class=UJSONResponse,
     )
 
+    # Added first, so rejected uploads still get the CORS headers and auth is checked before them
+    app.add_middleware(UploadGuardMiddleware, max_size=settings.upload_form_max_size)
+
     origins = ["*", "https://mlab.appatechlab.com:8080", "https://disal.appatechlab.com:8080"]
 
     app.add_middleware(
@@ -42,14 +45,6 @@ def get_app() -> FastAPI:
         expose_headers=["*"],
     )
 
-    # app.add_middleware(
-    #     ValidateUploadFileMiddleware,
-    #     max_size=50_000_000,
-    # )
-    # @app.middleware("http")
-    # async def file_validator(request: Request, call_next: Any) -> Any:
-    #     return await file_upload_middleware(request, call_next)
-
     @app.middleware("http")
     async def check_auth(request: Request, call_next: Any) -> Any:
         if request.method == "OPTIONS":
@@ -1,9 +1,16 @@
+import asyncio
 from typing import Awaitable, Callable
 
 from fastapi import FastAPI
 
 from server.db.config import database
+from server.services import cas, compression, retention
+from server.services.metrics import metrics_writer
+from server.services.previews import preview_pool
+from server.services.predictors import predictors, preload_predictors
 from server.services.redis.lifetime import init_redis, shutdown_redis
+from server.services.warm_pool import warm_pool
+from server.settings import settings
 
 
 def register_startup_event(
@@ -24,6 +31,19 @@ def register_startup_event(
         app.middleware_stack = None
         await database.connect()
         # init_redis(app)
+        app.state.metrics_writer_task = asyncio.create_task(metrics_writer.run_forever())
+        if settings.compress_at_rest:
+            app.state.compression_task = asyncio.create_task(
+                compression.run_forever(settings.compression_interval, settings.compression_delay),
+            )
+        if settings.cas_enabled:
+            app.state.cas_gc_task = asyncio.create_task(cas.run_forever(settings.cas_gc_interval))
+        if settings.retention_enabled:
+            app.state.retention_task = asyncio.create_task(retention.run_forever(settings.retention_interval))
+        if settings.warm_pool_enabled:
+            app.state.warm_pool_task = asyncio.create_task(warm_pool.run_forever())
+        if settings.predictor_preload:
+            asyncio.create_task(preload_predictors())
         app.middleware_stack = app.build_middleware_stack()
         pass  # noqa: WPS420
 
@@ -42,8 +62,21 @@ def register_shutdown_event(
 
     @app.on_event("shutdown")
     async def _shutdown() -> None:  # noqa: WPS430
+        app.state.metrics_writer_task.cancel()
+        if settings.compress_at_rest:
+            app.state.compression_task.cancel()
+        if settings.cas_enabled:
+            app.state.cas_gc_task.cancel()
+        if settings.retention_enabled:
+            app.state.retention_task.cancel()
+        await metrics_writer.flush()
         await database.disconnect()
         # await shutdown_redis(app)
+        if settings.warm_pool_enabled:
+            app.state.warm_pool_task.cancel()
+            await warm_pool.shutdown()
+        await predictors.shutdown()
+        preview_pool.shutdown()
         pass  # noqa: WPS420
 
     return _shutdown
@@ -1,10 +1,12 @@
-from typing import Any, List
-from fastapi import status
-from starlette.responses import Response
-from starlette.requests import Request
 from typing import List
 from enum import Enum
 
+import multipart
+from multipart.multipart import parse_options_header
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
 
 class FileTypeName(str, Enum):
     # Audio file type
@@ -58,30 +60,229 @@ class FileTypeName(str, Enum):
 
 
 FILE_TYPES: List[str] = FileTypeName.list()
-MAX_SIZE: int = 50_000_000
 UPLOAD_FILE_PATHS: List[str] = ['/api/jobs/upload']
+TEXT_TYPES: List[str] = [
+    FileTypeName.txt, FileTypeName.csv, FileTypeName.json, FileTypeName.xml, FileTypeName.html,
+]
+# Leading bytes of each file type: offset, magic bytes, and the declared types they match
+SIGNATURES: List[tuple[int, bytes, List[str]]] = [
+    (0, b"\x89PNG\r\n\x1a\n", [FileTypeName.png]),
+    (0, b"\xff\xd8\xff", [FileTypeName.jpeg, FileTypeName.jpg]),
+    (0, b"GIF87a", [FileTypeName.gif]),
+    (0, b"GIF89a", [FileTypeName.gif]),
+    (8, b"WEBP", [FileTypeName.webp]),
+    (8, b"WAVE", [FileTypeName.wav, FileTypeName.wave]),
+    (0, b"OggS", [FileTypeName.ogg]),
+    (0, b"ID3", [FileTypeName.mp3, FileTypeName.mpeg]),
+    (0, b"\xff\xfb", [FileTypeName.mp3, FileTypeName.mpeg]),
+    (0, b"\xff\xf3", [FileTypeName.mp3, FileTypeName.mpeg]),
+    (0, b"\xff\xf2", [FileTypeName.mp3, FileTypeName.mpeg]),
+    (4, b"ftyp", [FileTypeName.mp4, FileTypeName.mpeg4]),
+    (0, b"\x1a\x45\xdf\xa3", [FileTypeName.webm, FileTypeName.webm2, FileTypeName.webm3]),
+    (0, b"%PDF-", [FileTypeName.pdf]),
+    # Office documents since 2007 are zip files
+    (0, b"PK\x03\x04", [FileTypeName.zip, FileTypeName.docx, FileTypeName.xlsx, FileTypeName.pptx]),
+    (0, b"PK\x05\x06", [FileTypeName.zip]),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", [FileTypeName.doc, FileTypeName.xls, FileTypeName.ppt]),
+    (0, b"Rar!\x1a\x07", [FileTypeName.rar]),
+    (0, b"\x1f\x8b", [FileTypeName.gzip, FileTypeName.tar_gz]),
+    (257, b"ustar", [FileTypeName.tar]),
+]
+# Programs are not test data, whatever type they are sent as
+EXECUTABLE_SIGNATURES: List[bytes] = [
+    b"\x7fELF",
+    b"MZ",
+    b"\xcf\xfa\xed\xfe",
+    b"\xce\xfa\xed\xfe",
+    b"\xfe\xed\xfa\xcf",
+    b"\xca\xfe\xba\xbe",
+    b"#!",
+]
+# Bytes of each file read before its type is checked
+SNIFF_SIZE = 512
+
+
+def check_upload_file_paths(request_url: str) -> bool:
+    """Whether uploads to this path are guarded."""
+    return any(request_url.startswith(path) for path in UPLOAD_FILE_PATHS)
+
+
+def is_text(head: bytes) -> bool:
+    """Whether the first bytes of a file decode as UTF-8 and hold no NUL byte."""
+    if b"\x00" in head:
+        return False
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A character cut at the end of the sniffed bytes
+        return e.start >= len(head) - 3 and e.reason == "unexpected end of data"
+    return True
+
+
+def sniff_content_type(head: bytes, declared: str) -> bool:
+    """
+    Whether the first bytes of a file match its declared content type.
+
+    Known types must have their signature, or be text for text types. Other
+    text types (`text/tab-separated-values`, ...) must be text. Files sent
+    without a type, as `application/octet-stream` or with a type not listed,
+    like `.npy` or `.parquet` test data, are accepted unless they are programs.
+    """
+    for offset, magic, types in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic and declared in FILE_TYPES:
+            return declared in types
+    if declared in TEXT_TYPES or declared.startswith("text/"):
+        return is_text(head)
+    if declared in FILE_TYPES:
+        return False
+    return not any(head.startswith(magic) for magic in EXECUTABLE_SIGNATURES)
+
+
+class UploadRejected(Exception):
+    """An upload the guard refuses, with the status it is answered with."""
+
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class _UploadCheck:
+    """Parse the multipart body as it goes through, checking the type of each file from its first bytes."""
+
+    def __init__(self, boundary: bytes) -> None:
+        self.files = 0
+        self._headers: dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._content_type: str | None = None
+        self._head = b""
+        self._checked = True
+        self.parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+    def on_part_begin(self) -> None:
+        self._headers = {}
+        self._content_type = None
+        self._head = b""
+        self._checked = True
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in options:
+            return
+        self.files += 1
+        content_type, _ = parse_options_header(self._headers.get(b"content-type", b"application/octet-stream"))
+        # Clients like requests and httpx send no type, the content is sniffed then
+        self._content_type = content_type.decode("latin-1").lower() or "application/octet-stream"
+        self._checked = False
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._checked:
+            return
+        self._head += data[start:min(end, start + SNIFF_SIZE - len(self._head))]
+        if len(self._head) >= SNIFF_SIZE:
+            self._check()
+
+    def on_part_end(self) -> None:
+        if not self._checked:
+            self._check()
+
+    def _check(self) -> None:
+        self._checked = True
+        if not sniff_content_type(self._head, self._content_type or ""):
+            raise UploadRejected(415, f"The content of the file is not of type {self._content_type}")
+
+
+class UploadGuardMiddleware:
+    """
+    Check file uploads while they are received, before the route reads them.
+
+    Uploads announcing more than `max_size` bytes are refused before any of
+    the body is read. The others are passed through chunk by chunk: the
+    bytes are counted, and the multipart headers and first bytes of each
+    file are checked as they go by, so an upload of the wrong type or
+    larger than announced is cut off at the first chunk that shows it,
+    without spooling the form.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int) -> None:
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or not check_upload_file_paths(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        content_type, params = parse_options_header(headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            # Upload sessions send their chunks as raw bytes and check their own sizes
+            await self.app(scope, receive, send)
+            return
+        content_length = headers.get("content-length")
+        if content_length is not None and (not content_length.isdigit() or int(content_length) > self.max_size):
+            await self._reject(scope, receive, send, UploadRejected(413, f"Uploads are limited to {self.max_size} bytes"))
+            return
+        check = _UploadCheck(params[b"boundary"])
+        received = 0
+        rejected: UploadRejected | None = None
+        response_started = False
+
+        async def guarded_receive() -> Message:
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] != "http.request" or rejected is not None:
+                return message
+            body = message.get("body", b"")
+            received += len(body)
+            try:
+                if received > self.max_size:
+                    raise UploadRejected(413, f"Uploads are limited to {self.max_size} bytes")
+                check.parser.write(body)
+                if not message.get("more_body", False):
+                    check.parser.finalize()
+                    if check.files == 0:
+                        raise UploadRejected(400, "No file provided")
+            except UploadRejected as e:
+                rejected = e
+                raise
+            return message
+
+        async def guarded_send(message: Message) -> None:
+            nonlocal response_started
+            if rejected is not None and not response_started:
+                # The route failed on the rejected body, the rejection is answered instead
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, guarded_receive, guarded_send)
+        except UploadRejected:
+            pass
+        if rejected is not None and not response_started:
+            await self._reject(scope, receive, send, rejected)
 
-def check_upload_file_paths(request_url):
-    exists = False
-    for path in UPLOAD_FILE_PATHS:
-        if request_url.startswith(path):
-            exists = True
-            break
-    return exists
-
-async def file_upload_middleware(request: Request, call_next: Any) -> Response:
-    if request.method == 'POST' and check_upload_file_paths(request.url.path):
-        form = await request.form()
-        file = form.get('file')
-        if file is None:
-            return Response(status_code=status.HTTP_400_BAD_REQUEST)
-        if isinstance(file, str):
-            raise NotImplementedError("This middleware does not support file str")
-        if file.content_type not in FILE_TYPES:
-            return Response(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
-        if 'content-length' not in request.headers:
-            return Response(status_code=status.HTTP_411_LENGTH_REQUIRED)
-        content_length = int(request.headers['content-length'])
-        if content_length > MAX_SIZE:
-            return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
-    return await call_next(request)
+    async def _reject(self, scope: Scope, receive: Receive, send: Send, rejected: UploadRejected) -> None:
+        # The connection is closed instead of reading the rest of the body
+        response = JSONResponse({"detail": rejected.detail}, status_code=rejected.status_code, headers={"connection": "close"})
+        await response(scope, receive, send)